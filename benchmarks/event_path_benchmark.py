@@ -0,0 +1,393 @@
+""" End-to-end benchmark of the userland event path.
+
+Drives `BPFProbe._process_events` of the built-in probes with synthetic BPF events,
+in a forked probe process as in real deployments, while the main process collects
+events from the transport and writes them to a sink. Process information is read
+from a fake /proc tree, so neither root privileges nor a BPF-capable kernel are needed.
+
+Reports kernel event throughput of the probe process, end-to-end output throughput,
+latency percentiles from event submission to write, and peak memory usage.
+Results can be saved and compared across commits to catch performance regressions.
+
+Usage: python -m benchmarks.event_path_benchmark [-n EVENTS] [--rate EPS] [--save FILE] [--compare FILE]
+"""
+import argparse
+import asyncio
+import ctypes
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing import Process
+from multiprocessing import set_start_method
+from multiprocessing.sharedctypes import RawArray
+from threading import Thread
+from typing import Any
+from typing import Callable
+from typing import Iterator
+from typing import List
+from typing import NamedTuple
+from unittest.mock import MagicMock
+
+import psutil
+
+try:
+    import bcc  # noqa: F401
+except ImportError:
+    # only used for compiling BPF programs, which this benchmark never does
+    sys.modules['bcc'] = MagicMock(__version__='0.18.0')
+
+from pidtree_bcc.probes import BPFProbe  # noqa: E402
+from pidtree_bcc.probes.net_listen import NetListenProbe  # noqa: E402
+from pidtree_bcc.probes.tcp_connect import TCPConnectProbe  # noqa: E402
+from pidtree_bcc.probes.udp_session import UDPSessionProbe  # noqa: E402
+from pidtree_bcc.transport import BatchingQueueTransport  # noqa: E402
+from pidtree_bcc.transport import EventTransport  # noqa: E402
+from pidtree_bcc.transport import forward_events  # noqa: E402
+from pidtree_bcc.transport import SharedMemoryRingTransport  # noqa: E402
+from pidtree_bcc.utils import ip_to_int  # noqa: E402
+
+
+# Event structures mirroring the ones defined in the probe templates (only the fields used in userland)
+class ConnectionEvent(ctypes.Structure):
+    _fields_ = [
+        ('pid', ctypes.c_uint32),
+        ('daddr', ctypes.c_uint32),
+        ('saddr', ctypes.c_uint32),
+        ('dport', ctypes.c_uint16),
+    ]
+
+
+class UDPSessionEvent(ctypes.Structure):
+    _fields_ = [
+        ('type', ctypes.c_uint8),
+        ('pid', ctypes.c_uint32),
+        ('sock_pointer', ctypes.c_uint64),
+        ('daddr', ctypes.c_uint32),
+        ('dport', ctypes.c_uint16),
+        ('counted', ctypes.c_uint8),
+    ]
+
+
+class ListenEvent(ctypes.Structure):
+    _fields_ = [
+        ('pid', ctypes.c_uint32),
+        ('laddr', ctypes.c_uint32),
+        ('port', ctypes.c_uint16),
+        ('protocol', ctypes.c_uint8),
+    ]
+
+
+class FakeTable:
+    """ Stand-in for the BPF tables accessed in userland """
+
+    @staticmethod
+    def event(data: Any) -> Any:
+        return data  # events are passed as ctypes structures already
+
+    @staticmethod
+    def Key(**kwargs) -> tuple:
+        return tuple(sorted(kwargs.items()))
+
+    def __getitem__(self, key: Any):
+        raise KeyError(key)
+
+
+class FakeBPF:
+    def __getitem__(self, name: str) -> FakeTable:
+        return FakeTable()
+
+
+class Scenario(NamedTuple):
+    probe_class: type
+    # generates (event, sequence number or None) for the i-th synthetic event, where the
+    # sequence number is set for events completing an output event, and embedded in it
+    generate: Callable[[int, int], Iterator[tuple]]
+    # extracts the sequence number from a serialized output event
+    sequence_of: Callable[[dict], int]
+
+
+# leaf processes of the fake process tree generating events
+LEAF_PID_START = 10000
+SEQUENCE_BASE = ip_to_int('10.0.0.0')
+
+
+def generate_connections(count: int, pids: int) -> Iterator[tuple]:
+    for i in range(count):
+        event = ConnectionEvent(
+            pid=LEAF_PID_START + i % pids,
+            daddr=ip_to_int('10.1.2.3'),
+            saddr=SEQUENCE_BASE + i,
+            dport=443,
+        )
+        yield event, i
+
+
+def generate_udp_sessions(count: int, pids: int, messages: int = 3) -> Iterator[tuple]:
+    """ Each session is a start event, a few messages to the same destination and an end event """
+    for i in range(count):
+        pid = LEAF_PID_START + i % pids
+        sock_pointer = 0xffff000000000000 + i
+        yield UDPSessionEvent(
+            type=UDPSessionProbe.SESSION_START, pid=pid, sock_pointer=sock_pointer,
+            daddr=SEQUENCE_BASE + i, dport=53,
+        ), None
+        for _ in range(messages - 1):
+            yield UDPSessionEvent(
+                type=UDPSessionProbe.SESSION_CONTINUE, pid=pid, sock_pointer=sock_pointer,
+                daddr=SEQUENCE_BASE + i, dport=53,
+            ), None
+        yield UDPSessionEvent(type=UDPSessionProbe.SESSION_END, pid=pid, sock_pointer=sock_pointer), i
+
+
+def generate_listens(count: int, pids: int) -> Iterator[tuple]:
+    for i in range(count):
+        event = ListenEvent(pid=LEAF_PID_START + i % pids, laddr=SEQUENCE_BASE + i, port=8080, protocol=6)
+        yield event, i
+
+
+SCENARIOS = {
+    'tcp_connect': Scenario(
+        TCPConnectProbe,
+        generate_connections,
+        lambda event: ip_to_int(event['saddr']) - SEQUENCE_BASE,
+    ),
+    'udp_session': Scenario(
+        UDPSessionProbe,
+        generate_udp_sessions,
+        lambda event: ip_to_int(event['destinations'][0]['daddr']) - SEQUENCE_BASE,
+    ),
+    'net_listen': Scenario(
+        NetListenProbe,
+        generate_listens,
+        lambda event: ip_to_int(event['laddr']) - SEQUENCE_BASE,
+    ),
+}
+
+
+def build_fake_procfs(path: str, pids: int):
+    """ Create a fake /proc with a process tree like init -> containerd-shim -> supervisord -> workers
+
+    :param str path: directory where to create the fake procfs
+    :param int pids: number of worker processes
+    """
+    with open(os.path.join(path, 'stat'), 'w') as f:
+        f.write('cpu  1 0 1 0 0 0 0 0 0 0\nbtime {}\n'.format(int(time.time()) - 3600))
+    ancestors = [
+        (1, 0, '/sbin/init splash', 0),
+        (900, 1, '/usr/bin/containerd-shim-runc-v2 -namespace moby -id 1a2b3c4d5e6f', 0),
+        (1000, 900, '/usr/bin/python3 /usr/bin/supervisord -c /etc/supervisord.conf', 0),
+    ]
+    workers = [
+        (LEAF_PID_START + i, 1000, '/usr/bin/python3 -m service.worker --config /etc/service/worker.yaml', os.getuid())
+        for i in range(pids)
+    ]
+    for pid, ppid, cmdline, uid in ancestors + workers:
+        proc_dir = os.path.join(path, str(pid))
+        os.mkdir(proc_dir)
+        with open(os.path.join(proc_dir, 'stat'), 'w') as f:
+            # pid (comm) state ppid ..., with start time in clock ticks as 22nd field
+            f.write('{} ({}) S {} {} {}\n'.format(pid, cmdline.split()[0][-15:], ppid, '0 ' * 17, '1000 ' + '0 ' * 31))
+        with open(os.path.join(proc_dir, 'cmdline'), 'wb') as f:
+            f.write(cmdline.replace(' ', '\0').encode() + b'\0')
+        with open(os.path.join(proc_dir, 'status'), 'w') as f:
+            f.write('Name:\t{}\nUid:\t{uid}\t{uid}\t{uid}\t{uid}\n'.format(cmdline.split()[0], uid=uid))
+
+
+def max_rss_mb(who: int = resource.RUSAGE_SELF) -> float:
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def produce(
+    probe: BPFProbe,
+    events: Iterator[tuple],
+    rate: float,
+    submit_times: RawArray,
+    results: RawArray,
+):
+    """ Probe process body: feed synthetic events to the probe, as the BPF buffer polling would
+
+    :param BPFProbe probe: probe instance
+    :param Iterator[tuple] events: synthetic events with sequence numbers
+    :param float rate: target events per second, 0 for as fast as possible
+    :param RawArray submit_times: where to record submission times of sequenced events
+    :param RawArray results: where to store kernel event count, elapsed time and peak memory usage
+    """
+    probe.bpf = FakeBPF()
+    probe.metrics.activate()
+    for func, args in probe.SIDECARS:
+        if func in (probe._enrichment_worker, probe.output_queue.flush_worker):
+            Thread(target=func, args=args, daemon=True).start()
+    count = 0
+    start = time.monotonic()
+    for event, sequence in events:
+        if rate:
+            ahead = start + count / rate - time.monotonic()
+            if ahead > 0.001:
+                time.sleep(ahead)
+        if sequence is not None:
+            submit_times[sequence] = time.monotonic()
+        probe._process_events(None, event, None)
+        count += 1
+    while any(queue.qsize() for queue in probe.enrichment_queues):
+        time.sleep(0.001)
+    elapsed = time.monotonic() - start
+    time.sleep(0.01)  # let enrichment workers finish the event at hand
+    probe.output_queue.flush()
+    results[0], results[1], results[2] = count, elapsed, max_rss_mb()
+
+
+async def consume(
+    transport: EventTransport,
+    producer: Process,
+    expected: int,
+    sink_path: str,
+    poll_interval: float,
+    timeout: float,
+) -> List[tuple]:
+    """ Main process loop: write out events as they come, through the same output loop of pidtree-bcc
+
+    :param EventTransport transport: event transport
+    :param Process producer: probe process
+    :param int expected: number of output events expected
+    :param str sink_path: where to write events to
+    :param float poll_interval: seconds between safety-net checks of the transport
+    :param float timeout: maximum seconds to wait for events once the producer exited
+    :return: list of (write time, batch of events)
+    """
+    batches = []
+    received = 0
+    done = asyncio.Event()
+    with open(sink_path, 'w') as sink:
+
+        def write_batch(batch: list):
+            nonlocal received
+            sink.write('\n'.join(batch) + '\n')
+            sink.flush()
+            batches.append((time.monotonic(), batch))
+            received += len(batch)
+            if received >= expected:
+                done.set()
+
+        output_task = asyncio.ensure_future(forward_events([transport], write_batch, poll_interval))
+        try:
+            while not done.is_set() and producer.is_alive():
+                await asyncio.sleep(0.1)
+            try:
+                await asyncio.wait_for(done.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        finally:
+            output_task.cancel()
+            await asyncio.gather(output_task, return_exceptions=True)
+    return batches
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else float('nan')
+
+
+def run_scenario(name: str, args: argparse.Namespace) -> dict:
+    scenario = SCENARIOS[name]
+    transport = (
+        SharedMemoryRingTransport(args.shm_ring_size)
+        if args.transport == 'shm'
+        else BatchingQueueTransport(args.max_batch, args.flush_interval)
+    )
+    BPFProbe.JSON_ENCODER = args.json_encoder
+    probe = scenario.probe_class(
+        transport,
+        {'enrichment_workers': args.enrichment_workers, 'proctree_interning': args.proctree_interning},
+    )
+    submit_times = RawArray('d', args.events)
+    results = RawArray('d', 3)
+    producer = Process(
+        target=produce,
+        args=(probe, scenario.generate(args.events, args.pids), args.rate, submit_times, results),
+    )
+    producer.start()
+    batches = asyncio.run(consume(transport, producer, args.events, args.sink, args.flush_interval, timeout=5))
+    producer.join()
+    transport.close()
+    latencies = []
+    outputs = 0
+    last_write = 0
+    for written_at, batch in batches:
+        for serialized in batch:
+            event = json.loads(serialized)
+            if 'proctree' not in event and 'proctree_ids' not in event:
+                continue  # not an event, e.g. process record
+            outputs += 1
+            last_write = written_at
+            latencies.append(written_at - submit_times[scenario.sequence_of(event)])
+    latencies.sort()
+    kernel_events, producer_elapsed, producer_rss = results
+    first_submit = submit_times[0]
+    return {
+        'kernel_events': int(kernel_events),
+        'kernel_events_per_sec': kernel_events / producer_elapsed if producer_elapsed else 0,
+        'output_events': outputs,
+        'output_events_per_sec': outputs / (last_write - first_submit) if last_write > first_submit else 0,
+        'latency_p50_ms': percentile(latencies, 0.5) * 1000,
+        'latency_p99_ms': percentile(latencies, 0.99) * 1000,
+        'probe_max_rss_mb': producer_rss,
+        'writer_max_rss_mb': max_rss_mb(),
+    }
+
+
+def print_results(results: dict, baseline: dict = None):
+    columns = (
+        'kernel_events_per_sec', 'output_events_per_sec', 'latency_p50_ms',
+        'latency_p99_ms', 'probe_max_rss_mb', 'writer_max_rss_mb',
+    )
+    print('{:<12} {}'.format('probe', ' '.join('{:>22}'.format(column) for column in columns)))
+    for name, values in results.items():
+        cells = []
+        for column in columns:
+            cell = '{:.1f}'.format(values[column])
+            if baseline and name in baseline and baseline[name].get(column):
+                cell += ' ({:+.0f}%)'.format((values[column] / baseline[name][column] - 1) * 100)
+            cells.append('{:>22}'.format(cell))
+        print('{:<12} {}'.format(name, ' '.join(cells)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of the userland event path')
+    parser.add_argument('-n', '--events', type=int, default=50000, help='Number of output events per probe')
+    parser.add_argument('--rate', type=float, default=0, help='Kernel events per second, 0 for as fast as possible')
+    parser.add_argument('--probes', nargs='+', choices=tuple(SCENARIOS), default=tuple(SCENARIOS))
+    parser.add_argument('--pids', type=int, default=200, help='Number of distinct processes generating events')
+    parser.add_argument('--transport', choices=('queue', 'shm'), default='queue')
+    parser.add_argument('--shm-ring-size', type=int, default=SharedMemoryRingTransport.DEFAULT_CAPACITY)
+    parser.add_argument('--max-batch', type=int, default=BatchingQueueTransport.DEFAULT_MAX_BATCH)
+    parser.add_argument('--flush-interval', type=float, default=BatchingQueueTransport.DEFAULT_FLUSH_INTERVAL)
+    parser.add_argument('--json-encoder', default='json')
+    parser.add_argument('--enrichment-workers', type=int, default=0)
+    parser.add_argument('--proctree-interning', action='store_true', default=False)
+    parser.add_argument('--sink', default=os.devnull, help='File events are written to')
+    parser.add_argument('--save', metavar='FILE', help='Save results as JSON, for later comparison')
+    parser.add_argument('--compare', metavar='FILE', help='Show changes relative to previously saved results')
+    args = parser.parse_args()
+    set_start_method('fork')  # probe instances are inherited by the probe process, as in pidtree-bcc
+    procfs = tempfile.mkdtemp(prefix='pidtree-bcc-benchmark-proc-')
+    try:
+        build_fake_procfs(procfs, args.pids)
+        psutil.PROCFS_PATH = procfs
+        results = {name: run_scenario(name, args) for name in args.probes}
+    finally:
+        shutil.rmtree(procfs)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    print_results(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+""" Microbenchmark for userland network filtering.
+
+Compares a linear scan of all the filters, as `NetFilter.is_filtered` used to do,
+with the current mask-indexed implementation, for increasing numbers of filters.
+
+Usage: python -m benchmarks.filtering_benchmark [-n ITERATIONS]
+"""
+import argparse
+import ipaddress
+import random
+import timeit
+
+from pidtree_bcc.filtering import NetFilter
+from pidtree_bcc.utils import ip_to_int
+
+
+FILTER_COUNTS = (10, 100, 1000, 10000)
+PREFIX_LENGTHS = (8, 12, 16, 20, 24, 28, 32)
+
+
+def random_filters(count: int, rng: random.Random) -> list:
+    """ Generate network filters with a mix of prefix lengths and port restrictions """
+    filters = []
+    for _ in range(count):
+        network = ipaddress.IPv4Network((rng.getrandbits(32), rng.choice(PREFIX_LENGTHS)), strict=False)
+        f = {'network': str(network.network_address), 'network_mask': str(network.netmask)}
+        if rng.random() < 0.2:
+            f['except_ports'] = [rng.randint(1, 1024)]
+        filters.append(f)
+    return filters
+
+
+def linear_is_filtered(net_filter: NetFilter, ip_address: str, port: int) -> bool:
+    """ Filtering as done before filters were indexed by mask (any matching filter decided) """
+    ip_address = ip_to_int(ip_address)
+    for f in net_filter.filters:
+        if (
+            ip_address & f.netmask == f.subnet
+            and port not in f.except_ports
+            and (not f.include_ports or port in f.include_ports)
+        ):
+            return True
+    return False
+
+
+def run(iterations: int):
+    rng = random.Random(0)
+    for count in FILTER_COUNTS:
+        filters = random_filters(count, rng)
+        net_filter = NetFilter(filters)
+        # half the queries hit a filter, half are random addresses
+        queries = [
+            (
+                rng.choice(filters)['network'] if i % 2 else str(ipaddress.IPv4Address(rng.getrandbits(32))),
+                rng.randint(1, 1024),
+            )
+            for i in range(1000)
+        ]
+        print('----- {} filters -----'.format(count))
+        for name, func in (
+            ('linear', lambda: [linear_is_filtered(net_filter, ip, port) for ip, port in queries]),
+            ('indexed', lambda: [net_filter.is_filtered(ip, port) for ip, port in queries]),
+        ):
+            elapsed = timeit.timeit(func, number=iterations)
+            print('{:>12}: {:.2f} us/lookup'.format(name, elapsed / iterations / len(queries) * 10 ** 6))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Network filtering microbenchmark')
+    parser.add_argument('-n', '--iterations', type=int, default=10, help='Number of runs over 1000 lookups')
+    run(parser.parse_args().iterations)
@@ -0,0 +1,98 @@
+""" Microbenchmark for loading filters into BPF maps.
+
+Compares per-element map updates with batched ones, for the global port filters of
+a probe (e.g. `excludeports: ['1-65535']`) both on first load and on hot-swap reload.
+To run without root nor bcc, maps are emulated in memory: each operation that would be
+a bpf() system call on a real map goes through the same ctypes calls as bcc does, and
+issues a cheap system call instead. Absolute figures are therefore lower bounds, but
+the number of system calls is accurate.
+
+Usage: python -m benchmarks.map_update_benchmark [-n ITERATIONS]
+"""
+import argparse
+import ctypes
+import timeit
+
+from pidtree_bcc.filtering import load_port_filters_into_map
+from pidtree_bcc.filtering import PortFilterMode
+
+
+LIBC = ctypes.CDLL(None, use_errno=True)
+
+
+class EmulatedArrayTable:
+    """ In-memory BPF array map, with bcc's table interface """
+
+    Key = ctypes.c_int
+    Leaf = ctypes.c_uint8
+
+    def __init__(self, size: int = 65536):
+        self.values = [0] * size
+        self.syscalls = 0
+
+    def _syscall(self, *args: ctypes.c_void_p):
+        self.syscalls += 1
+        if LIBC.getppid(*args) < 0:
+            raise OSError(ctypes.get_errno())
+
+    def __setitem__(self, key: ctypes.c_int, leaf: ctypes.c_uint8):
+        self._syscall(
+            ctypes.cast(ctypes.byref(key), ctypes.c_void_p),
+            ctypes.cast(ctypes.byref(leaf), ctypes.c_void_p),
+        )
+        self.values[key.value] = leaf.value
+
+    def items(self):
+        for i in range(len(self.values)):
+            self._syscall()  # get next key
+            self._syscall()  # lookup
+            yield ctypes.c_int(i), ctypes.c_uint8(self.values[i])
+
+
+class EmulatedBatchArrayTable(EmulatedArrayTable):
+    """ In-memory BPF array map, also supporting batch operations """
+
+    BATCH_SIZE = 4096  # entries returned by each batch lookup system call
+
+    def items_update_batch(self, keys: ctypes.Array, leaves: ctypes.Array):
+        self._syscall(
+            ctypes.cast(ctypes.byref(keys), ctypes.c_void_p),
+            ctypes.cast(ctypes.byref(leaves), ctypes.c_void_p),
+        )
+        for key, leaf in zip(keys, leaves):
+            self.values[key] = leaf
+
+    def items_lookup_batch(self):
+        for i in range(len(self.values)):
+            if i % self.BATCH_SIZE == 0:
+                self._syscall()
+            yield ctypes.c_int(i), ctypes.c_uint8(self.values[i])
+
+
+def run(iterations: int):
+    for name, table_type in (('single', EmulatedArrayTable), ('batch', EmulatedBatchArrayTable)):
+        table = table_type()
+        load_time = timeit.timeit(
+            lambda: load_port_filters_into_map(['1-65535'], PortFilterMode.exclude, table),
+            number=iterations,
+        )
+        load_syscalls = table.syscalls // iterations
+        table.syscalls = 0
+        reload_time = timeit.timeit(
+            lambda: load_port_filters_into_map(['1-65535'], PortFilterMode.exclude, table, do_diff=True),
+            number=iterations,
+        )
+        reload_syscalls = table.syscalls // iterations
+        print('{:>8}: load {:.1f} ms ({} syscalls), reload {:.1f} ms ({} syscalls)'.format(
+            name,
+            load_time / iterations * 1000,
+            load_syscalls,
+            reload_time / iterations * 1000,
+            reload_syscalls,
+        ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='BPF map loading microbenchmark')
+    parser.add_argument('-n', '--iterations', type=int, default=5, help='Number of loads per run')
+    run(parser.parse_args().iterations)
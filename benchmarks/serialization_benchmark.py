@@ -0,0 +1,79 @@
+""" Microbenchmark for event serialization.
+
+Compares the plain `json.dumps` + `datetime.utcnow()` approach with `EventSerializer`,
+for each available JSON encoder, on representative events of the built-in probes.
+
+Usage: python -m benchmarks.serialization_benchmark [-n ITERATIONS]
+"""
+import argparse
+import json
+import timeit
+from datetime import datetime
+
+from pidtree_bcc.serialization import EventSerializer
+from pidtree_bcc.serialization import JSON_ENCODERS
+
+
+PROCTREE = [
+    {'pid': 4321, 'cmdline': '/usr/bin/python3 -m service.worker --config /etc/service/worker.yaml', 'username': 'svc'},
+    {'pid': 4000, 'cmdline': '/usr/bin/python3 /usr/bin/supervisord -c /etc/supervisord.conf', 'username': 'root'},
+    {'pid': 3900, 'cmdline': '/usr/bin/containerd-shim-runc-v2 -namespace moby -id 1a2b3c4d', 'username': 'root'},
+    {'pid': 1, 'cmdline': '/sbin/init splash', 'username': 'root'},
+]
+
+EVENTS = {
+    'tcp_connect': {
+        'pid': 4321,
+        'proctree': PROCTREE,
+        'daddr': '10.1.2.3',
+        'saddr': '10.4.5.6',
+        'port': 443,
+        'error': '',
+    },
+    'udp_session': {
+        'pid': 4321,
+        'proctree': PROCTREE,
+        'destinations': [
+            {'daddr': '10.0.0.2', 'port': 53, 'duration': 0.0123, 'msg_count': 4},
+            {'daddr': '127.0.0.1', 'port': 8125, 'duration': 12.3456, 'msg_count': 2048},
+        ],
+        'error': '',
+    },
+    'net_listen': {
+        'pid': 4321,
+        'port': 8080,
+        'proctree': PROCTREE,
+        'laddr': '0.0.0.0',
+        'protocol': 'tcp',
+        'error': '',
+    },
+}
+
+
+def baseline(probe_name: str, event: dict) -> str:
+    """ Serialization as done before `EventSerializer` was introduced """
+    event = event.copy()
+    event['timestamp'] = datetime.utcnow().isoformat() + 'Z'
+    event['probe'] = probe_name
+    return json.dumps(event)
+
+
+def run(iterations: int):
+    for probe_name, event in EVENTS.items():
+        print('----- {} -----'.format(probe_name))
+        elapsed = timeit.timeit(lambda: baseline(probe_name, event), number=iterations)
+        print('{:>12}: {:.2f} us/event'.format('baseline', elapsed / iterations * 10 ** 6))
+        for encoder in JSON_ENCODERS:
+            try:
+                serializer = EventSerializer(probe_name, encoder)
+            except RuntimeError:
+                print('{:>12}: not installed'.format(encoder))
+                continue
+            elapsed = timeit.timeit(lambda: serializer.serialize_with_metadata(event), number=iterations)
+            print('{:>12}: {:.2f} us/event'.format(encoder, elapsed / iterations * 10 ** 6))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Event serialization microbenchmark')
+    parser.add_argument('-n', '--iterations', type=int, default=100000, help='Number of events serialized per run')
+    run(parser.parse_args().iterations)
@@ -0,0 +1,425 @@
+""" Userland reference model of the filters applied in kernel by the network probes.
+
+Evaluates destination address-port pairs against the content of the filter maps,
+exactly as `is_addr_port_filtered` and `is_port_globally_filtered` in `utils.j2` do,
+so that the event volume produced by a filter configuration can be estimated offline
+from recorded traffic (CSV or pcap) before rolling it out.
+
+Usage: python -m pidtree_bcc.filter_simulator -c CONFIG -p PROBE (--csv FILE | --pcap FILE)
+"""
+import argparse
+import csv
+import json
+import socket
+import struct
+import sys
+from collections import Counter
+from typing import Any
+from typing import BinaryIO
+from typing import Callable
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import TextIO
+from typing import Tuple
+from typing import Union
+
+from pidtree_bcc.config import enumerate_probe_configs
+from pidtree_bcc.config import setup_config
+from pidtree_bcc.filtering import load_filters_into_map
+from pidtree_bcc.filtering import load_port_bitmap_into_map
+from pidtree_bcc.filtering import load_port_filters_into_map
+from pidtree_bcc.filtering import NET_FILTER_MAX_PORT_RANGES
+from pidtree_bcc.filtering import PortFilterMode
+from pidtree_bcc.utils import ip_to_int
+from pidtree_bcc.utils import ipv6_to_bytes
+from pidtree_bcc.utils import is_ipv6
+from pidtree_bcc.yaml_loader import FileIncludeLoader
+
+
+# outcomes, named after the corresponding kernel filter counters
+FILTERED_NET = 'filtered_net'
+FILTERED_PORT = 'filtered_port'
+SUBMITTED = 'submitted'
+
+# destination addresses are either in `ip_to_int` encoding (IPv4) or packed (IPv6)
+Address = Union[int, bytes]
+IPV4_MAPPED_PREFIX = b'\x00' * 10 + b'\xff' * 2
+
+
+def _prefix_bitmask(prefixlen: int) -> int:
+    """ Bitmask selecting the first `prefixlen` bits of an address in `ip_to_int` encoding """
+    return struct.unpack('=L', ((0xFFFFFFFF << (32 - prefixlen)) & 0xFFFFFFFF).to_bytes(4, 'big'))[0]
+
+
+def _ipv6_prefix_bitmask(prefixlen: int) -> int:
+    """ Bitmask selecting the first `prefixlen` bits of an IPv6 address as big-endian integer """
+    return ((1 << 128) - 1) ^ ((1 << (128 - prefixlen)) - 1)
+
+
+def _map_value(value: Any) -> int:
+    """ Unwrap ctypes scalars, as used for keys and values by `load_port_filters_into_map` """
+    return getattr(value, 'value', value)
+
+
+def _bitmap_to_ranges(bitmap: Any) -> tuple:
+    """ Convert port bitmap to port ranges, with inclusive bounds """
+    ranges = []
+    for port in range(65536):
+        if bitmap.bits[port >> 6] >> (port & 63) & 1:
+            if ranges and ranges[-1][1] == port - 1:
+                ranges[-1][1] = port
+            else:
+                ranges.append([port, port])
+    return tuple(map(tuple, ranges))
+
+
+class ArrayMapStandIn(dict):
+    """ Dictionary standing in for a BPF array map, keyed by the value of ctypes integers """
+
+    def __setitem__(self, key: Any, value: Any):
+        super().__setitem__(_map_value(key), _map_value(value))
+
+    def __getitem__(self, key: Any) -> int:
+        return super().__getitem__(_map_value(key))
+
+    def __delitem__(self, key: Any):
+        super().__delitem__(_map_value(key))
+
+
+class FilterSimulator:
+    """ Evaluates the kernel filter programs against the content of their maps.
+
+    The network filter map is a longest prefix match trie, so for each address only the
+    filter with the longest matching prefix is considered, and its port ranges decide
+    the outcome. IPv6 addresses are looked up in a trie of their own, except for
+    IPv4-mapped ones, which are looked up in the IPv4 trie. The global port filter map
+    is an array indexed by port, with the filtering mode stored at index 0.
+    """
+
+    def __init__(self, net_filter_map: Any, port_filter_map: Any, bitmap_map: Any = None, ipv6_map: Any = None):
+        """ Constructor
+
+        :param Any net_filter_map: network filters, mapping `CFilterKey` to `CFilterValue`,
+                                   e.g. a dictionary loaded with `load_filters_into_map`
+        :param Any port_filter_map: global port filters, mapping port to flag,
+                                    e.g. an `ArrayMapStandIn` loaded with `load_port_filters_into_map`
+        :param Any bitmap_map: port bitmaps of network filters with many port ranges, if any
+        :param Any ipv6_map: IPv6 network filters, mapping `CFilterKeyV6` to `CFilterValue`,
+                             None if the probe does not capture IPv6 traffic
+        """
+        bitmaps = {int(_map_value(k)): v for k, v in bitmap_map.items()} if bitmap_map else {}
+        self._trie_levels = self._build_trie_levels(net_filter_map, bitmaps, _prefix_bitmask, lambda data: data)
+        self._ipv6_trie_levels = (
+            self._build_trie_levels(
+                ipv6_map, bitmaps, _ipv6_prefix_bitmask, lambda data: int.from_bytes(bytes(data), 'big'),
+            )
+            if ipv6_map is not None
+            else None
+        )
+        port_entries = list(port_filter_map.items())
+        if port_entries and hasattr(port_entries[0][1], 'bits'):
+            # single bitmap value (`port_filter_bitmap` probe option)
+            bitmap = port_entries[0][1]
+            self._port_mode = bitmap.mode
+            self._flagged_ports = frozenset(
+                port for port in range(65536)
+                if bitmap.bits[port >> 6] >> (port & 63) & 1
+            )
+        else:
+            port_flags = {int(_map_value(k)): _map_value(v) for k, v in port_entries}
+            # the slot of port 0 holds the mode, so it counts as flagged when a mode is set
+            self._port_mode = port_flags.get(0, 0)
+            self._flagged_ports = frozenset(port for port, flag in port_flags.items() if flag)
+
+    @staticmethod
+    def _build_trie_levels(
+        net_filter_map: Any,
+        bitmaps: dict,
+        prefix_bitmask: Callable[[int], int],
+        key_data: Callable[[Any], int],
+    ) -> List[Tuple[int, dict]]:
+        """ Index the content of a network filter map by prefix length
+
+        :param Any net_filter_map: network filters
+        :param dict bitmaps: port bitmaps by index
+        :param Callable[[int], int] prefix_bitmask: bitmask for a prefix length
+        :param Callable[[Any], int] key_data: integer form of the network in a map key
+        :return: list of (bitmask, {masked address: (mode, ranges)}), longest prefixes first
+        """
+        tries = {}
+        for key, value in net_filter_map.items():
+            if value.bitmap_index > 0:
+                ranges = _bitmap_to_ranges(bitmaps[value.bitmap_index - 1])
+            else:
+                ranges = tuple(
+                    (port_range.lower, port_range.upper)
+                    for port_range in value.ranges[:min(value.range_size, NET_FILTER_MAX_PORT_RANGES)]
+                )
+            tries.setdefault(key.prefixlen, {})[key_data(key.data)] = (value.mode, ranges)
+        return [(prefix_bitmask(prefixlen), tries[prefixlen]) for prefixlen in sorted(tries, reverse=True)]
+
+    @classmethod
+    def from_config(
+        cls,
+        filters: List[dict],
+        includeports: Iterable[Union[int, str]] = (),
+        excludeports: Iterable[Union[int, str]] = (),
+        port_bitmap: bool = False,
+        ipv6: bool = False,
+    ) -> 'FilterSimulator':
+        """ Build simulator from probe configuration, loading maps the same way probes do
+
+        :param List[dict] filters: network filters (see `load_filters_into_map`)
+        :param Iterable[Union[int, str]] includeports: ports for which events are submitted
+        :param Iterable[Union[int, str]] excludeports: ports for which events are filtered out
+        :param bool port_bitmap: global port filters are stored as a bitmap
+        :param bool ipv6: the probe captures IPv6 traffic, and loads IPv6 filters
+        :return: simulator instance
+        """
+        net_filter_map, port_filter_map, bitmap_map = {}, ArrayMapStandIn(), ArrayMapStandIn()
+        ipv6_map = {} if ipv6 else None
+        load_filters_into_map(filters, net_filter_map, bitmap_map=bitmap_map, ipv6_map=ipv6_map)
+        includeports = list(includeports)
+        global_filters = (
+            (includeports, PortFilterMode.include)
+            if includeports
+            else (list(excludeports), PortFilterMode.exclude)
+        )
+        if port_bitmap:
+            load_port_bitmap_into_map(*global_filters, port_filter_map)
+        else:
+            load_port_filters_into_map(*global_filters, port_filter_map)
+        return cls(net_filter_map, port_filter_map, bitmap_map, ipv6_map)
+
+    def lookup(self, address: Address) -> Optional[Tuple[int, tuple]]:
+        """ Longest prefix match of an address in the network filter maps
+
+        :param Address address: IPv4 address in `ip_to_int` encoding, or packed IPv6 address
+        :return: filter mode and port ranges, None if no filter matches
+        """
+        if isinstance(address, bytes):
+            if self._ipv6_trie_levels is None:
+                raise ValueError('IPv6 destination found, but the probe is not configured to capture IPv6 traffic')
+            if address.startswith(IPV4_MAPPED_PREFIX):
+                address, = struct.unpack('=L', address[12:])
+                trie_levels = self._trie_levels
+            else:
+                address = int.from_bytes(address, 'big')
+                trie_levels = self._ipv6_trie_levels
+        else:
+            trie_levels = self._trie_levels
+        for bitmask, level in trie_levels:
+            value = level.get(address & bitmask)
+            if value is not None:
+                return value
+        return None
+
+    def is_addr_port_filtered(self, address: Address, port: int) -> bool:
+        """ Model of `is_addr_port_filtered` (and `is_addr6_port_filtered`) in `utils.j2`
+
+        :param Address address: IPv4 address in `ip_to_int` encoding, or packed IPv6 address
+        :param int port: port in host byte order
+        :return: True if filtered
+        """
+        value = self.lookup(address)
+        return value is not None and self._is_filter_matching(value, port)
+
+    def is_port_globally_filtered(self, port: int) -> bool:
+        """ Model of `is_port_globally_filtered` in `utils.j2`
+
+        :param int port: port in host byte order
+        :return: True if filtered
+        """
+        flagged = port in self._flagged_ports
+        return (
+            (self._port_mode == PortFilterMode.exclude and flagged)
+            or (self._port_mode == PortFilterMode.include and not flagged)
+        )
+
+    def classify(self, address: Address, port: int) -> str:
+        """ Outcome of the kernel filters for a destination, in the order probes check them
+
+        :param Address address: IPv4 address in `ip_to_int` encoding, or packed IPv6 address
+        :param int port: port in host byte order
+        :return: one of FILTERED_NET, FILTERED_PORT or SUBMITTED
+        """
+        if self.is_addr_port_filtered(address, port):
+            return FILTERED_NET
+        if self.is_port_globally_filtered(port):
+            return FILTERED_PORT
+        return SUBMITTED
+
+    def count(self, destinations: Iterable[Tuple[Address, int]]) -> Counter:
+        """ Classify a stream of destinations in bulk.
+
+        Trie lookups are done once per distinct address, and port checks once per
+        distinct filter-port pair, which keeps the cost per destination low on real
+        traffic where both repeat a lot.
+
+        :param Iterable[Tuple[Address, int]] destinations: address (see `lookup`) and port pairs
+        :return: number of destinations for each outcome
+        """
+        address_cache = {}
+        outcome_cache = {}
+        counts = Counter({FILTERED_NET: 0, FILTERED_PORT: 0, SUBMITTED: 0})
+        for address, port in destinations:
+            try:
+                value = address_cache[address]
+            except KeyError:
+                value = address_cache[address] = self.lookup(address)
+            try:
+                outcome = outcome_cache[value, port]
+            except KeyError:
+                if value is not None and self._is_filter_matching(value, port):
+                    outcome = FILTERED_NET
+                elif self.is_port_globally_filtered(port):
+                    outcome = FILTERED_PORT
+                else:
+                    outcome = SUBMITTED
+                outcome_cache[value, port] = outcome
+            counts[outcome] += 1
+        return counts
+
+    @staticmethod
+    def _is_filter_matching(value: Tuple[int, tuple], port: int) -> bool:
+        mode, ranges = value
+        if mode == PortFilterMode.all:
+            return True
+        for lower, upper in ranges:
+            if lower <= port <= upper:
+                return mode == PortFilterMode.include
+        return mode == PortFilterMode.exclude
+
+
+def read_csv(input_fh: TextIO) -> Iterator[Tuple[Address, int]]:
+    """ Read destinations from CSV with `daddr` and `port` columns
+
+    :param TextIO input_fh: text input stream
+    :return: iterator of address (see `FilterSimulator.lookup`) and port pairs
+    """
+    for row in csv.DictReader(input_fh):
+        daddr = row['daddr']
+        yield (ipv6_to_bytes(daddr) if is_ipv6(daddr) else ip_to_int(daddr)), int(row['port'])
+
+
+# link layer header sizes of the supported pcap link types
+PCAP_LINK_HEADERS = {
+    1: 14,  # Ethernet
+    12: 0,  # raw IP
+    101: 0,  # raw IP
+    113: 16,  # Linux cooked capture
+}
+PCAP_MAGIC = {
+    0xa1b2c3d4: '<',
+    0xd4c3b2a1: '>',
+    0xa1b23c4d: '<',  # nanosecond timestamps
+    0x4d3cb2a1: '>',
+}
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86DD
+ETHERTYPE_VLAN = (0x8100, 0x88a8)
+TCP_SYN_ACK_MASK = 0x12
+TCP_SYN = 0x02
+
+
+def read_pcap(input_fh: BinaryIO, ipv6: bool = False) -> Iterator[Tuple[Address, int]]:
+    """ Read destinations of TCP connection attempts (SYN) and UDP datagrams from a pcap capture.
+    IPv6 packets with extension headers before the transport header are skipped.
+
+    :param BinaryIO input_fh: binary input stream in classic libpcap format
+    :param bool ipv6: also read IPv6 packets, otherwise only IPv4 ones
+    :return: iterator of address (see `FilterSimulator.lookup`) and port pairs
+    """
+    ip_versions = (4, 6) if ipv6 else (4,)
+    header = input_fh.read(24)
+    magic, = struct.unpack('<I', header[:4]) if len(header) == 24 else (None,)
+    if magic not in PCAP_MAGIC:
+        raise ValueError('Unsupported capture format (pcapng captures must be converted to pcap)')
+    endianness = PCAP_MAGIC[magic]
+    linktype, = struct.unpack(endianness + 'I', header[20:24])
+    if linktype not in PCAP_LINK_HEADERS:
+        raise ValueError('Unsupported capture link type: {}'.format(linktype))
+    link_header_size = PCAP_LINK_HEADERS[linktype]
+    record_header = struct.Struct(endianness + 'IIII')
+    while True:
+        record = input_fh.read(record_header.size)
+        if len(record) < record_header.size:
+            break
+        _, _, captured_size, _ = record_header.unpack(record)
+        packet = input_fh.read(captured_size)
+        ip_offset = link_header_size
+        if link_header_size:
+            if len(packet) < link_header_size:
+                continue
+            ethertype, = struct.unpack_from('!H', packet, link_header_size - 2)
+            while ethertype in ETHERTYPE_VLAN and len(packet) >= ip_offset + 4:
+                ethertype, = struct.unpack_from('!H', packet, ip_offset + 2)
+                ip_offset += 4
+            if ethertype not in (ETHERTYPE_IPV4, ETHERTYPE_IPV6):
+                continue
+        ip_version = packet[ip_offset] >> 4 if len(packet) > ip_offset else None
+        if ip_version not in ip_versions:
+            continue
+        if ip_version == 4:
+            if len(packet) < ip_offset + 20:
+                continue
+            transport_offset = ip_offset + (packet[ip_offset] & 0x0F) * 4
+            protocol = packet[ip_offset + 9]
+        else:
+            if len(packet) < ip_offset + 40:
+                continue
+            transport_offset = ip_offset + 40
+            protocol = packet[ip_offset + 6]
+        if len(packet) < transport_offset + 4 or protocol not in (socket.IPPROTO_TCP, socket.IPPROTO_UDP):
+            continue
+        if protocol == socket.IPPROTO_TCP and (
+            len(packet) < transport_offset + 14
+            or packet[transport_offset + 13] & TCP_SYN_ACK_MASK != TCP_SYN
+        ):
+            continue
+        if ip_version == 4:
+            address, = struct.unpack_from('=L', packet, ip_offset + 16)
+        else:
+            address = packet[ip_offset + 24:ip_offset + 40]
+        port, = struct.unpack_from('!H', packet, transport_offset + 2)
+        yield address, port
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Estimate which events the kernel filters of a probe let through')
+    parser.add_argument('-c', '--config', type=str, required=True, help='YAML file containing probe configurations')
+    parser.add_argument('-p', '--probe', type=str, required=True, help='Name of the probe whose filters are used')
+    input_group = parser.add_mutually_exclusive_group(required=True)
+    input_group.add_argument('--csv', type=str, help='CSV file of destinations, with "daddr" and "port" columns')
+    input_group.add_argument('--pcap', type=str, help='Network capture in pcap format')
+    args = parser.parse_args()
+    setup_config(args.config)
+    FileIncludeLoader.cleanup()
+    probe_configs = {probe_name: probe_config for probe_name, probe_config, _ in enumerate_probe_configs()}
+    if args.probe not in probe_configs:
+        sys.exit('Probe {} not found in configuration'.format(args.probe))
+    probe_config = probe_configs[args.probe]
+    simulator = FilterSimulator.from_config(
+        probe_config.get('filters', []),
+        probe_config.get('includeports', []),
+        probe_config.get('excludeports', []),
+        probe_config.get('port_filter_bitmap', False),
+        probe_config.get('ipv6', False),
+    )
+    try:
+        if args.csv:
+            with open(args.csv) as input_fh:
+                counts = simulator.count(read_csv(input_fh))
+        else:
+            # IPv6 packets in the capture are not seen by probes which do not capture IPv6 traffic
+            with open(args.pcap, 'rb') as input_fh:
+                counts = simulator.count(read_pcap(input_fh, probe_config.get('ipv6', False)))
+    except ValueError as e:
+        sys.exit(str(e))
+    print(json.dumps({'total': sum(counts.values()), **counts}))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,22 @@
 import ctypes
 import enum
+import ipaddress
+import logging
 from collections import namedtuple
 from itertools import chain
 from typing import Any
 from typing import Iterable
 from typing import List
+from typing import Sequence
 from typing import Set
+from typing import Tuple
 from typing import Union
 
 from pidtree_bcc.ctypes_helper import ComparableCtStructure
 from pidtree_bcc.ctypes_helper import create_comparable_array_type
 from pidtree_bcc.utils import ip_to_int
+from pidtree_bcc.utils import ipv6_to_bytes
+from pidtree_bcc.utils import is_ipv6
 from pidtree_bcc.utils import netmask_to_prefixlen
 
 
@@ -19,43 +25,95 @@ IpPortFilter = namedtuple('IpPortFilter', ('subnet', 'netmask', 'except_ports',
 
 
 class NetFilter:
+    """ Userland counterpart of the network filters loaded in kernel.
+
+    Like the kernel LPM trie, only the filter with the longest prefix matching an
+    address decides whether it is filtered, and a later filter for the same network
+    replaces an earlier one. Filters are indexed by network mask and then by network,
+    so that checking an address costs one dictionary lookup per distinct mask (at most
+    33 for well-formed masks), longest prefixes first, rather than a scan of all the filters.
+    IPv6 filters have an index of their own, and IPv4-mapped IPv6 addresses
+    are checked against IPv4 filters, as done in kernel.
+    """
 
     def __init__(self, filters: List[dict]):
         """ Constructor
 
         :param List[dict] filters: list of IP-ports filters. Format:
                                    {
-                                       'network': '127.0.0.1',
-                                       'network_mask': '255.0.0.0',
+                                       'network': '127.0.0.1',  # or IPv6, e.g. 'fd00::'
+                                       'network_mask': '255.0.0.0',  # or IPv6, e.g. 'ff00::'
                                        'except_ports': [123, 456], # optional
                                        'include_ports': [789],     # optional
                                    }
         """
         self.filters = [
-            IpPortFilter(
-                ip_to_int(f['network']) & ip_to_int(f['network_mask']),
-                ip_to_int(f['network_mask']),
-                set(map(int, f.get('except_ports', []))),
-                set(map(int, f.get('include_ports', []))),
-            ) for f in filters
+            self._parse_filter(f, ip_to_int(f['network']), ip_to_int(f['network_mask']))
+            for f in filters if not is_ipv6_filter(f)
+        ]
+        self.ipv6_filters = [
+            self._parse_filter(
+                f,
+                int(ipaddress.IPv6Address(f['network'])),
+                int(ipaddress.IPv6Address(f['network_mask'])),
+            )
+            for f in filters if is_ipv6_filter(f)
         ]
+        self._index = self._build_index(self.filters)
+        self._ipv6_index = self._build_index(self.ipv6_filters)
+
+    @staticmethod
+    def _parse_filter(entry: dict, network: int, netmask: int) -> IpPortFilter:
+        """ Parse filter, interpreting ports the same way as when loading it in kernel
+
+        :param dict entry: network filter
+        :param int network: integer encoded network address
+        :param int netmask: integer encoded network mask
+        :return: parsed filter
+        """
+        mode, port_ranges = filter_port_ranges(entry)
+        ports = set(chain.from_iterable(range(r.lower, r.upper + 1) for r in port_ranges))
+        return IpPortFilter(
+            network & netmask,
+            netmask,
+            ports if mode == PortFilterMode.exclude else set(),
+            ports if mode == PortFilterMode.include else set(),
+        )
 
-    def is_filtered(self, ip_address: Union[int, str], port: int) -> bool:
+    @staticmethod
+    def _build_index(filters: List[IpPortFilter]) -> List[Tuple[int, dict]]:
+        """ Index filters by network mask and network
+
+        :param List[IpPortFilter] filters: parsed filters
+        :return: list of (netmask, {subnet: filter}), longest prefixes first
+        """
+        index = {}
+        for f in filters:
+            index.setdefault(f.netmask, {})[f.subnet] = f
+        return sorted(index.items(), key=lambda item: bin(item[0]).count('1'), reverse=True)
+
+    def is_filtered(self, ip_address: Union[int, str, bytes], port: int) -> bool:
         """ Check if IP-port combination is filtered
 
-        :param Union[int, str] ip_address: IP address in integer or string form
+        :param Union[int, str, bytes] ip_address: IPv4 address in integer or string form,
+                                                  or IPv6 address in string or packed form
         :param int port: port in host byte order representation (i.e. pre htons / after ntohs)
         :return: True if filtered
         """
-        if isinstance(ip_address, str):
-            ip_address = ip_to_int(ip_address)
-        for f in self.filters:
-            if (
-                f.netmask & ip_address == f.subnet
-                and port not in f.except_ports
-                and (not f.include_ports or port in f.include_ports)
-            ):
-                return True
+        if isinstance(ip_address, int):
+            index = self._index
+        elif isinstance(ip_address, bytes) or is_ipv6(ip_address):
+            address = ipaddress.IPv6Address(ip_address)
+            if address.ipv4_mapped:
+                ip_address, index = ip_to_int(str(address.ipv4_mapped)), self._index
+            else:
+                ip_address, index = int(address), self._ipv6_index
+        else:
+            ip_address, index = ip_to_int(ip_address), self._index
+        for netmask, subnets in index:
+            f = subnets.get(ip_address & netmask)
+            if f is not None:
+                return port not in f.except_ports and (not f.include_ports or port in f.include_ports)
         return False
 
 
@@ -95,15 +153,100 @@ class CFilterKey(ComparableCtStructure):
         return cls(prefixlen=prefixlen, data=data & bitmask)
 
 
+class CFilterKeyV6(ComparableCtStructure):
+    data_array_t = create_comparable_array_type(16, ctypes.c_uint8)
+    _fields_ = [
+        ('prefixlen', ctypes.c_uint32),
+        ('data', data_array_t),  # network byte order
+    ]
+
+    @classmethod
+    def from_network_definition(cls, netmask: str, ip: str):
+        """ Normalize data according to prefix length to avoid equivalent keys
+        with different representations.
+
+        :param str netmask: IPv6 network mask
+        :param str ip: IPv6 network ip
+        """
+        data = bytes(a & b for a, b in zip(ipv6_to_bytes(ip), ipv6_to_bytes(netmask)))
+        return cls(prefixlen=netmask_to_prefixlen(netmask), data=cls.data_array_t(*data))
+
+    def __hash__(self) -> int:
+        # ctypes arrays are hashed by identity
+        return hash((self.prefixlen, bytes(self.data)))
+
+
 class CFilterValue(ComparableCtStructure):
     range_array_t = create_comparable_array_type(NET_FILTER_MAX_PORT_RANGES, CPortRange)
     _fields_ = [
         ('mode', ctypes.c_int),  # this is actually an enum, which are ints in C
         ('range_size', ctypes.c_uint8),
         ('ranges', range_array_t),
+        # 1-based index of a CFilterPortBitmap holding the ports, used instead of
+        # `ranges` when there are more than NET_FILTER_MAX_PORT_RANGES of them
+        ('bitmap_index', ctypes.c_uint32),
     ]
 
 
+class CPortBitmap(ComparableCtStructure):
+    """ Global port filters as a single bitmap value, see `port_filter_bitmap` in `net_filter_trie_init` """
+    bits_array_t = create_comparable_array_type(65536 // 64, ctypes.c_uint64)
+    _fields_ = [
+        ('mode', ctypes.c_uint32),
+        ('bits', bits_array_t),
+    ]
+
+    @classmethod
+    def from_port_filters(cls, filters: List[Union[int, str]], mode: 'PortFilterMode') -> 'CPortBitmap':
+        """ Build bitmap with one bit set for each filtered port
+
+        :param List[Union[int, str]] filters: list of ports or port ranges
+        :param PortFilterMode mode: include or exclude
+        :return: bitmap value
+        """
+        bitmap = cls(mode=mode.value)
+        # port 0 counts as flagged, like in the array representation where its slot holds the mode
+        for port in parse_port_filters(filters) | {0}:
+            bitmap.bits[port >> 6] |= 1 << (port & 63)
+        return bitmap
+
+    def is_set(self, port: int) -> bool:
+        """ Check if port is in the bitmap
+
+        :param int port: port number
+        :return: True if the port bit is set
+        """
+        return bool(self.bits[port >> 6] >> (port & 63) & 1)
+
+
+class CFilterPortBitmap(ComparableCtStructure):
+    """ Ports of a network filter with too many port ranges to be listed in `CFilterValue` """
+    _fields_ = [
+        ('bits', CPortBitmap.bits_array_t),
+    ]
+
+    @classmethod
+    def from_port_ranges(cls, port_ranges: Iterable[CPortRange]) -> 'CFilterPortBitmap':
+        """ Build bitmap with one bit set for each port in the ranges
+
+        :param Iterable[CPortRange] port_ranges: port ranges, with inclusive bounds
+        :return: bitmap value
+        """
+        bitmap = cls()
+        for port_range in port_ranges:
+            for port in range(port_range.lower, port_range.upper + 1):
+                bitmap.bits[port >> 6] |= 1 << (port & 63)
+        return bitmap
+
+    def is_set(self, port: int) -> bool:
+        """ Check if port is in the bitmap
+
+        :param int port: port number
+        :return: True if the port bit is set
+        """
+        return bool(self.bits[port >> 6] >> (port & 63) & 1)
+
+
 class PortFilterMode(enum.IntEnum):
     """ Reflects values used for `net_filter_mode` in utils.j2 """
     all = 0
@@ -116,53 +259,210 @@ def port_range_mapper(port_range: str) -> Iterable[int]:
     return range(max(1, from_p), min(65535, to_p + 1))
 
 
-def load_filters_into_map(filters: List[dict], ebpf_map: Any, do_diff: bool = False):
+def parse_port_filters(filters: Iterable[Union[int, str]]) -> Set[int]:
+    """ Expand list of ports and port ranges
+
+    :param Iterable[Union[int, str]] filters: list of ports or port ranges (e.g. "100-200")
+    :return: set of ports
+    """
+    return set(
+        chain.from_iterable(
+            port_range_mapper(port_or_range)
+            if isinstance(port_or_range, str) and '-' in port_or_range
+            else (int(port_or_range),)
+            for port_or_range in filters
+        ),
+    )
+
+
+def _to_ctypes_array(ctype: Any, values: Sequence[Any]) -> ctypes.Array:
+    """ Pack values into an array of the key or leaf type of an eBPF map
+
+    :param Any ctype: ctypes type of the array elements
+    :param Sequence[Any] values: ctypes values of compatible layout
+    :return: ctypes array
+    """
+    array_type = ctype * len(values)
+    if hasattr(values[0], 'value'):
+        # scalars, which arrays take as plain python values
+        return array_type(*(value.value for value in values))
+    return array_type(*(ctype.from_buffer_copy(value) for value in values))
+
+
+def read_map_items(ebpf_map: Any) -> List[Tuple[Any, Any]]:
+    """ Read all the entries of an eBPF map, with batch lookups if supported
+
+    :param Any ebpf_map: eBPF table
+    :return: list of key-value pairs
+    """
+    lookup_batch = getattr(type(ebpf_map), 'items_lookup_batch', None)
+    if lookup_batch:
+        try:
+            return list(lookup_batch(ebpf_map))
+        except Exception as e:
+            logging.debug('Batch lookup not supported for map, falling back to iteration: {}'.format(e))
+    return list(ebpf_map.items())
+
+
+def update_map(ebpf_map: Any, items: Sequence[Tuple[Any, Any]]):
+    """ Write entries to an eBPF map.
+
+    With a recent enough bcc (>= 0.21) and kernel (>= 5.6), all entries are written with a
+    single BPF_MAP_UPDATE_BATCH system call, rather than one system call per entry.
+
+    :param Any ebpf_map: eBPF table
+    :param Sequence[Tuple[Any, Any]] items: key-value pairs
+    """
+    if not items:
+        return
+    update_batch = getattr(type(ebpf_map), 'items_update_batch', None)
+    if update_batch:
+        keys, values = zip(*items)
+        try:
+            update_batch(ebpf_map, _to_ctypes_array(ebpf_map.Key, keys), _to_ctypes_array(ebpf_map.Leaf, values))
+            return
+        except Exception as e:
+            logging.debug('Batch update not supported for map, falling back to single updates: {}'.format(e))
+    for key, value in items:
+        ebpf_map[key] = value
+
+
+def delete_from_map(ebpf_map: Any, keys: Sequence[Any]):
+    """ Remove entries from an eBPF map, with a single BPF_MAP_DELETE_BATCH system call if supported
+
+    :param Any ebpf_map: eBPF table
+    :param Sequence[Any] keys: keys of the entries to remove
+    """
+    if not keys:
+        return
+    delete_batch = getattr(type(ebpf_map), 'items_delete_batch', None)
+    if delete_batch:
+        try:
+            delete_batch(ebpf_map, _to_ctypes_array(ebpf_map.Key, keys))
+            return
+        except Exception as e:
+            logging.debug('Batch delete not supported for map, falling back to single deletes: {}'.format(e))
+    for key in keys:
+        del ebpf_map[key]
+
+
+def is_ipv6_filter(entry: dict) -> bool:
+    """ Check if a network filter applies to IPv6 addresses
+
+    :param dict entry: network filter (see `load_filters_into_map`)
+    :return: True if the network is IPv6
+    """
+    return is_ipv6(entry['network'])
+
+
+def filter_port_ranges(entry: dict) -> Tuple[PortFilterMode, List[CPortRange]]:
+    """ Extract port filtering mode and port ranges from a network filter
+
+    :param dict entry: network filter (see `load_filters_into_map`)
+    :return: filtering mode and port ranges
+    """
+    if entry.get('except_ports'):
+        return PortFilterMode.exclude, list(map(CPortRange.from_conf_value, entry['except_ports']))
+    elif entry.get('include_ports'):
+        return PortFilterMode.include, list(map(CPortRange.from_conf_value, entry['include_ports']))
+    return PortFilterMode.all, []
+
+
+def needs_port_bitmap(entry: dict) -> bool:
+    """ Check if a network filter has too many port ranges to be stored in the trie value
+
+    :param dict entry: network filter (see `load_filters_into_map`)
+    :return: True if a port bitmap is needed
+    """
+    return len(filter_port_ranges(entry)[1]) > NET_FILTER_MAX_PORT_RANGES
+
+
+def load_filters_into_map(
+    filters: List[dict],
+    ebpf_map: Any,
+    do_diff: bool = False,
+    bitmap_map: Any = None,
+    ipv6_map: Any = None,
+):
     """ Loads network filters into a eBPF map. The map is expected to be a trie
     with prefix as they key and net_filter_val_t as elements, according to the
     type definitions in the `net_filter_trie_init` macro in `utils.j2`.
 
+    Port ranges are stored in the trie value, unless there are more than
+    NET_FILTER_MAX_PORT_RANGES of them: then they are stored as a port bitmap
+    in a separate array map, referenced by index from the trie value.
+
+    IPv6 filters are loaded into a trie of their own, sharing the port bitmaps
+    with IPv4 filters, and are skipped if no such trie is provided.
+
     NOTE: modifying values in the map is not atomic, hence it may cause a brief moment
-    of inconsistency between probe output and configuration.
+    of inconsistency between probe output and configuration if the map is in use.
 
     :param List[dict] filters: list of IP-ports filters. Format:
                                 {
-                                    'network': '127.0.0.1',
-                                    'network_mask': '255.0.0.0',
+                                    'network': '127.0.0.1',  # or IPv6, e.g. 'fd00::'
+                                    'network_mask': '255.0.0.0',  # or IPv6, e.g. 'ff00::'
                                     'except_ports': [123, 456], # optional
                                     'include_ports': [789],     # optional
                                 }
     :param Any ebpf_map: reference to eBPF table where filters should be loaded.
     :param bool do_diff: diff input with existing values, removing excess entries
+    :param Any bitmap_map: array of net_filter_port_bitmap_t, required for filters with many port ranges
+    :param Any ipv6_map: trie with net_filter_key_v6_t as key, where IPv6 filters should be loaded
     """
+    # The map returns keys using an auto-generated type.
+    # Casting works, but we don't want to keep map references anyway to avoid
+    # side effect, so we might as well unpack them explicitly
     leftovers = set(
-        # The map returns keys using an auto-generated type.
-        # Casting works, but we don't want to keep map references anyway to avoid
-        # side effect, so we might as well unpack them explicitly
-        (CFilterKey(prefixlen=k.prefixlen, data=k.data) for k in ebpf_map)
+        (CFilterKey(prefixlen=k.prefixlen, data=k.data) for k, _ in read_map_items(ebpf_map))
         if do_diff else [],
     )
-    for entry in filters:
-        map_key = CFilterKey.from_network_definition(
-            netmask=entry['network_mask'],
-            ip=entry['network'],
+    ipv6_leftovers = set(
+        (
+            CFilterKeyV6(prefixlen=k.prefixlen, data=CFilterKeyV6.data_array_t(*k.data))
+            for k, _ in read_map_items(ipv6_map)
         )
-        if entry.get('except_ports'):
-            mode = PortFilterMode.exclude
-            port_ranges = list(map(CPortRange.from_conf_value, entry['except_ports']))
-        elif entry.get('include_ports'):
-            mode = PortFilterMode.include
-            port_ranges = list(map(CPortRange.from_conf_value, entry['include_ports']))
+        if do_diff and ipv6_map is not None else [],
+    )
+    updates = {}
+    ipv6_updates = {}
+    bitmaps = []
+    for entry in filters:
+        if is_ipv6_filter(entry):
+            if ipv6_map is None:
+                continue
+            map_key = CFilterKeyV6.from_network_definition(netmask=entry['network_mask'], ip=entry['network'])
+            map_updates = ipv6_updates
         else:
-            mode = PortFilterMode.all
-            port_ranges = []
-        ebpf_map[map_key] = CFilterValue(
-            mode=mode.value,
-            range_size=len(port_ranges),
-            ranges=CFilterValue.range_array_t(*port_ranges),
-        )
-        leftovers.discard(map_key)
-    for key in leftovers:
-        del ebpf_map[key]
+            map_key = CFilterKey.from_network_definition(netmask=entry['network_mask'], ip=entry['network'])
+            map_updates = updates
+        mode, port_ranges = filter_port_ranges(entry)
+        if len(port_ranges) > NET_FILTER_MAX_PORT_RANGES:
+            if bitmap_map is None:
+                raise ValueError(
+                    'Filter for {}/{} has more than {} port ranges'.format(
+                        entry['network'], entry['network_mask'], NET_FILTER_MAX_PORT_RANGES,
+                    ),
+                )
+            bitmaps.append((ctypes.c_int(len(bitmaps)), CFilterPortBitmap.from_port_ranges(port_ranges)))
+            value = CFilterValue(mode=mode.value, bitmap_index=len(bitmaps))
+        else:
+            value = CFilterValue(
+                mode=mode.value,
+                range_size=len(port_ranges),
+                ranges=CFilterValue.range_array_t(*port_ranges),
+            )
+        map_updates[map_key] = value
+    leftovers.difference_update(updates)
+    ipv6_leftovers.difference_update(ipv6_updates)
+    # bitmaps are written first, so that trie values never reference missing ones
+    if bitmaps:
+        update_map(bitmap_map, bitmaps)
+    update_map(ebpf_map, list(updates.items()))
+    delete_from_map(ebpf_map, list(leftovers))
+    if ipv6_map is not None:
+        update_map(ipv6_map, list(ipv6_updates.items()))
+        delete_from_map(ipv6_map, list(ipv6_leftovers))
 
 
 def load_port_filters_into_map(
@@ -170,39 +470,55 @@ def load_port_filters_into_map(
     mode: PortFilterMode,
     ebpf_map: Any,
     do_diff: bool = False,
+    overwrite: bool = False,
 ):
     """ Loads global port filters into eBPF array map.
     The map must be a BPF array with allocated space to fit all the possible TCP/UDP ports (2^16).
 
     NOTE: modifying values in the map is not atomic, hence it may cause a brief moment
-    of inconsistency between probe output and configuration. For this reason, hot-swapping
-    the filtering mode is supported but not recommended.
+    of inconsistency between probe output and configuration if the map is in use.
 
     :param List[Union[int, str]] filters: list of ports or port ranges
     :param PortFilterMode mode: include or exclude
     :param Any ebpf_map: array in which filters are loaded
     :param bool do_diff: diff input with existing values, removing excess entries
+    :param bool overwrite: reset all the ports not in the filters, without reading existing values
     """
     if mode not in (PortFilterMode.include, PortFilterMode.exclude):
         raise ValueError('Invalid global port filtering mode: {}'.format(mode))
-    current_state = set((k.value for k, v in ebpf_map.items() if v.value > 0 and k.value > 0) if do_diff else [])
-    portset = set(
-        chain.from_iterable(
-            port_range_mapper(port_or_range)
-            if isinstance(port_or_range, str) and '-' in port_or_range
-            else (int(port_or_range),)
-            for port_or_range in filters
-        ),
-    )
+    if overwrite:
+        current_state = set(range(1, 65536))
+    else:
+        current_state = set(
+            (k.value for k, v in read_map_items(ebpf_map) if v.value > 0 and k.value > 0)
+            if do_diff else [],
+        )
+    portset = parse_port_filters(filters)
     leftovers = current_state - portset
-    for port in portset:
-        ebpf_map[ctypes.c_int(port)] = ctypes.c_uint8(1)
-    for port in leftovers:
-        ebpf_map[ctypes.c_int(port)] = ctypes.c_uint8(0)
-    # 0-element of the map holds the filtering mode
+    flag_on, flag_off = ctypes.c_uint8(1), ctypes.c_uint8(0)
+    update_map(
+        ebpf_map,
+        [(ctypes.c_int(port), flag_on) for port in portset]
+        + [(ctypes.c_int(port), flag_off) for port in leftovers],
+    )
+    # 0-element of the map holds the filtering mode, written last so that it is never
+    # set before the ports it applies to
     ebpf_map[ctypes.c_int(0)] = ctypes.c_uint8(mode.value)
 
 
+def load_port_bitmap_into_map(filters: List[Union[int, str]], mode: PortFilterMode, ebpf_map: Any):
+    """ Loads global port filters into eBPF array map holding a single `CPortBitmap` value,
+    which takes one map update regardless of the number of ports filtered.
+
+    :param List[Union[int, str]] filters: list of ports or port ranges
+    :param PortFilterMode mode: include or exclude
+    :param Any ebpf_map: array in which filters are loaded
+    """
+    if mode not in (PortFilterMode.include, PortFilterMode.exclude):
+        raise ValueError('Invalid global port filtering mode: {}'.format(mode))
+    ebpf_map[ctypes.c_int(0)] = CPortBitmap.from_port_filters(filters, mode)
+
+
 def load_intset_into_map(intset: Set[int], ebpf_map: Any, do_diff: bool = False, delete: bool = False):
     """ Loads set of int values into eBPF map
 
@@ -214,9 +530,7 @@ def load_intset_into_map(intset: Set[int], ebpf_map: Any, do_diff: bool = False,
     if delete:
         to_delete = intset
     else:
-        current_state = set((k.value for k, _ in ebpf_map.items()) if do_diff else [])
+        current_state = set((k.value for k, _ in read_map_items(ebpf_map)) if do_diff else [])
         to_delete = current_state - intset
-        for val in intset:
-            ebpf_map[ctypes.c_int(val)] = ctypes.c_uint8(1)
-    for val in to_delete:
-        del ebpf_map[ctypes.c_int(val)]
+        update_map(ebpf_map, [(ctypes.c_int(val), ctypes.c_uint8(1)) for val in intset])
+    delete_from_map(ebpf_map, [ctypes.c_int(val) for val in to_delete])
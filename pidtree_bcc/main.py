@@ -1,16 +1,14 @@
 import argparse
+import asyncio
 import logging
 import os
+import platform
 import select
 import signal
 import sys
-import time
 from functools import partial
 from multiprocessing import Process
 from multiprocessing import set_start_method
-from multiprocessing import SimpleQueue
-from threading import Thread
-from typing import Any
 from typing import Callable
 from typing import List
 from typing import TextIO
@@ -19,7 +17,16 @@ from staticconf.config import ConfigurationWatcher
 
 from pidtree_bcc import __version__
 from pidtree_bcc.config import setup_config
+from pidtree_bcc.metrics import MetricsExporter
 from pidtree_bcc.probes import load_probes
+from pidtree_bcc.process_cache import ProcessTreeCache
+from pidtree_bcc.serialization import JSON_ENCODERS
+from pidtree_bcc.serialization import OUTPUT_FORMATS
+from pidtree_bcc.transport import BatchingQueueTransport
+from pidtree_bcc.transport import EventTransport
+from pidtree_bcc.transport import forward_events
+from pidtree_bcc.transport import SharedMemoryRingTransport
+from pidtree_bcc.utils import PROCESS_CACHE
 from pidtree_bcc.utils import self_restart
 from pidtree_bcc.utils import smart_open
 from pidtree_bcc.utils import StopFlagWrapper
@@ -65,7 +72,7 @@ def parse_args() -> argparse.Namespace:
     )
     parser.add_argument(
         '--health-check-period', type=int, default=HEALTH_CHECK_PERIOD_DEFAULT,
-        help='Controls how often the watchdog thread performs health and configuration checks (in seconds)',
+        help='Controls how often the watchdog task performs health and configuration checks (in seconds)',
     )
     parser.add_argument(
         '--lost-event-telemetry', type=int, default=-1, metavar='NEVENTS',
@@ -74,6 +81,55 @@ def parse_args() -> argparse.Namespace:
             'of events dropped due to the kernel -> userland communication channel filling up'
         ),
     )
+    parser.add_argument(
+        '--telemetry-interval', type=float, default=0, metavar='SECONDS',
+        help='If set and greater than 0, output probe metrics as telemetry records every SECONDS',
+    )
+    parser.add_argument(
+        '--metrics-address', type=str, metavar='HOST:PORT|unix:PATH',
+        help='Expose probe metrics in Prometheus format over HTTP, on a TCP address or unix socket',
+    )
+    parser.add_argument(
+        '--transport', type=str, choices=('queue', 'shm'), default='queue',
+        help=(
+            'How events are passed from probe processes to the output writer: a pipe shared by all probes, '
+            'or a shared memory ring buffer for each probe (x86 only)'
+        ),
+    )
+    parser.add_argument(
+        '--shm-ring-size', type=int, default=SharedMemoryRingTransport.DEFAULT_CAPACITY, metavar='BYTES',
+        help='Capacity of the shared memory ring buffer of each probe, events are dropped when it is full',
+    )
+    parser.add_argument(
+        '--max-batch', type=int, default=BatchingQueueTransport.DEFAULT_MAX_BATCH, metavar='NEVENTS',
+        help='Maximum number of events probes buffer before sending them to be written out',
+    )
+    parser.add_argument(
+        '--flush-interval', type=float, default=BatchingQueueTransport.DEFAULT_FLUSH_INTERVAL, metavar='SECONDS',
+        help='Maximum time probes buffer events before sending them to be written out',
+    )
+    parser.add_argument(
+        '--process-cache-size', type=int, default=ProcessTreeCache.DEFAULT_MAX_SIZE, metavar='NPROCS',
+        help='Maximum number of processes kept in the process ancestry cache of each probe',
+    )
+    parser.add_argument(
+        '--process-cache-max-age', type=float, default=ProcessTreeCache.DEFAULT_MAX_AGE, metavar='SECONDS',
+        help='For how long ancestors read from /proc are cached, as they may execute a different program meanwhile',
+    )
+    parser.add_argument(
+        '--output-format', type=str, choices=OUTPUT_FORMATS, default='json',
+        help=(
+            'Event output format: newline-delimited JSON, or length-prefixed msgpack frames '
+            '(see `python -m pidtree_bcc.msgpack_reader` to convert it back to JSON)'
+        ),
+    )
+    parser.add_argument(
+        '--json-encoder', type=str, choices=tuple(JSON_ENCODERS), default='json',
+        help=(
+            'JSON encoder used to serialize events. Encoders other than the standard library one '
+            'are faster, but produce more compact output, and need to be installed separately'
+        ),
+    )
     parser.add_argument(
         '--extra-probe-path', type=str,
         help='Extra dot-notation package path where to look for probes to load',
@@ -87,25 +143,26 @@ def parse_args() -> argparse.Namespace:
         version='{} {}'.format(program_name, __version__),
     )
     args = parser.parse_args()
+    if args.transport == 'shm' and not SharedMemoryRingTransport.is_supported():
+        parser.error('--transport shm is only supported on x86, not on {}'.format(platform.machine()))
     if args.config is not None and not os.path.exists(args.config):
         sys.stderr.write('--config file does not exist\n')
     return args
 
 
-def termination_handler(probe_workers: List[Process], signum: int, frame: Any):
-    """ Generic termination signal handler
+def termination_handler(probe_workers: List[Process], shutdown: asyncio.Future, signum: int):
+    """ Generic termination signal handler, run by the event loop
 
     :param List[Process] probe_workers: list of probe processes
+    :param asyncio.Future shutdown: future resolved with the signal number, to stop the main loop
     :param int signum: signal integer code
-    :param Any frame: signal stack frame
     """
     msg_info = ('restart', 'restarting') if signum == signal.SIGHUP else ('termination', 'exiting')
     logging.warning('Caught {} signal, shutting off probes and {}'.format(*msg_info))
     for worker in probe_workers:
         worker.terminate()
-    if signum == signal.SIGHUP:
-        raise RestartSignal()
-    sys.exit(EXIT_CODE)
+    if not shutdown.done():
+        shutdown.set_result(signum)
 
 
 def deregister_signals(func: Callable):
@@ -115,16 +172,16 @@ def deregister_signals(func: Callable):
     :return: wrapped function
     """
     def helper(*args, **kwargs):
+        signal.set_wakeup_fd(-1)  # inherited from the event loop of the parent process
         for s in HANDLED_SIGNALS:
             signal.signal(s, signal.SIG_DFL)
         return func(*args, **kwargs)
     return helper
 
 
-def health_and_config_watchdog(
+async def health_and_config_watchdog(
     probe_workers: List[Process],
     output_fh: TextIO,
-    stop_flag: StopFlagWrapper,
     config_watcher: ConfigurationWatcher = None,
     check_period: int = HEALTH_CHECK_PERIOD_DEFAULT,
 ):
@@ -136,12 +193,11 @@ def health_and_config_watchdog(
     ;param int check_period: how often the checks are run (in seconds)
     """
     global EXIT_CODE
+    loop = asyncio.get_running_loop()
     fs_poller = select.poll()
     fs_poller.register(output_fh, select.POLLERR)
     while True:
-        time.sleep(check_period)
-        if stop_flag.do_stop:
-            break
+        await asyncio.sleep(check_period)
         bad_fds = fs_poller.poll(0)
         if not all(worker.is_alive() for worker in probe_workers) or bad_fds:
             EXIT_CODE = 1
@@ -151,12 +207,59 @@ def health_and_config_watchdog(
             break
         if config_watcher:
             try:
-                config_watcher.reload_if_changed()
+                # remote includes may block while fetching, which must not stall event output
+                await loop.run_in_executor(None, config_watcher.reload_if_changed)
             except Exception as e:
                 logging.warning('Issue encountered in checking config changes, restarting: {}'.format(e))
                 self_restart()
 
 
+async def output_loop(
+    probe_workers: List[Process],
+    transports: List[EventTransport],
+    output_fh: TextIO,
+    binary_output: bool,
+    shutdown: asyncio.Future,
+    config_watcher: ConfigurationWatcher,
+    metrics_exporter: MetricsExporter,
+    args: argparse.Namespace,
+) -> int:
+    """ Write out events from the probes, while health and configuration checks run as a separate task
+
+    :param List[Process] probe_workers: list of probe processes
+    :param List[EventTransport] transports: transports carrying events from the probes
+    :param TextIO output_fh: Output file handle
+    :param bool binary_output: events are serialized to bytes rather than text
+    :param asyncio.Future shutdown: future resolved with the number of the signal requesting shutdown
+    :param ConfigurationWatcher config_watcher: Watcher for monitoring configuration changes
+    :param MetricsExporter metrics_exporter: exporter of probe metrics
+    :param argparse.Namespace args: command line arguments
+    :return: number of the signal which caused the shutdown
+    """
+    def write_batch(batch: list):
+        output_fh.write(b''.join(batch) if binary_output else '\n'.join(batch) + '\n')
+        output_fh.flush()
+        metrics_exporter.events_written += len(batch)
+
+    output_task = asyncio.ensure_future(forward_events(transports, write_batch, args.flush_interval))
+    background_tasks = [
+        asyncio.ensure_future(
+            health_and_config_watchdog(probe_workers, output_fh, config_watcher, args.health_check_period),
+        ),
+    ]
+    if args.metrics_address:
+        background_tasks.append(asyncio.ensure_future(metrics_exporter.serve(args.metrics_address)))
+    try:
+        await asyncio.wait((shutdown, output_task), return_when=asyncio.FIRST_COMPLETED)
+        if output_task.done():
+            output_task.result()  # raises the error which stopped the output
+        return shutdown.result()
+    finally:
+        for task in (output_task, *background_tasks):
+            task.cancel()
+        await asyncio.gather(output_task, *background_tasks, return_exceptions=True)
+
+
 def main(args: argparse.Namespace):
     global EXIT_CODE
     probe_workers = []
@@ -166,53 +269,69 @@ def main(args: argparse.Namespace):
         level=logging.INFO,
         format='%(asctime)s - %(levelname)s - %(message)s',
     )
-    curried_handler = partial(termination_handler, probe_workers)
+    loop = asyncio.new_event_loop()
+    shutdown = loop.create_future()
     for s in HANDLED_SIGNALS:
-        signal.signal(s, curried_handler)
-    config_watcher = setup_config(
-        args.config,
-        watch_config=args.watch_config,
-        min_watch_interval=args.health_check_period,
-        stop_flag=stop_wrapper,
-    )
-    out = smart_open(args.output_file, mode='w')
-    output_queue = SimpleQueue()
-    probes = load_probes(
-        output_queue,
-        args.extra_probe_path,
-        args.extra_plugin_path,
-        args.lost_event_telemetry,
-    )
-    logging.info('Loaded probes: {}'.format(', '.join(probes)))
-    if args.print_and_quit:
-        for probe_name, probe in probes.items():
-            print('----- {} -----'.format(probe_name))
-            print(probe.expanded_bpf_text)
-            print('\n')
-        sys.exit(0)
-    for probe in probes.values():
-        probe_workers.append(Process(target=deregister_signals(probe.start_polling)))
-        probe_workers[-1].start()
-    watchdog_thread = Thread(
-        target=health_and_config_watchdog,
-        args=(probe_workers, out, stop_wrapper, config_watcher, args.health_check_period),
-        daemon=True,
-    )
-    watchdog_thread.start()
+        loop.add_signal_handler(s, termination_handler, probe_workers, shutdown, s)
     try:
-        while True:
-            print(output_queue.get(), file=out)
-            out.flush()
-    except RestartSignal:
-        stop_wrapper.stop()
-        FileIncludeLoader.cleanup()
-        raise
-    except Exception as e:
-        # Terminate everything if something goes wrong
-        EXIT_CODE = 1
-        logging.error('Encountered unexpected error: {}'.format(e))
-        for worker in probe_workers:
-            worker.terminate()
+        config_watcher = setup_config(
+            args.config,
+            watch_config=args.watch_config,
+            min_watch_interval=args.health_check_period,
+            stop_flag=stop_wrapper,
+        )
+        binary_output = args.output_format != 'json'
+        out = smart_open(args.output_file, mode='wb' if binary_output else 'w')
+        PROCESS_CACHE.max_size = args.process_cache_size
+        PROCESS_CACHE.max_age = args.process_cache_max_age
+        if args.transport == 'shm':
+            output_queue = partial(SharedMemoryRingTransport, args.shm_ring_size, binary_output)
+        else:
+            output_queue = BatchingQueueTransport(args.max_batch, args.flush_interval)
+        probes = load_probes(
+            output_queue,
+            args.extra_probe_path,
+            args.extra_plugin_path,
+            args.lost_event_telemetry,
+            args.json_encoder,
+            args.output_format,
+            args.telemetry_interval,
+        )
+        logging.info('Loaded probes: {}'.format(', '.join(probes)))
+        transports = list({id(probe.output_queue): probe.output_queue for probe in probes.values()}.values())
+        if args.print_and_quit:
+            for probe_name, probe in probes.items():
+                print('----- {} -----'.format(probe_name))
+                print(probe.expanded_bpf_text)
+                print('\n')
+            for transport in transports:
+                transport.close()
+            sys.exit(0)
+        metrics_exporter = MetricsExporter(probe.metrics for probe in probes.values())
+        for probe in probes.values():
+            probe_workers.append(Process(target=deregister_signals(probe.start_polling)))
+            probe_workers[-1].start()
+        try:
+            signum = loop.run_until_complete(
+                output_loop(
+                    probe_workers, transports, out, binary_output, shutdown, config_watcher, metrics_exporter, args,
+                ),
+            )
+            if signum == signal.SIGHUP:
+                stop_wrapper.stop()
+                FileIncludeLoader.cleanup()
+                raise RestartSignal()
+        except Exception as e:
+            # Terminate everything if something goes wrong
+            EXIT_CODE = 1
+            logging.error('Encountered unexpected error: {}'.format(e))
+            for worker in probe_workers:
+                worker.terminate()
+        finally:
+            for transport in transports:
+                transport.close()
+    finally:
+        loop.close()
     sys.exit(EXIT_CODE)
 
 
@@ -0,0 +1,247 @@
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from multiprocessing.sharedctypes import RawArray
+from threading import Lock
+from typing import Iterable
+from typing import Iterator
+
+
+COUNTERS = {
+    'events_received': 'Events received from the kernel',
+    'events_filtered': 'Events discarded in userland during enrichment',
+    'events_enriched': 'Events enriched with process information',
+    'events_output': 'Events sent to the output writer',
+    'events_lost_kernel': 'Events lost because the kernel buffers were full',
+    'events_dropped_enrichment': 'Events dropped because the enrichment worker queues were full',
+    'events_dropped_transport': 'Events dropped because the transport to the output writer was full',
+    'kernel_filtered_net': 'Events discarded in kernel by network filters',
+    'kernel_filtered_port': 'Events discarded in kernel by global port filters',
+    'kernel_filtered_mntns': 'Events discarded in kernel by container mount namespace filters',
+    'kernel_filtered_netns': 'Events discarded in kernel by network namespace filters',
+    'kernel_submitted': 'Events submitted by the kernel to userland',
+    'kernel_kretprobe_miss': 'Function returns traced in kernel without a matching function call',
+}
+HISTOGRAMS = {
+    'enrichment_seconds': 'Time spent enriching an event',
+    'crawl_process_tree_seconds': 'Time spent looking up the process tree of an event',
+    'plugin_seconds': 'Time spent running an event through plugins',
+    'queue_wait_seconds': 'Time spent by an event waiting for an enrichment worker',
+    'filter_reload_seconds': 'Time spent loading filters into BPF maps',
+}
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+METRIC_PREFIX = 'pidtree_bcc_'
+
+# Metrics of the probe running in the current process, see `ProbeMetrics.activate`
+_active_metrics = None
+
+
+class ProbeMetrics:
+    """ Counters and latency histograms of a probe.
+
+    Values are stored in shared memory, so that they are updated by the probe process
+    and read by the main process. Instances must therefore be created before probe
+    processes are started.
+    """
+
+    def __init__(self, probe_name: str):
+        """ Constructor
+
+        :param str probe_name: name of the probe
+        """
+        self.probe_name = probe_name
+        self._counter_index = {name: i for i, name in enumerate(COUNTERS)}
+        # for each histogram: one slot per bucket (plus +Inf), then sum and count
+        histogram_size = len(LATENCY_BUCKETS) + 3
+        self._histogram_offset = {
+            name: len(COUNTERS) + i * histogram_size
+            for i, name in enumerate(HISTOGRAMS)
+        }
+        self._values = RawArray('d', len(COUNTERS) + len(HISTOGRAMS) * histogram_size)
+        self._lock = Lock()  # updates come from multiple threads of the probe process
+
+    def inc(self, counter: str, value: int = 1):
+        """ Increment counter
+
+        :param str counter: counter name
+        :param int value: increment
+        """
+        with self._lock:
+            self._values[self._counter_index[counter]] += value
+
+    def set(self, counter: str, value: int):
+        """ Set counter to a total tracked elsewhere
+
+        :param str counter: counter name
+        :param int value: counter value
+        """
+        self._values[self._counter_index[counter]] = value
+
+    def get(self, counter: str) -> int:
+        """ Read counter
+
+        :param str counter: counter name
+        :return: counter value
+        """
+        return int(self._values[self._counter_index[counter]])
+
+    def observe(self, histogram: str, seconds: float):
+        """ Record latency sample
+
+        :param str histogram: histogram name
+        :param float seconds: sample value
+        """
+        offset = self._histogram_offset[histogram]
+        bucket = bisect_left(LATENCY_BUCKETS, seconds)
+        with self._lock:
+            self._values[offset + bucket] += 1
+            self._values[offset + len(LATENCY_BUCKETS) + 1] += seconds
+            self._values[offset + len(LATENCY_BUCKETS) + 2] += 1
+
+    @contextmanager
+    def timed(self, histogram: str) -> Iterator[None]:
+        """ Record the execution time of a block of code
+
+        :param str histogram: histogram name
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(histogram, time.perf_counter() - start)
+
+    def snapshot(self) -> dict:
+        """ Read all metric values
+
+        :return: dictionary with counter values, and cumulative bucket counts, sum and count of histograms
+        """
+        values = self._values[:]
+        histograms = {}
+        for name, offset in self._histogram_offset.items():
+            cumulative, buckets = 0, []
+            for bucket_count in values[offset:offset + len(LATENCY_BUCKETS) + 1]:
+                cumulative += int(bucket_count)
+                buckets.append(cumulative)
+            histograms[name] = {
+                'buckets': buckets,
+                'sum': values[offset + len(LATENCY_BUCKETS) + 1],
+                'count': int(values[offset + len(LATENCY_BUCKETS) + 2]),
+            }
+        return {
+            'counters': {name: int(values[i]) for name, i in self._counter_index.items()},
+            'histograms': histograms,
+        }
+
+    def telemetry_record(self) -> dict:
+        """ Format metrics as event stream record
+
+        :return: telemetry record
+        """
+        snapshot = self.snapshot()
+        record = {'type': 'telemetry', **snapshot['counters']}
+        for name, values in snapshot['histograms'].items():
+            record[name] = {
+                'count': values['count'],
+                'sum': values['sum'],
+                'buckets': dict(zip(map(str, LATENCY_BUCKETS + ('+Inf',)), values['buckets'])),
+            }
+        return record
+
+    def activate(self):
+        """ Make these the metrics updated by instrumented code shared by all
+        probes, such as process tree crawling, in the current process.
+        """
+        global _active_metrics
+        _active_metrics = self
+
+
+@contextmanager
+def timed(histogram: str) -> Iterator[None]:
+    """ Record the execution time of a block of code in the metrics of the probe
+    running in the current process, if any.
+
+    :param str histogram: histogram name
+    """
+    if _active_metrics is None:
+        yield
+    else:
+        with _active_metrics.timed(histogram):
+            yield
+
+
+class MetricsExporter:
+    """ Exposes probe metrics in Prometheus text format, via HTTP over TCP or a unix socket """
+
+    def __init__(self, probe_metrics: Iterable[ProbeMetrics]):
+        """ Constructor
+
+        :param Iterable[ProbeMetrics] probe_metrics: metrics of each probe
+        """
+        self.probe_metrics = list(probe_metrics)
+        self.events_written = 0
+
+    def render(self) -> str:
+        """ Format metrics in Prometheus text exposition format
+
+        :return: metrics text
+        """
+        snapshots = [(metrics.probe_name, metrics.snapshot()) for metrics in self.probe_metrics]
+        lines = [
+            '# HELP {}events_written_total Events written to the output'.format(METRIC_PREFIX),
+            '# TYPE {}events_written_total counter'.format(METRIC_PREFIX),
+            '{}events_written_total {}'.format(METRIC_PREFIX, self.events_written),
+        ]
+        for counter, description in COUNTERS.items():
+            name = '{}{}_total'.format(METRIC_PREFIX, counter)
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} counter'.format(name))
+            for probe_name, snapshot in snapshots:
+                lines.append('{}{{probe="{}"}} {}'.format(name, probe_name, snapshot['counters'][counter]))
+        for histogram, description in HISTOGRAMS.items():
+            name = METRIC_PREFIX + histogram
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} histogram'.format(name))
+            for probe_name, snapshot in snapshots:
+                values = snapshot['histograms'][histogram]
+                for bound, bucket_count in zip(LATENCY_BUCKETS + ('+Inf',), values['buckets']):
+                    lines.append('{}_bucket{{probe="{}",le="{}"}} {}'.format(name, probe_name, bound, bucket_count))
+                lines.append('{}_sum{{probe="{}"}} {}'.format(name, probe_name, values['sum']))
+                lines.append('{}_count{{probe="{}"}} {}'.format(name, probe_name, values['count']))
+        return '\n'.join(lines) + '\n'
+
+    async def serve(self, address: str):
+        """ Serve metrics until cancelled
+
+        :param str address: "HOST:PORT" to listen on TCP, or "unix:PATH" for a unix socket
+        """
+        try:
+            if address.startswith('unix:'):
+                server = await asyncio.start_unix_server(self._handle_request, address[len('unix:'):])
+            else:
+                host, port = address.rsplit(':', 1)
+                server = await asyncio.start_server(self._handle_request, host or None, int(port))
+        except Exception as e:
+            logging.error('Could not serve metrics on {}: {}'.format(address, e))
+            return
+        async with server:
+            await server.serve_forever()
+
+    async def _handle_request(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """ Minimal HTTP handler, replying with metrics to any request """
+        try:
+            while (await reader.readline()).strip():
+                pass  # request line and headers are irrelevant
+            body = self.render().encode()
+            writer.write(
+                b'HTTP/1.0 200 OK\r\n'
+                b'Content-Type: text/plain; version=0.0.4\r\n'
+                + 'Content-Length: {}\r\n\r\n'.format(len(body)).encode()
+                + body,
+            )
+            await writer.drain()
+        except Exception as e:
+            logging.warning('Error serving metrics: {}'.format(e))
+        finally:
+            writer.close()
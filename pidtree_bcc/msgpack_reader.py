@@ -0,0 +1,94 @@
+""" Converts pidtree-bcc msgpack output back to newline-delimited JSON.
+
+Usage: python -m pidtree_bcc.msgpack_reader [-i INPUT] [-o OUTPUT]
+"""
+import argparse
+import json
+import sys
+from typing import BinaryIO
+from typing import Iterator
+from typing import List
+from typing import TextIO
+
+import msgpack
+
+from pidtree_bcc.serialization import MsgpackEventSerializer
+from pidtree_bcc.utils import smart_open
+
+
+def read_frames(input_fh: BinaryIO) -> Iterator[dict]:
+    """ Read length-prefixed msgpack frames
+
+    :param BinaryIO input_fh: binary input stream
+    :return: iterator of decoded records
+    """
+    header_size = MsgpackEventSerializer.FRAME_HEADER.size
+    while True:
+        header = input_fh.read(header_size)
+        if len(header) < header_size:
+            break
+        size, = MsgpackEventSerializer.FRAME_HEADER.unpack(header)
+        payload = input_fh.read(size)
+        if len(payload) < size:
+            break  # truncated output, e.g. the writer was killed
+        yield msgpack.unpackb(payload)
+
+
+def _decode_process(fields: List[str], proc: list) -> dict:
+    """ Restore process tree entry from its array of schema fields, possibly followed by a map of other fields
+
+    :param List[str] fields: schema fields
+    :param list proc: encoded process
+    :return: process dictionary
+    """
+    decoded = {field: value for field, value in zip(fields, proc) if value is not None}
+    if len(proc) > len(fields):
+        decoded.update(proc[len(fields)])
+    return decoded
+
+
+def read_events(input_fh: BinaryIO) -> Iterator[dict]:
+    """ Read events from msgpack output, restoring them to the same structure they have in JSON output
+
+    :param BinaryIO input_fh: binary input stream
+    :return: iterator of events
+    """
+    schemas = {}
+    for record in read_frames(input_fh):
+        if record.get('type') == 'schema':
+            schemas[record['probe']] = record['proctree_fields']
+            continue
+        if 'proctree' in record:
+            fields = schemas.get(record.get('probe'), MsgpackEventSerializer.PROCTREE_FIELDS)
+            record['proctree'] = [_decode_process(fields, proc) for proc in record['proctree']]
+        yield record
+
+
+def convert_to_json(input_fh: BinaryIO, output_fh: TextIO):
+    """ Convert msgpack output to newline-delimited JSON
+
+    :param BinaryIO input_fh: binary input stream
+    :param TextIO output_fh: text output stream
+    """
+    for event in read_events(input_fh):
+        output_fh.write(json.dumps(event) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert pidtree-bcc msgpack output to JSON')
+    parser.add_argument(
+        '-i', '--input-file', type=str, default='-',
+        help='File to read msgpack output from (default is STDIN, denoted by -)',
+    )
+    parser.add_argument(
+        '-o', '--output-file', type=str, default='-',
+        help='File to output JSON to (default is STDOUT, denoted by -)',
+    )
+    args = parser.parse_args()
+    input_fh = sys.stdin.buffer if args.input_file == '-' else open(args.input_file, 'rb')
+    with input_fh, smart_open(args.output_file, mode='w') as output_fh:
+        convert_to_json(input_fh, output_fh)
+
+
+if __name__ == '__main__':
+    main()
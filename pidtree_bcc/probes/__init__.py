@@ -1,18 +1,25 @@
+import ctypes
 import inspect
-import json
 import logging
 import os.path
 import platform
 import re
 import time
-from datetime import datetime
 from functools import lru_cache
 from multiprocessing import SimpleQueue
+from queue import Full
+from queue import Queue
 from threading import Lock
 from threading import Thread
 from typing import Any
+from typing import Callable
+from typing import List
 from typing import Mapping
+from typing import Optional
+from typing import Tuple
+from typing import Union
 
+import psutil
 from bcc import __version__ as bccversion
 from bcc import BPF
 from jinja2 import Environment
@@ -22,14 +29,25 @@ from pidtree_bcc.config import enumerate_probe_configs
 from pidtree_bcc.containers import ContainerEventType
 from pidtree_bcc.containers import list_container_mnt_namespaces
 from pidtree_bcc.containers import monitor_container_mnt_namespaces
+from pidtree_bcc.filtering import is_ipv6_filter
 from pidtree_bcc.filtering import load_filters_into_map
 from pidtree_bcc.filtering import load_intset_into_map
+from pidtree_bcc.filtering import load_port_bitmap_into_map
 from pidtree_bcc.filtering import load_port_filters_into_map
+from pidtree_bcc.filtering import needs_port_bitmap
 from pidtree_bcc.filtering import NET_FILTER_MAX_PORT_RANGES
 from pidtree_bcc.filtering import PortFilterMode
+from pidtree_bcc.metrics import ProbeMetrics
 from pidtree_bcc.plugins import load_plugins
+from pidtree_bcc.process_cache import boot_ns_to_start_time
+from pidtree_bcc.process_cache import ProcessInfo
+from pidtree_bcc.process_cache import uid_to_username
+from pidtree_bcc.serialization import create_serializer
+from pidtree_bcc.serialization import ProcessInterner
+from pidtree_bcc.transport import EventTransport
 from pidtree_bcc.utils import find_subclass
 from pidtree_bcc.utils import never_crash
+from pidtree_bcc.utils import PROCESS_CACHE
 from pidtree_bcc.utils import round_nearest_multiple
 
 
@@ -49,27 +67,89 @@ class BPFProbe:
 
     # To be populated by `load_probes`
     EXTRA_PLUGIN_PATH = None
+    JSON_ENCODER = 'json'
+    OUTPUT_FORMAT = 'json'
+    TELEMETRY_INTERVAL = 0  # seconds between telemetry records in the event stream, 0 to disable
 
     # If set, it means that the probe implements network filtering with a BPF table
     # (not via Jinja-templated if statements)
     USES_DYNAMIC_FILTERS = False
+    # IPv4 filters are loaded in NET_FILTER_MAP_NAME tries, IPv6 ones (if the `ipv6` probe
+    # setting is enabled) in tries with a "_v6" suffix
     NET_FILTER_MAP_NAME = 'net_filter_map'
     NET_FILTER_MAP_SIZE_MAX = 4 * 1024
     NET_FILTER_MAP_SIZE_SCALING = 512
+    # Port bitmaps for network filters with more than NET_FILTER_MAX_PORT_RANGES port ranges (8KB each)
+    NET_FILTER_PORT_BITMAPS_MAX = 256
+    NET_FILTER_PORT_BITMAPS_SCALING = 8
     PORT_FILTER_MAP_NAME = 'port_filter_map'
+    # Network and port filter maps come in two generations (suffixed by "_0" and "_1"),
+    # this one-element array holds the generation in use by the BPF program
+    FILTER_GENERATION_MAP_NAME = 'filter_generation_map'
     MNTNS_FILTER_MAP_NAME = 'mntns_filter_map'
+    # Filtering decisions counted in kernel (see `filter_counters_init` macro in `utils.j2`),
+    # reported in probe metrics with a "kernel_" prefix
+    FILTER_COUNTERS_MAP_NAME = 'filter_counters'
+    FILTER_COUNTERS = (
+        'filtered_net',
+        'filtered_port',
+        'filtered_mntns',
+        'filtered_netns',
+        'submitted',
+        'kretprobe_miss',
+    )
     CONTAINER_BASELINE_INTERVAL = 30 * 60  # seconds
 
+    # Events are output through a BPF ring buffer shared by all CPUs when the kernel supports it
+    # (can be disabled with the `ring_buffer` probe setting), and through per-CPU perf buffers otherwise
+    RING_BUFFER_MIN_KERNEL = (5, 8)
+    # IPv6 events (enabled with the `ipv6` probe setting) have their own buffer and layout,
+    # so that IPv4 events keep their 32 bit address fields
+    IPV6_EVENTS_MAP_NAME = 'events_v6'
+    RING_BUFFER_PAGES_DEFAULT = 256
+    # Perf buffer sizing (per CPU) and polling behaviour. In adaptive mode, the perf buffer
+    # size is doubled, up to `perf_buffer_max_pages`, after events are lost in several
+    # consecutive check windows.
+    PERF_BUFFER_PAGES_DEFAULT = 8
+    PERF_BUFFER_MAX_PAGES_DEFAULT = 512
+    PERF_BUFFER_LOSS_WINDOW = 10  # seconds
+    PERF_BUFFER_LOSSY_WINDOWS = 3
+    POLL_TIMEOUT_MS_DEFAULT = -1  # wait indefinitely
+
+    # Enrichment of events in a pool of worker threads (enabled with the `enrichment_workers` probe setting)
+    # rather than in the polling thread. Events are assigned to workers by `_enrichment_shard_key`,
+    # so that their relative order is preserved for each key.
+    ENRICHMENT_QUEUE_SIZE_DEFAULT = 4096  # events, for each worker
+
+    # How often totals tracked outside of the probe metrics (e.g. by the transport) are copied into them
+    METRICS_SYNC_INTERVAL = 5  # seconds
+
+    # Process tree interning (enabled with the `proctree_interning` probe setting)
+    PROCTREE_REANNOUNCE_INTERVAL_DEFAULT = ProcessInterner.DEFAULT_REANNOUNCE_INTERVAL
+
+    # Process lifecycle tracking (enabled with the `track_processes` probe setting),
+    # event types reflect values in the `process_tracker_init` macro in `utils.j2`
+    PROC_EVENTS_MAP_NAME = 'proc_events'
+    PROCESS_EXIT_GRACE_PERIOD_DEFAULT = 30  # seconds
+    PROC_EVENT_FORK = 1
+    PROC_EVENT_EXEC = 2
+    PROC_EVENT_EXIT = 3
+
+    # In-kernel ancestry capture (enabled with the `kernel_ancestry_depth` probe setting)
+    KERNEL_ANCESTRY_MAX_DEPTH = 8
+    KERNEL_ANCESTRY_MODES = ('full', 'comm')
+    TASK_COMM_LEN = 16
+
     def __init__(
         self,
-        output_queue: SimpleQueue,
+        output_queue: EventTransport,
         probe_config: dict = None,
         lost_event_telemetry: int = -1,
         config_change_queue: SimpleQueue = None,
     ):
         """ Constructor
 
-        :param Queue output_queue: queue for event output
+        :param EventTransport output_queue: transport for event output
         :param dict probe_config: (optional) config passed as kwargs to BPF template
                                   all fields are passed to the template engine with the exception
                                   of "plugins". This behaviour can be overidden with the TEMPLATE_VARS
@@ -83,9 +163,23 @@ class BPFProbe:
         self.SIDECARS = []
         probe_config = probe_config if probe_config else {}
         self.output_queue = output_queue
+        if output_queue is not None:
+            self.SIDECARS.append((output_queue.flush_worker, tuple()))
         self.validate_config(probe_config)
         module_src = inspect.getsourcefile(type(self))
         self.probe_name = os.path.basename(module_src).split('.')[0]
+        self.serializer = create_serializer(self.probe_name, self.OUTPUT_FORMAT, self.JSON_ENCODER)
+        self.metrics = ProbeMetrics(self.probe_name)
+        self.SIDECARS.append((self._metrics_worker, (self.TELEMETRY_INTERVAL,)))
+        self.process_interner = (
+            ProcessInterner(
+                probe_config.get('proctree_reannounce_interval', self.PROCTREE_REANNOUNCE_INTERVAL_DEFAULT),
+            )
+            if probe_config.get('proctree_interning', False)
+            else None
+        )
+        # held until process records are queued, so that no event referencing them is output earlier
+        self.interning_mutex = Lock()
         self.plugins = load_plugins(
             probe_config.get('plugins', {}),
             self.probe_name,
@@ -100,7 +194,24 @@ class BPFProbe:
         self.lost_event_telemetry = lost_event_telemetry
         self.lost_event_timer = lost_event_telemetry
         self.lost_event_count = 0
+        self.lost_proc_event_count = 0
+        self.ring_buffer_pages = template_config['RING_BUFFER_PAGES']
+        self.perf_buffer_pages = probe_config.get('perf_buffer_pages', self.PERF_BUFFER_PAGES_DEFAULT)
+        self.perf_buffer_max_pages = probe_config.get('perf_buffer_max_pages', self.PERF_BUFFER_MAX_PAGES_DEFAULT)
+        self.perf_buffer_adaptive = probe_config.get('perf_buffer_adaptive', False) and not self.ring_buffer_pages
+        self.poll_timeout_ms = probe_config.get('poll_timeout_ms', self.POLL_TIMEOUT_MS_DEFAULT)
+        self.loss_window_start = time.monotonic()
+        self.loss_window_count = 0
+        self.lossy_windows = 0
+        self.enrichment_drop_count = 0
+        self.enrichment_queues = [
+            Queue(probe_config.get('enrichment_queue_size', self.ENRICHMENT_QUEUE_SIZE_DEFAULT))
+            for _ in range(probe_config.get('enrichment_workers', 0))
+        ]
+        for queue in self.enrichment_queues:
+            self.SIDECARS.append((self._enrichment_worker, (queue,)))
         self.net_filter_mutex = Lock()
+        self.filter_generation = 0
         if self.USES_DYNAMIC_FILTERS and config_change_queue:
             self.SIDECARS.append((self._poll_config_changes, (config_change_queue,)))
         self.container_labels_filter = template_config.get('container_labels')
@@ -108,6 +219,15 @@ class BPFProbe:
             self.container_name_mapping = {}
             self.container_idns_mapping = {}
             self.SIDECARS.append((self._monitor_running_containers, tuple()))
+        self.ipv6 = template_config.get('ipv6', False)
+        self.track_processes = template_config.get('track_processes', False)
+        self.kernel_ancestry_depth = template_config.get('kernel_ancestry_depth', 0)
+        self.kernel_ancestry_comm_only = template_config.get('kernel_ancestry_mode') == 'comm'
+        if self.track_processes:
+            self.SIDECARS.append((
+                self._expire_exited_processes,
+                (template_config.get('process_exit_grace_period', self.PROCESS_EXIT_GRACE_PERIOD_DEFAULT),),
+            ))
 
     def build_probe_config(self, probe_config: dict, hotswap_only: bool = False) -> dict:
         """ Load probe configuration values
@@ -122,12 +242,20 @@ class BPFProbe:
             else probe_config.copy()
         )
         if not hotswap_only:
+            ring_buffer_pages = (
+                template_config.get('ring_buffer_pages', self.RING_BUFFER_PAGES_DEFAULT)
+                if template_config.get('ring_buffer', True) and self._supports_ring_buffer()
+                else 0
+            )
             if hasattr(self, 'TEMPLATE_VARS'):
                 template_config = {k: template_config[k] for k in self.TEMPLATE_VARS}
             else:
                 template_config.pop('plugins', None)
             template_config['PATCH_BUGGY_HEADERS'] = self._has_buggy_headers()
             template_config['BCC_VERSION'] = int(bccversion.split('.')[1])
+            template_config['RING_BUFFER_PAGES'] = ring_buffer_pages
+            template_config['FILTER_COUNTERS_MAP_NAME'] = self.FILTER_COUNTERS_MAP_NAME
+            template_config['FILTER_COUNTERS'] = self.FILTER_COUNTERS
         if self.USES_DYNAMIC_FILTERS:
             self.net_filters = template_config['filters']
             self.global_filters = (
@@ -138,11 +266,30 @@ class BPFProbe:
             if not hotswap_only:
                 template_config['NET_FILTER_MAP_NAME'] = self.NET_FILTER_MAP_NAME
                 template_config['PORT_FILTER_MAP_NAME'] = self.PORT_FILTER_MAP_NAME
+                template_config['FILTER_GENERATION_MAP_NAME'] = self.FILTER_GENERATION_MAP_NAME
+                self.port_filter_bitmap = template_config.get('port_filter_bitmap', False)
+                template_config['PORT_FILTER_BITMAP'] = self.port_filter_bitmap
                 template_config['NET_FILTER_MAX_PORT_RANGES'] = NET_FILTER_MAX_PORT_RANGES
+                ipv6_filter_count = sum(map(is_ipv6_filter, self.net_filters))
                 template_config['NET_FILTER_MAP_SIZE'] = min(
                     self.NET_FILTER_MAP_SIZE_MAX,
-                    round_nearest_multiple(len(self.net_filters), self.NET_FILTER_MAP_SIZE_SCALING, headroom=128),
+                    round_nearest_multiple(
+                        len(self.net_filters) - ipv6_filter_count,
+                        self.NET_FILTER_MAP_SIZE_SCALING,
+                        headroom=128,
+                    ),
                 )
+                template_config['NET_FILTER_MAP_V6_SIZE'] = min(
+                    self.NET_FILTER_MAP_SIZE_MAX,
+                    round_nearest_multiple(ipv6_filter_count, self.NET_FILTER_MAP_SIZE_SCALING, headroom=128),
+                ) if template_config.get('ipv6') else 0
+                port_bitmap_count = sum(map(needs_port_bitmap, self.net_filters))
+                # capacity is fixed once the program is compiled, filter reloads cannot go beyond it
+                self.net_filter_port_bitmaps = min(
+                    self.NET_FILTER_PORT_BITMAPS_MAX,
+                    round_nearest_multiple(port_bitmap_count, self.NET_FILTER_PORT_BITMAPS_SCALING),
+                ) if port_bitmap_count else 0
+                template_config['NET_FILTER_PORT_BITMAPS'] = self.net_filter_port_bitmaps
                 template_config['MNTNS_FILTER_MAP_NAME'] = self.MNTNS_FILTER_MAP_NAME
         return template_config
 
@@ -163,6 +310,13 @@ class BPFProbe:
             or bccminor < 37 and kmajor > 6
         )
 
+    @lru_cache(maxsize=1)
+    def _supports_ring_buffer(self) -> bool:
+        """ BPF ring buffers are available from kernel 5.8, and need bcc support too """
+        kernel_version = platform.uname().release
+        kmajor, kminor = map(int, kernel_version.split('.', 2)[:2])
+        return (kmajor, kminor) >= self.RING_BUFFER_MIN_KERNEL and hasattr(BPF, 'ring_buffer_poll')
+
     def _process_events(self, cpu: Any, data: Any, size: Any, from_bpf: bool = True):
         """ BPF event callback
 
@@ -172,21 +326,126 @@ class BPFProbe:
         :param bool from_bpf: (optional, default=True) event generated by BPF code
         """
         event = self.bpf['events'].event(data) if from_bpf else data
-        event = self.enrich_event(event)
+        if from_bpf:
+            self.metrics.inc('events_received')
+        if self.enrichment_queues:
+            self._dispatch_event(event, from_bpf)
+            return
+        self._enrich_and_output(event)
+
+    def _process_ipv6_events(self, cpu: Any, data: Any, size: Any):
+        """ BPF event callback for the IPv6 event buffer
+
+        :param Any cpu: unused arg required for callback
+        :param Any data: BPF raw event
+        :param Any size: unused arg required for callback
+        """
+        event = self.bpf[self.IPV6_EVENTS_MAP_NAME].event(data)
+        self.metrics.inc('events_received')
+        if self.enrichment_queues:
+            self._dispatch_event(event, True)
+            return
+        self._enrich_and_output(event)
+
+    def _event_buffers(self) -> List[Tuple[str, Callable]]:
+        """ List BPF buffers through which events are received
+
+        :return: list of buffer name and event callback pairs
+        """
+        buffers = [('events', self._process_events)]
+        if self.ipv6:
+            buffers.append((self.IPV6_EVENTS_MAP_NAME, self._process_ipv6_events))
+        return buffers
+
+    def _enrich_and_output(self, event: Any):
+        """ Enrich BPF event and send it to output, unless it gets filtered out
+
+        :param Any event: BPF event data
+        """
+        with self.metrics.timed('enrichment_seconds'):
+            event = self.enrich_event(event)
         if not event:
+            self.metrics.inc('events_filtered')
+            return
+        self.metrics.inc('events_enriched')
+        self._output_event(event)
+
+    def _enrichment_shard_key(self, event: Any) -> int:
+        """ Overridable method selecting the enrichment worker for an event.
+        Events with the same key are enriched and output in the order they were received.
+
+        :param Any event: BPF event
+        :return: integer key
+        """
+        return event.pid
+
+    def _dispatch_event(self, event: Any, from_bpf: bool):
+        """ Send event to its enrichment worker. Events from BPF are copied out of the
+        event buffer, which gets reused once the callback returns, and are dropped
+        if the worker queue is full, so that polling is never blocked.
+
+        :param Any event: BPF event data
+        :param bool from_bpf: event generated by BPF code
+        """
+        queue = self.enrichment_queues[self._enrichment_shard_key(event) % len(self.enrichment_queues)]
+        if not from_bpf:
+            queue.put((time.monotonic(), event))
+            return
+        try:
+            queue.put_nowait((time.monotonic(), type(event).from_buffer_copy(event)))
+        except Full:
+            self.enrichment_drop_count += 1
+
+    @never_crash
+    def _enrichment_worker(self, queue: Queue):
+        """ Handler function for enrichment worker threads
+
+        :param Queue queue: queue of events assigned to the worker
+        """
+        while True:
+            queued_at, event = queue.get()
+            self.metrics.observe('queue_wait_seconds', time.monotonic() - queued_at)
+            self._enrich_and_output(event)
+
+    def _output_event(self, event: dict):
+        """ Add metadata to enriched event, run it through plugins and send it to output
+
+        :param dict event: event dictionary
+        """
+        if not self.plugins:
+            if self.process_interner:
+                event = self._intern_process_tree(event)
+            self.output_queue.put(self.serializer.serialize_with_metadata(event))
+            self.metrics.inc('events_output')
             return
         self._add_event_metadata(event)
-        for event_plugin in self.plugins:
-            event = event_plugin.process(event)
-        self.output_queue.put(json.dumps(event))
+        with self.metrics.timed('plugin_seconds'):
+            for event_plugin in self.plugins:
+                event = event_plugin.process(event)
+        if self.process_interner:
+            event = self._intern_process_tree(event)
+        self.output_queue.put(self.serializer.encode(event))
+        self.metrics.inc('events_output')
+
+    def _intern_process_tree(self, event: dict) -> dict:
+        """ Replace process tree with references to process records, outputting
+        the records not announced yet.
+
+        :param dict event: event dictionary
+        :return: event with process references
+        """
+        with self.interning_mutex:
+            event, records = self.process_interner.intern_event(event)
+            for record in records:
+                self.output_queue.put(self.serializer.serialize_with_metadata(record))
+        return event
 
     def _add_event_metadata(self, event: dict):
         """ Adds probe name and current ISO-format timestamp to event dictionary (in place)
 
         :param dict event: event dictionary
         """
-        event['timestamp'] = datetime.utcnow().isoformat() + 'Z'
-        event['probe'] = self.probe_name
+        self.serializer.add_metadata(event)
 
     def _lost_event_callback(self, lost_count: int):
         """ Method to be used as callback to count lost events
@@ -195,15 +454,218 @@ class BPFProbe:
         """
         self.lost_event_count += lost_count
 
+    def _ring_buffer_lost_event_count(self) -> int:
+        """ Read how many events were dropped because the event ring buffers were full
+
+        :return: number of events lost since the probe started
+        """
+        return sum(self._ring_buffer_lost_count(map_name) for map_name, _ in self._event_buffers())
+
+    def _ring_buffer_lost_count(self, map_name: str) -> int:
+        """ Read how many records were dropped because a BPF ring buffer was full.
+        Unlike perf buffers, ring buffers have no lost event callback, so this is
+        counted in kernel (see `submit_event` macro in `utils.j2`).
+
+        :param str map_name: name of the ring buffer map
+        :return: number of records lost since the probe started
+        """
+        return self.bpf['{}_lost'.format(map_name)][0].value
+
+    def _poll_events(self):
+        """ Poll the BPF event buffers, blocking until some events are available or timeout """
+        if self.ring_buffer_pages:
+            self.bpf.ring_buffer_poll(timeout=self.poll_timeout_ms)
+        else:
+            self.bpf.perf_buffer_poll(timeout=self.poll_timeout_ms)
+
+    def _open_event_buffers(self):
+        """ Open BPF buffers through which events are received """
+        if self.ring_buffer_pages:
+            # lost records are counted in kernel rather than reported via callback
+            for map_name, callback in self._event_buffers():
+                self.bpf[map_name].open_ring_buffer(callback)
+            if self.track_processes:
+                self.bpf[self.PROC_EVENTS_MAP_NAME].open_ring_buffer(self._process_proc_events)
+        else:
+            for map_name, callback in self._event_buffers():
+                self.bpf[map_name].open_perf_buffer(
+                    callback,
+                    page_cnt=self.perf_buffer_pages,
+                    lost_cb=self._lost_event_callback,
+                )
+            if self.track_processes:
+                self.bpf[self.PROC_EVENTS_MAP_NAME].open_perf_buffer(
+                    self._process_proc_events,
+                    page_cnt=self.perf_buffer_pages,
+                    lost_cb=self._lost_proc_events_callback,
+                )
+
+    def _adapt_perf_buffer(self):
+        """ Grow the event perf buffers if events have been lost for a sustained
+        period of time. To be invoked from the polling thread, as the buffer
+        has to be closed and reopened with the new size.
+        """
+        now = time.monotonic()
+        if now - self.loss_window_start < self.PERF_BUFFER_LOSS_WINDOW:
+            return
+        window_lost = self.lost_event_count - self.loss_window_count
+        self.loss_window_start = now
+        self.loss_window_count = self.lost_event_count
+        self.lossy_windows = self.lossy_windows + 1 if window_lost else 0
+        if self.lossy_windows < self.PERF_BUFFER_LOSSY_WINDOWS or self.perf_buffer_pages >= self.perf_buffer_max_pages:
+            return
+        self.lossy_windows = 0
+        self.perf_buffer_pages = min(2 * self.perf_buffer_pages, self.perf_buffer_max_pages)
+        logging.warning(
+            '[{}] Sustained event loss, growing perf buffer to {} pages'
+            .format(self.probe_name, self.perf_buffer_pages),
+        )
+        for map_name, callback in self._event_buffers():
+            events_table = self.bpf[map_name]
+            for cpu in range(len(events_table)):
+                del events_table[cpu]  # closes the per-CPU reader, if open
+            events_table.open_perf_buffer(
+                callback,
+                page_cnt=self.perf_buffer_pages,
+                lost_cb=self._lost_event_callback,
+            )
+
     def _poll_and_check_lost(self):
         """ Simple wrapper method which outputs lost event telemetry while polling """
-        self.bpf.perf_buffer_poll()
+        self._poll_events()
         self.lost_event_timer -= 1
         if self.lost_event_timer == 0:
             self.lost_event_timer = self.lost_event_telemetry
-            event = {'type': 'lost_event_telemetry', 'count': self.lost_event_count}
-            self._add_event_metadata(event)
-            self.output_queue.put(json.dumps(event))
+            if self.ring_buffer_pages:
+                self.lost_event_count = self._ring_buffer_lost_event_count()
+            event = {
+                'type': 'lost_event_telemetry',
+                'count': self.lost_event_count,
+                'transport_overflow': self.output_queue.overflow_count,
+                'buffer_type': 'ring' if self.ring_buffer_pages else 'perf',
+                'buffer_pages': self.ring_buffer_pages or self.perf_buffer_pages,
+            }
+            if self.enrichment_queues:
+                event['enrichment_dropped'] = self.enrichment_drop_count
+                event['enrichment_queue_depth'] = sum(queue.qsize() for queue in self.enrichment_queues)
+            self.output_queue.put(self.serializer.serialize_with_metadata(event))
+
+    def _read_filter_counters(self) -> Mapping[str, int]:
+        """ Read the filtering decision counters from kernel, summing them over all CPUs
+
+        :return: dictionary mapping counter name to its value, empty if the BPF program does not count
+        """
+        try:
+            table = self.bpf[self.FILTER_COUNTERS_MAP_NAME]
+        except KeyError:
+            return {}
+        return {
+            name: table.sum(table.Key(i)).value
+            for i, name in enumerate(self.FILTER_COUNTERS)
+        }
+
+    def _sync_metrics(self):
+        """ Copy into the probe metrics the totals tracked elsewhere """
+        if self.ring_buffer_pages:
+            self.lost_event_count = self._ring_buffer_lost_event_count()
+        self.metrics.set('events_lost_kernel', self.lost_event_count)
+        self.metrics.set('events_dropped_enrichment', self.enrichment_drop_count)
+        self.metrics.set('events_dropped_transport', self.output_queue.overflow_count)
+        for name, value in self._read_filter_counters().items():
+            self.metrics.set('kernel_' + name, value)
+
+    @never_crash
+    def _metrics_worker(self, telemetry_interval: float):
+        """ Handler function for the thread keeping metrics up to date,
+        and outputting them as telemetry records if enabled.
+
+        :param float telemetry_interval: seconds between telemetry records, 0 to disable
+        """
+        last_telemetry = time.monotonic()
+        while True:
+            time.sleep(min(self.METRICS_SYNC_INTERVAL, telemetry_interval or self.METRICS_SYNC_INTERVAL))
+            self._sync_metrics()
+            if telemetry_interval and time.monotonic() - last_telemetry >= telemetry_interval:
+                last_telemetry = time.monotonic()
+                self.output_queue.put(self.serializer.serialize_with_metadata(self.metrics.telemetry_record()))
+
+    def _process_proc_events(self, cpu: Any, data: Any, size: Any):
+        """ Process lifecycle event callback, keeps the process cache up to date
+
+        :param Any cpu: unused arg required for callback
+        :param Any data: BPF raw event
+        :param Any size: unused arg required for callback
+        """
+        event = self.bpf[self.PROC_EVENTS_MAP_NAME].event(data)
+        start_time = boot_ns_to_start_time(event.start_ns)
+        if event.type == self.PROC_EVENT_EXEC:
+            PROCESS_CACHE.track_exec(
+                ProcessInfo(
+                    pid=event.pid,
+                    ppid=event.ppid,
+                    start_time=start_time,
+                    cmdline=self._decode_proc_event_args(event),
+                    username=uid_to_username(event.uid),
+                ),
+            )
+        elif event.type == self.PROC_EVENT_FORK:
+            PROCESS_CACHE.track_fork(event.pid, event.ppid, start_time)
+        elif event.type == self.PROC_EVENT_EXIT:
+            PROCESS_CACHE.track_exit(event.pid, start_time)
+
+    @staticmethod
+    def _decode_proc_event_args(event: Any) -> str:
+        """ Extract command line from process exec event.
+        If the arguments did not fit the event buffer, try to read them from /proc.
+
+        :param Any event: BPF process lifecycle event
+        :return: command line string
+        """
+        buffer_size = type(event).args.size
+        raw_args = BPFProbe._read_char_array(event, 'args', min(event.args_size, buffer_size))
+        cmdline = raw_args.replace(b'\0', b' ').decode('utf8', errors='replace').strip()
+        if not cmdline or event.args_size > buffer_size:
+            try:
+                cmdline = ' '.join(psutil.Process(event.pid).cmdline()).strip()
+            except Exception:
+                pass
+        return cmdline
+
+    @staticmethod
+    def _read_char_array(event: Any, field_name: str, size: Optional[int] = None) -> bytes:
+        """ Read raw content of a char array field of a BPF event, as accessing
+        the attribute would make ctypes truncate the value at the first NUL byte.
+
+        :param Any event: BPF event
+        :param str field_name: name of the field
+        :param int size: (optional) number of bytes to read, defaults to field size
+        :return: field content
+        """
+        field = getattr(type(event), field_name)
+        return ctypes.string_at(ctypes.addressof(event) + field.offset, field.size if size is None else size)
+
+    def _lost_proc_events_callback(self, lost_count: int):
+        """ Lost process lifecycle events make tracking unreliable, so we reset it
+
+        :param int lost_count: number of events lost
+        """
+        logging.warning('[{}] Lost {} process events, resetting process tracking'.format(self.probe_name, lost_count))
+        PROCESS_CACHE.reset_tracking()
+
+    @never_crash
+    def _expire_exited_processes(self, grace_period: int):
+        """ Periodically stops tracking processes which exited
+
+        :param int grace_period: seconds after exit during which processes can still be looked up
+        """
+        while True:
+            time.sleep(max(1, grace_period // 2))
+            if self.ring_buffer_pages:
+                lost_count = self._ring_buffer_lost_count(self.PROC_EVENTS_MAP_NAME)
+                if lost_count > self.lost_proc_event_count:
+                    self._lost_proc_events_callback(lost_count - self.lost_proc_event_count)
+                    self.lost_proc_event_count = lost_count
+            PROCESS_CACHE.expire_exited(grace_period)
 
     @never_crash
     def _poll_config_changes(self, config_queue: SimpleQueue):
@@ -253,14 +715,53 @@ class BPFProbe:
         self.container_idns_mapping.update({mntns_info.container_id: mntns_info.ns_id for mntns_info in ns_infos})
 
     def reload_filters(self, is_init: bool = False):
-        """ Load filters
+        """ Load filters into the generation of filter maps not in use, and then switch to it,
+        so that the BPF program moves from the old to the new filters all at once.
+
+        Reloads needing more port bitmaps than the BPF program was compiled with are rejected,
+        leaving the filters in use untouched: a restart is needed to apply them.
 
         :param bool is_init: Indicate this is the first time loading
         """
         with self.net_filter_mutex:
+            port_bitmap_count = sum(map(needs_port_bitmap, self.net_filters))
+            if port_bitmap_count > self.net_filter_port_bitmaps:
+                if is_init:
+                    raise RuntimeError(
+                        '[{}] Network filters need {} port bitmaps, more than the maximum of {}'.format(
+                            self.probe_name, port_bitmap_count, self.NET_FILTER_PORT_BITMAPS_MAX,
+                        ),
+                    )
+                logging.error(
+                    '[{}] Network filters need {} port bitmaps, but the probe was started with room for {}: '
+                    'keeping the current filters, restart pidtree-bcc to apply the new ones'.format(
+                        self.probe_name, port_bitmap_count, self.net_filter_port_bitmaps,
+                    ),
+                )
+                return
             logging.info('[{}] {}oading filters into BPF maps'.format(self.probe_name, 'L' if is_init else 'Rel'))
-            load_filters_into_map(self.net_filters, self.bpf[self.NET_FILTER_MAP_NAME], not is_init)
-            load_port_filters_into_map(*self.global_filters, self.bpf[self.PORT_FILTER_MAP_NAME], not is_init)
+            start = time.perf_counter()
+            generation = 0 if is_init else 1 - self.filter_generation
+            load_filters_into_map(
+                self.net_filters,
+                self.bpf['{}_{}'.format(self.NET_FILTER_MAP_NAME, generation)],
+                do_diff=not is_init,
+                bitmap_map=(
+                    self.bpf['{}_port_bitmaps_{}'.format(self.NET_FILTER_MAP_NAME, generation)]
+                    if self.net_filter_port_bitmaps else None
+                ),
+                ipv6_map=self.bpf['{}_v6_{}'.format(self.NET_FILTER_MAP_NAME, generation)] if self.ipv6 else None,
+            )
+            port_filter_map = self.bpf['{}_{}'.format(self.PORT_FILTER_MAP_NAME, generation)]
+            if self.port_filter_bitmap:
+                load_port_bitmap_into_map(*self.global_filters, port_filter_map)
+            else:
+                load_port_filters_into_map(*self.global_filters, port_filter_map, overwrite=not is_init)
+            self.bpf[self.FILTER_GENERATION_MAP_NAME][ctypes.c_int(0)] = ctypes.c_uint32(generation)
+            self.filter_generation = generation
+            elapsed = time.perf_counter() - start
+            self.metrics.observe('filter_reload_seconds', elapsed)
+            logging.info('[{}] Filters loaded in {:.3f}s'.format(self.probe_name, elapsed))
 
     def start_polling(self):
         """ Start infinite loop polling BPF events """
@@ -276,19 +777,20 @@ class BPFProbe:
                 )
             ),
         )
+        header = self.serializer.header()
+        if header:
+            self.output_queue.put(header)
+        self.metrics.activate()
         for func, args in self.SIDECARS:
             Thread(target=func, args=args, daemon=True).start()
-        if self.lost_event_telemetry > 0:
-            extra_args = {'lost_cb': self._lost_event_callback}
-            poll_func = self._poll_and_check_lost
-        else:
-            extra_args = {}
-            poll_func = self.bpf.perf_buffer_poll
+        poll_func = self._poll_and_check_lost if self.lost_event_telemetry > 0 else self._poll_events
         if self.USES_DYNAMIC_FILTERS:
             self.reload_filters(is_init=True)
-        self.bpf['events'].open_perf_buffer(self._process_events, **extra_args)
+        self._open_event_buffers()
         while True:
             poll_func()
+            if self.perf_buffer_adaptive:
+                self._adapt_perf_buffer()
 
     def enrich_container_name(self, event: Any, formatted_event: dict) -> dict:
         """ Updates in place event dict with name of container related to the event """
@@ -296,6 +798,38 @@ class BPFProbe:
             formatted_event['container_name'] = self.container_name_mapping.get(event.mntns_id, '')
         return formatted_event
 
+    def kernel_process_tree(self, event: Any) -> Optional[List[dict]]:
+        """ Build process tree from the ancestry captured in kernel.
+        Command line and username are looked up in the process cache, falling back
+        to the process name when the process is gone. In "comm" mode, only the process
+        names captured in kernel are used, and usernames are left empty. If the ancestry was truncated because of
+        the maximum depth, the rest of the tree is crawled from userland.
+
+        :param Any event: BPF event
+        :return: process tree, None if the event does not carry ancestry information
+        """
+        ancestry_size = getattr(event, 'ancestry_size', 0) if self.kernel_ancestry_depth else 0
+        if not ancestry_size:
+            return None
+        result = []
+        info = None
+        comms = self._read_char_array(event, 'ancestry_comm')
+        for i in range(ancestry_size):
+            pid = event.ancestry_tgid[i]
+            comm = comms[i * self.TASK_COMM_LEN:(i + 1) * self.TASK_COMM_LEN]
+            comm = comm.split(b'\0', 1)[0].decode('utf8', errors='replace')
+            if self.kernel_ancestry_comm_only:
+                result.append({'pid': pid, 'cmdline': comm, 'username': ''})
+                continue
+            info = PROCESS_CACHE.lookup(pid, boot_ns_to_start_time(event.ancestry_start_ns[i]))
+            result.append(info.to_dict() if info else {'pid': pid, 'cmdline': comm, 'username': ''})
+        if info and info.ppid and ancestry_size == self.kernel_ancestry_depth:
+            try:
+                result.extend(proc.to_dict() for proc in PROCESS_CACHE.crawl(info.ppid))
+            except Exception as e:
+                logging.debug('Could not complete process tree for {}: {}'.format(info.pid, e))
+        return result
+
     def enrich_event(self, event: Any) -> dict:
         """ Transform raw BPF event data into dictionary,
         possibly adding more interesting data to it.
@@ -306,35 +840,80 @@ class BPFProbe:
 
     def validate_config(self, config: dict):
         """ Overridable method to implement config validation.
-        Should raise exceptions on errors.
+        Should raise exceptions on errors. Overriding methods should invoke this one too.
 
         :param dict config: probe configuration
         """
-        pass
+        ancestry_depth = config.get('kernel_ancestry_depth', 0)
+        if not isinstance(ancestry_depth, int) or not 0 <= ancestry_depth <= self.KERNEL_ANCESTRY_MAX_DEPTH:
+            raise RuntimeError(
+                'kernel_ancestry_depth must be an integer between 0 and {}'
+                .format(self.KERNEL_ANCESTRY_MAX_DEPTH),
+            )
+        for pages_key, default_pages in (
+            ('ring_buffer_pages', self.RING_BUFFER_PAGES_DEFAULT),
+            ('perf_buffer_pages', self.PERF_BUFFER_PAGES_DEFAULT),
+            ('perf_buffer_max_pages', self.PERF_BUFFER_MAX_PAGES_DEFAULT),
+        ):
+            pages = config.get(pages_key, default_pages)
+            if not isinstance(pages, int) or pages <= 0 or pages & (pages - 1):
+                raise RuntimeError('{} must be a positive power of 2'.format(pages_key))
+        perf_buffer_pages = config.get('perf_buffer_pages', self.PERF_BUFFER_PAGES_DEFAULT)
+        if perf_buffer_pages > config.get('perf_buffer_max_pages', self.PERF_BUFFER_MAX_PAGES_DEFAULT):
+            raise RuntimeError('perf_buffer_pages cannot be greater than perf_buffer_max_pages')
+        poll_timeout = config.get('poll_timeout_ms', self.POLL_TIMEOUT_MS_DEFAULT)
+        if not isinstance(poll_timeout, int) or poll_timeout < -1:
+            raise RuntimeError('poll_timeout_ms must be a non-negative integer, or -1 to wait indefinitely')
+        reannounce_interval = config.get('proctree_reannounce_interval', self.PROCTREE_REANNOUNCE_INTERVAL_DEFAULT)
+        if not isinstance(reannounce_interval, (int, float)) or reannounce_interval <= 0:
+            raise RuntimeError('proctree_reannounce_interval must be a positive number of seconds')
+        workers = config.get('enrichment_workers', 0)
+        if not isinstance(workers, int) or workers < 0:
+            raise RuntimeError('enrichment_workers must be a non-negative integer')
+        queue_size = config.get('enrichment_queue_size', self.ENRICHMENT_QUEUE_SIZE_DEFAULT)
+        if not isinstance(queue_size, int) or queue_size <= 0:
+            raise RuntimeError('enrichment_queue_size must be a positive integer')
+        ancestry_mode = config.get('kernel_ancestry_mode', 'full')
+        if ancestry_mode not in self.KERNEL_ANCESTRY_MODES:
+            raise RuntimeError(
+                '{} is not among supported kernel ancestry modes {}'
+                .format(ancestry_mode, self.KERNEL_ANCESTRY_MODES),
+            )
 
 
 def load_probes(
-    output_queue: SimpleQueue,
+    output_queue: Union[EventTransport, Callable[[], EventTransport]],
     extra_probe_path: str = None,
     extra_plugin_path: str = None,
     lost_event_telemetry: int = -1,
+    json_encoder: str = 'json',
+    output_format: str = 'json',
+    telemetry_interval: float = 0,
 ) -> Mapping[str, BPFProbe]:
     """ Find and load probe classes
 
     :param dict config: pidtree-bcc configuration
-    :param Queue output_queue: queue for event output
+    :param Union[EventTransport, Callable] output_queue: transport for event output, or factory
+                                                         method creating a transport for each probe
     :param str extra_probe_path: (optional) additional package path where to look for probes
     :param str extra_probe_path: (optional) additional package path where to look for plugins
     :param int lost_event_telemetry: (optional) every how many messages emit the number of lost messages.
+    :param str json_encoder: (optional) name of the JSON encoder used to serialize events
+    :param str output_format: (optional) event output format
+    :param float telemetry_interval: (optional) seconds between telemetry records, 0 to disable
     :return: dictionary mapping probe name to its instance
     """
     BPFProbe.EXTRA_PLUGIN_PATH = extra_plugin_path
+    BPFProbe.JSON_ENCODER = json_encoder
+    BPFProbe.OUTPUT_FORMAT = output_format
+    BPFProbe.TELEMETRY_INTERVAL = telemetry_interval
     packages = [p for p in (__package__, extra_probe_path) if p]
+    transport_factory = output_queue if callable(output_queue) else lambda: output_queue
     return {
         probe_name: find_subclass(
             ['{}.{}'.format(p, probe_name) for p in packages],
             BPFProbe,
-        )(output_queue, probe_config, lost_event_telemetry, conf_change_queue)
+        )(transport_factory(), probe_config, lost_event_telemetry, conf_change_queue)
         for probe_name, probe_config, conf_change_queue in enumerate_probe_configs()
         if not probe_name.startswith('_')
     }
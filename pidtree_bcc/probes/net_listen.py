@@ -12,9 +12,11 @@ from pidtree_bcc.filtering import NetFilter
 from pidtree_bcc.filtering import port_range_mapper
 from pidtree_bcc.probes import BPFProbe
 from pidtree_bcc.utils import crawl_process_tree
+from pidtree_bcc.utils import format_ip
 from pidtree_bcc.utils import get_network_namespace
-from pidtree_bcc.utils import int_to_ip
 from pidtree_bcc.utils import ip_to_int
+from pidtree_bcc.utils import ipv6_to_bytes
+from pidtree_bcc.utils import is_ipv6
 from pidtree_bcc.utils import never_crash
 
 
@@ -38,6 +40,7 @@ class NetListenProbe(BPFProbe):
         'snapshot_periodicity': False,
         'same_namespace_only': False,
         'exclude_random_bind': False,
+        'ipv6': False,
     }
     SUPPORTED_PROTOCOLS = ('udp', 'tcp')
     USES_DYNAMIC_FILTERS = True
@@ -70,6 +73,7 @@ class NetListenProbe(BPFProbe):
 
     def validate_config(self, config: dict):
         """ Checks if config values are valid """
+        super().validate_config(config)
         for proto in config.get('protocols', []):
             if proto not in self.SUPPORTED_PROTOCOLS:
                 raise RuntimeError(
@@ -85,7 +89,9 @@ class NetListenProbe(BPFProbe):
         """
         error = ''
         try:
-            proctree = crawl_process_tree(event.pid)
+            proctree = self.kernel_process_tree(event)
+            if proctree is None:
+                proctree = crawl_process_tree(event.pid)
         except Exception:
             error = traceback.format_exc()
             proctree = []
@@ -95,7 +101,7 @@ class NetListenProbe(BPFProbe):
                 'pid': event.pid,
                 'port': event.port,
                 'proctree': proctree,
-                'laddr': int_to_ip(event.laddr),
+                'laddr': format_ip(event.laddr),
                 'protocol': self.PROTO_MAP.get(event.protocol, 'unknown'),
                 'error': error,
             },
@@ -120,7 +126,7 @@ class NetListenProbe(BPFProbe):
         """
         time.sleep(300)  # sleep 5 minutes to avoid "noisy" restarts
         while True:
-            socket_stats = psutil.net_connections('inet4')
+            socket_stats = psutil.net_connections('inet' if self.ipv6 else 'inet4')
             for conn in socket_stats:
                 if not conn.pid:
                     # filter out entries without associated PID
@@ -131,7 +137,7 @@ class NetListenProbe(BPFProbe):
                     protocol = socket.IPPROTO_UDP
                 else:
                     protocol = None
-                ip_addr = ip_to_int(conn.laddr.ip)
+                ip_addr = ipv6_to_bytes(conn.laddr.ip) if is_ipv6(conn.laddr.ip) else ip_to_int(conn.laddr.ip)
                 if (
                     protocol
                     and not self.filtering.is_filtered(ip_addr, conn.laddr.port)
@@ -1,10 +1,16 @@
+import time
 import traceback
+from datetime import datetime
 from typing import Any
+from typing import Iterable
+from typing import Optional
+from typing import Tuple
 
 from pidtree_bcc.probes import BPFProbe
 from pidtree_bcc.utils import crawl_process_tree
-from pidtree_bcc.utils import int_to_ip
+from pidtree_bcc.utils import format_ip
 from pidtree_bcc.utils import ip_to_int
+from pidtree_bcc.utils import never_crash
 
 
 class TCPConnectProbe(BPFProbe):
@@ -15,8 +21,26 @@ class TCPConnectProbe(BPFProbe):
         'container_labels': [],
         'includeports': [],
         'excludeports': [],
+        'aggregate_interval': 0,
+        'aggregate_map_size': 10240,
+        'ipv6': False,
     }
     USES_DYNAMIC_FILTERS = True
+    AGGREGATE_MAP_NAME = 'connection_counts'
+    IPV6_AGGREGATE_MAP_NAME = 'connection_counts_v6'
+
+    def build_probe_config(self, probe_config: dict, hotswap_only: bool = False) -> dict:
+        config = super().build_probe_config(probe_config, hotswap_only=hotswap_only)
+        if not hotswap_only and config.get('aggregate_interval'):
+            self.SIDECARS.append((self._aggregation_worker, (config['aggregate_interval'],)))
+        return config
+
+    def validate_config(self, config: dict):
+        """ Checks if config values are valid """
+        super().validate_config(config)
+        aggregate_interval = config.get('aggregate_interval', 0)
+        if not isinstance(aggregate_interval, (int, float)) or aggregate_interval < 0:
+            raise RuntimeError('aggregate_interval must be a non-negative number of seconds')
 
     def enrich_event(self, event: Any) -> dict:
         """ Parses TCP connect event and adds process tree data
@@ -26,7 +50,9 @@ class TCPConnectProbe(BPFProbe):
         """
         error = ''
         try:
-            proctree = crawl_process_tree(event.pid)
+            proctree = self.kernel_process_tree(event)
+            if proctree is None:
+                proctree = crawl_process_tree(event.pid)
         except Exception:
             error = traceback.format_exc()
             proctree = []
@@ -37,11 +63,80 @@ class TCPConnectProbe(BPFProbe):
                 'proctree': proctree,
                 # We're turning a little-endian insigned long ('<L')
                 # representation of the destination address sent from the
-                # kernel to a python `int` and then turning that into a string
+                # kernel (or the 16 bytes of an IPv6 one) into a string
                 # representation of an IP address:
-                'daddr': int_to_ip(event.daddr),
-                'saddr': int_to_ip(event.saddr),
+                'daddr': format_ip(event.daddr),
+                'saddr': format_ip(event.saddr),
                 'port': event.dport,
                 'error': error,
             },
         )
+
+    def enrich_summary(self, key: Any, stats: Any) -> dict:
+        """ Parses connection counters aggregated in kernel and adds process tree data
+
+        :param Any key: BPF connection counters key
+        :param Any stats: BPF connection counters value
+        :return: summary event dictionary with process tree
+        """
+        error = ''
+        try:
+            proctree = crawl_process_tree(key.pid)
+        except Exception:
+            error = traceback.format_exc()
+            proctree = []
+        return self.enrich_container_name(
+            key,
+            {
+                'type': 'connection_summary',
+                'pid': key.pid,
+                'proctree': proctree,
+                'daddr': format_ip(key.daddr),
+                'saddr': format_ip(stats.saddr),
+                'port': key.dport,
+                'count': stats.count,
+                'first_seen': self._ktime_to_isoformat(stats.first_seen_ns),
+                'last_seen': self._ktime_to_isoformat(stats.last_seen_ns),
+                'error': error,
+            },
+        )
+
+    @staticmethod
+    def _ktime_to_isoformat(ktime_ns: int) -> str:
+        """ Convert kernel monotonic timestamp (as from `bpf_ktime_get_ns`) to ISO-format UTC time
+
+        :param int ktime_ns: nanoseconds on the monotonic clock
+        :return: ISO-format timestamp
+        """
+        elapsed = (time.clock_gettime_ns(time.CLOCK_MONOTONIC) - ktime_ns) / 10 ** 9
+        return datetime.utcfromtimestamp(time.time() - elapsed).isoformat() + 'Z'
+
+    def _drain_aggregation_map(self, map_name: Optional[str] = None) -> Iterable[Tuple[Any, Any]]:
+        """ Read and reset connection counters aggregated in kernel
+
+        :param str map_name: (optional) name of the counters map, defaults to the IPv4 one
+        :return: list of BPF key-value pairs
+        """
+        table = self.bpf[map_name or self.AGGREGATE_MAP_NAME]
+        try:
+            # atomic for each batch, available on kernel 5.6+
+            return list(table.items_lookup_and_delete_batch())
+        except Exception:
+            # increments between the read and the deletion go lost
+            items = list(table.items())
+            for key, _ in items:
+                del table[key]
+            return items
+
+    @never_crash
+    def _aggregation_worker(self, interval: int):
+        """ Handler function for the thread periodically outputting connection summaries
+
+        :param int interval: seconds between each drain of the counters
+        """
+        map_names = [self.AGGREGATE_MAP_NAME] + ([self.IPV6_AGGREGATE_MAP_NAME] if self.ipv6 else [])
+        while True:
+            time.sleep(interval)
+            for map_name in map_names:
+                for key, stats in self._drain_aggregation_map(map_name):
+                    self._output_event(self.enrich_summary(key, stats))
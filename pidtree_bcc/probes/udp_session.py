@@ -1,13 +1,20 @@
+import heapq
+import sys
 import time
 import traceback
 from collections import namedtuple
+from itertools import count
 from threading import Lock
 from typing import Any
+from typing import List
+from typing import Optional
+from typing import Tuple
 from typing import Union
 
+from pidtree_bcc.filtering import read_map_items
 from pidtree_bcc.probes import BPFProbe
 from pidtree_bcc.utils import crawl_process_tree
-from pidtree_bcc.utils import int_to_ip
+from pidtree_bcc.utils import format_ip
 from pidtree_bcc.utils import ip_to_int
 from pidtree_bcc.utils import never_crash
 
@@ -15,6 +22,35 @@ from pidtree_bcc.utils import never_crash
 SessionEventWrapper = namedtuple('SessionEndEvent', ('type', 'sock_pointer'))
 
 
+class UDPDestination:
+    """ Tracking data for a destination of a UDP session """
+
+    __slots__ = ('first_seen', 'msg_count', 'counted')
+
+    def __init__(self, first_seen: float, counted: int):
+        """ Constructor
+
+        :param float first_seen: monotonic time of the first message
+        :param int counted: whether messages are counted in kernel, rather than here
+        """
+        self.first_seen = first_seen
+        self.msg_count = 0 if counted else 1
+        self.counted = bool(counted)
+
+
+class UDPSession:
+    """ Tracking data for a UDP session """
+
+    __slots__ = ('pid', 'proctree', 'error', 'last_update', 'destinations')
+
+    def __init__(self, pid: int, proctree: list, error: str, last_update: float):
+        self.pid = pid
+        self.proctree = proctree
+        self.error = error
+        self.last_update = last_update
+        self.destinations = {}  # (daddr, dport) -> UDPDestination, see `_destination_key`
+
+
 class UDPSessionProbe(BPFProbe):
 
     CONFIG_DEFAULTS = {
@@ -23,9 +59,16 @@ class UDPSessionProbe(BPFProbe):
         'container_labels': [],
         'includeports': [],
         'excludeports': [],
+        'destination_map_size': 16384,
+        'ipv6': False,
     }
     USES_DYNAMIC_FILTERS = True
+    DESTINATION_MAP_NAME = 'destination_counts'
+    IPV6_DESTINATION_MAP_NAME = 'destination_counts_v6'
+    TRACING_MAP_NAME = 'tracing'
     SESSION_MAX_DURATION_DEFAULT = 120
+    SESSION_EXPIRED_ERROR = 'session_max_duration_exceeded'
+    EXPIRATION_BATCH_SIZE = 1000
     SESSION_START = 1
     SESSION_CONTINUE = 2
     SESSION_END = 3
@@ -34,6 +77,9 @@ class UDPSessionProbe(BPFProbe):
         config = super().build_probe_config(probe_config, hotswap_only=hotswap_only)
         if not hotswap_only:
             self.session_tracking = {}
+            # min-heap of (last update, sequence, sock pointer, session)
+            self.session_expiry = []
+            self.session_sequence = count()
             self.thread_lock = Lock()
             self.SIDECARS.append((
                 self._session_expiration_worker,
@@ -41,6 +87,10 @@ class UDPSessionProbe(BPFProbe):
             ))
         return config
 
+    def _enrichment_shard_key(self, event: Any) -> int:
+        """ Session events are tracked by socket, which may be shared by multiple processes """
+        return event.sock_pointer
+
     def enrich_event(self, event: Any) -> Union[dict, None]:
         """ Parses UDP session event and adds process tree data
 
@@ -57,56 +107,233 @@ class UDPSessionProbe(BPFProbe):
         if event.type == self.SESSION_START:
             try:
                 error = ''
-                proctree = crawl_process_tree(event.pid)
+                proctree = self.kernel_process_tree(event)
+                if proctree is None:
+                    proctree = crawl_process_tree(event.pid)
             except Exception:
                 error = traceback.format_exc()
                 proctree = []
-            self.session_tracking[sock_key] = {
-                'pid': event.pid,
-                'proctree': proctree,
-                'destinations': {(event.daddr, event.dport): [now, 1]},
-                'error': error,
-                'last_update': now,
-            }
+            session = UDPSession(event.pid, proctree, error, now)
+            session.destinations[self._destination_key(event)] = UDPDestination(now, event.counted)
+            self.session_tracking[sock_key] = session
+            heapq.heappush(self.session_expiry, (now, next(self.session_sequence), sock_key, session))
         elif sock_key in self.session_tracking:
             if event.type == self.SESSION_CONTINUE:
-                dest_key = (event.daddr, event.dport)
-                session_data = self.session_tracking[sock_key]
-                if dest_key not in session_data['destinations']:
-                    session_data['destinations'][dest_key] = [now, 1]
+                dest_key = self._destination_key(event)
+                session = self.session_tracking[sock_key]
+                destination = session.destinations.get(dest_key)
+                if destination is None:
+                    session.destinations[dest_key] = UDPDestination(now, event.counted)
+                elif event.counted:
+                    destination.counted = True
                 else:
-                    session_data['destinations'][dest_key][1] += 1
-                session_data['last_update'] = now
+                    destination.msg_count += 1
+                # the expiry queue entry is refreshed lazily, when it comes due
+                session.last_update = now
             else:
-                session_data = self.session_tracking.pop(sock_key)
-                session_data.pop('last_update')
-                session_data['destinations'] = [
+                session = self.session_tracking.pop(sock_key)
+                destinations = []
+                for (daddr, dport), destination in session.destinations.items():
+                    first_seen, msg_count = destination.first_seen, destination.msg_count
+                    kernel_counters = (
+                        self._pop_destination_counters(sock_key, daddr, dport)
+                        if destination.counted
+                        else None
+                    )
+                    if kernel_counters:
+                        first_seen = min(first_seen, kernel_counters[0])
+                        msg_count += kernel_counters[1]
+                    destinations.append({
+                        'daddr': format_ip(daddr),
+                        'port': dport,
+                        'duration': now - first_seen,
+                        'msg_count': msg_count,
+                    })
+                if session.error == self.SESSION_EXPIRED_ERROR:
+                    # let the kernel start a new session on further traffic from the socket
+                    self._stop_kernel_tracing(sock_key)
+                return self.enrich_container_name(
+                    event,
                     {
-                        'daddr': int_to_ip(addr_port[0]),
-                        'port': addr_port[1],
-                        'duration': now - begin_count[0],
-                        'msg_count': begin_count[1],
-                    }
-                    for addr_port, begin_count in session_data['destinations'].items()
-                ]
-                return self.enrich_container_name(event, session_data)
+                        'pid': session.pid,
+                        'proctree': session.proctree,
+                        'destinations': destinations,
+                        'error': session.error,
+                    },
+                )
+
+    @staticmethod
+    def _destination_key(event: Any) -> Tuple[Union[int, bytes], int]:
+        """ Session destination tracking key of an event. IPv6 addresses are copied
+        out of the event, as ctypes arrays are neither hashable nor safe to keep around.
+
+        :param Any event: BPF event
+        :return: destination address and port
+        """
+        daddr = event.daddr
+        return (daddr if isinstance(daddr, int) else bytes(daddr)), event.dport
+
+    def _destination_counters_key(self, sock_pointer: int, daddr: Union[int, bytes], dport: int) -> Tuple[Any, Any]:
+        """ Locate the kernel message counters of a session destination
+
+        :param int sock_pointer: socket address
+        :param Union[int, bytes] daddr: destination address, integer encoded IPv4 or packed IPv6
+        :param int dport: destination port
+        :return: BPF table and key
+        """
+        if isinstance(daddr, bytes):
+            table = self.bpf[self.IPV6_DESTINATION_MAP_NAME]
+            key = table.Key(sock_pointer=sock_pointer, dport=dport)
+            key.daddr[:] = daddr
+        else:
+            table = self.bpf[self.DESTINATION_MAP_NAME]
+            key = table.Key(sock_pointer=sock_pointer, daddr=daddr, dport=dport)
+        return table, key
+
+    def _pop_destination_counters(
+        self,
+        sock_pointer: int,
+        daddr: Union[int, bytes],
+        dport: int,
+    ) -> Optional[Tuple[float, int]]:
+        """ Read and remove message counters accumulated in kernel for a session destination
+
+        :param int sock_pointer: socket address
+        :param Union[int, bytes] daddr: destination address, integer encoded IPv4 or packed IPv6
+        :param int dport: destination port
+        :return: first seen monotonic time and message count, None if not found
+        """
+        table, key = self._destination_counters_key(sock_pointer, daddr, dport)
+        try:
+            stats = table[key]
+            del table[key]
+        except KeyError:
+            return None
+        # bpf_ktime_get_ns uses the same clock as time.monotonic
+        return stats.first_seen_ns / 10 ** 9, stats.count
+
+    def _kernel_last_seen(self, sock_pointer: int, session: UDPSession) -> float:
+        """ Latest message time of a session according to the kernel counters.
+        Messages to destinations already counted in kernel generate no events,
+        so `UDPSession.last_update` alone does not tell whether the session is idle.
+
+        :param int sock_pointer: socket address
+        :param UDPSession session: session data
+        :return: monotonic time of the last counted message, 0 if unknown
+        """
+        last_seen = 0
+        for (daddr, dport), destination in session.destinations.items():
+            if not destination.counted:
+                continue
+            table, key = self._destination_counters_key(sock_pointer, daddr, dport)
+            try:
+                last_seen = max(last_seen, table[key].last_seen_ns / 10 ** 9)
+            except KeyError:
+                pass
+        return last_seen
+
+    def _stop_kernel_tracing(self, sock_pointer: int):
+        """ Remove socket from the sessions traced in kernel
+
+        :param int sock_pointer: socket address
+        """
+        table = self.bpf[self.TRACING_MAP_NAME]
+        try:
+            del table[table.Key(sock_pointer)]
+        except KeyError:
+            pass  # socket was released in the meantime
+
+    def _pop_expired_sessions(self, deadline: float) -> List[int]:
+        """ Remove from the expiry queue sessions last updated before the deadline,
+        also taking into account messages only counted in kernel. Only entries which came due
+        are looked at, and the lock is released every `EXPIRATION_BATCH_SIZE` of them, so that
+        event enrichment is never blocked for long.
+
+        :param float deadline: monotonic time before which sessions are considered expired
+        :return: list of socket pointers of expired sessions
+        """
+        expired = []
+        done = False
+        while not done:
+            with self.thread_lock:
+                for _ in range(self.EXPIRATION_BATCH_SIZE):
+                    if not self.session_expiry or self.session_expiry[0][0] > deadline:
+                        done = True
+                        break
+                    _, _, sock_pointer, session = heapq.heappop(self.session_expiry)
+                    if self.session_tracking.get(sock_pointer) is not session:
+                        continue  # session already ended
+                    if session.last_update <= deadline:
+                        session.last_update = max(session.last_update, self._kernel_last_seen(sock_pointer, session))
+                    if session.last_update > deadline:
+                        heapq.heappush(
+                            self.session_expiry,
+                            (session.last_update, next(self.session_sequence), sock_pointer, session),
+                        )
+                        continue
+                    session.error = self.SESSION_EXPIRED_ERROR
+                    expired.append(sock_pointer)
+        return expired
+
+    def _sweep_destination_counters(self, deadline: float) -> int:
+        """ Remove kernel message counters of sockets without a session tracked here, idle since
+        before the deadline. They are otherwise left behind whenever the end of a session is never
+        handled (e.g. lost events, or sessions started before the probe), and would fill up the map.
+
+        :param float deadline: monotonic time before which counters are considered stale
+        :return: number of counters removed
+        """
+        with self.thread_lock:
+            tracked = set(self.session_tracking)
+        map_names = [self.DESTINATION_MAP_NAME]
+        if self.ipv6:
+            map_names.append(self.IPV6_DESTINATION_MAP_NAME)
+        removed = 0
+        for map_name in map_names:
+            table = self.bpf[map_name]
+            for key, stats in read_map_items(table):
+                if key.sock_pointer in tracked or stats.last_seen_ns / 10 ** 9 > deadline:
+                    continue
+                try:
+                    del table[key]
+                    removed += 1
+                except KeyError:
+                    pass  # removed by a session ending in the meantime
+        return removed
+
+    def session_memory_footprint(self) -> dict:
+        """ Estimate memory used for tracking UDP sessions
+
+        :return: dictionary with number of sessions and approximate size in bytes
+        """
+        with self.thread_lock:
+            sessions = list(self.session_tracking.values())
+            size = sys.getsizeof(self.session_tracking) + sys.getsizeof(self.session_expiry)
+            size += sum(sys.getsizeof(entry) for entry in self.session_expiry)
+        for session in sessions:
+            size += sys.getsizeof(session) + sys.getsizeof(session.destinations)
+            size += sum(
+                sys.getsizeof(dest_key) + sys.getsizeof(destination)
+                for dest_key, destination in session.destinations.items()
+            )
+        return {
+            'sessions': len(sessions),
+            'bytes': size,
+            'bytes_per_session': size // len(sessions) if sessions else 0,
+        }
 
     @never_crash
     def _session_expiration_worker(self, session_max_duration: int):
         """ Handler function for session expiration thread.
-        Removes from tracking sessions older than the specified max duration
+        Removes from tracking sessions older than the specified max duration,
+        as well as stale kernel message counters
 
         :param int session_max_duration: max session duration in seconds
         """
         while True:
             time.sleep(session_max_duration)
-            expired = []
-            now = time.monotonic()
-            with self.thread_lock:
-                for sock_pointer, session_data in self.session_tracking.items():
-                    if now - session_data['last_update'] > session_max_duration:
-                        session_data['error'] = 'session_max_duration_exceeded'
-                        expired.append(sock_pointer)
-            for sock_pointer in expired:
+            deadline = time.monotonic() - session_max_duration
+            for sock_pointer in self._pop_expired_sessions(deadline):
                 end_event = SessionEventWrapper(self.SESSION_END, sock_pointer)
                 self._process_events(None, end_event, None, False)
+            self._sweep_destination_counters(deadline)
@@ -0,0 +1,364 @@
+import os
+import pwd
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from threading import Lock
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+
+import psutil
+
+
+ProcessKey = Tuple[int, float]
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+BOOT_TIME = psutil.boot_time()  # psutil reads /proc/stat again on every call
+
+
+class ProcessDict(dict):
+    """ Process tree entry, also carrying the process start time (not part of the entry itself) """
+    __slots__ = ('start_time',)
+
+
+class ProcessInfo(NamedTuple):
+    pid: int
+    ppid: int
+    start_time: float
+    cmdline: str
+    username: str
+
+    @property
+    def key(self) -> ProcessKey:
+        return self.pid, self.start_time
+
+    def to_dict(self) -> dict:
+        """ Format process information as it appears in event process trees """
+        proc = ProcessDict(
+            pid=self.pid,
+            cmdline=self.cmdline,
+            username=self.username,
+        )
+        proc.start_time = self.start_time
+        return proc
+
+
+def boot_ns_to_start_time(start_ns: int) -> float:
+    """ Convert task start time as tracked by the kernel (nanoseconds since boot)
+    to the same value `psutil.Process.create_time()` would return.
+
+    :param int start_ns: nanoseconds between boot and process creation
+    :return: process creation timestamp
+    """
+    ticks = start_ns // (10 ** 9 // CLOCK_TICKS)
+    return ticks / CLOCK_TICKS + BOOT_TIME
+
+
+@lru_cache(maxsize=1024)
+def uid_to_username(uid: int) -> str:
+    """ Resolve user name in the same way psutil does, falling back to the UID
+
+    :param int uid: user ID
+    :return: user name
+    """
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return str(uid)
+
+
+class ProcessTreeCache:
+    """ LRU cache of process information, used to avoid crawling /proc
+    for ancestors shared among many events (e.g. a build system spawning
+    thousands of short lived children).
+
+    Entries are keyed by (pid, start_time), so that PID reuse cannot cause
+    stale data to be returned. Each entry also remembers the key of the parent
+    it was observed with, so that once an ancestor is found in cache, the rest
+    of the chain can be resolved without touching /proc at all.
+
+    Since exec keeps both PID and start time, entries read from /proc are only
+    trusted for `max_age` seconds, and the command line of the process at the
+    bottom of a crawled tree is always checked against /proc.
+
+    The cache can optionally be kept up to date by process lifecycle events
+    (fork, exec, exit) coming from the kernel. Processes tracked this way are
+    indexed by PID, and can be looked up without reading /proc, also for a grace
+    period after they exit.
+    """
+
+    DEFAULT_MAX_SIZE = 8192
+    DEFAULT_MAX_AGE = 60  # seconds
+
+    def __init__(self, max_size: int = DEFAULT_MAX_SIZE, max_age: float = DEFAULT_MAX_AGE):
+        """ Constructor
+
+        :param int max_size: maximum number of processes held in cache
+        :param float max_age: seconds for which processes read from /proc are trusted to not have exec'd
+        """
+        self.max_size = max_size
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # ProcessKey -> (ProcessInfo, parent ProcessKey)
+        self._live = {}  # pid -> ProcessKey, for processes tracked via lifecycle events
+        self._exited = OrderedDict()  # ProcessKey -> exit timestamp
+        self._read_times = {}  # ProcessKey -> monotonic time, for entries read from /proc
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def crawl(self, pid: int) -> List[ProcessInfo]:
+        """ Get process ancestry, from the process itself up to the one with ppid 0
+
+        :param int pid: child process ID
+        :return: list of process information navigating up the tree
+        """
+        result = []
+        child_key = None
+        while pid != 0:
+            cached = self._get_tracked(pid)
+            if cached is None:
+                proc = psutil.Process(pid)
+                key = (pid, proc.create_time())
+                cached = self._get(key)
+                if cached is not None and child_key is None and self._has_exec_since(proc, cached[0]):
+                    cached = None
+            else:
+                key = cached[0].key
+            if child_key is not None:
+                self._link(child_key, key)
+            if cached is None:
+                info = self._read_proc(proc, key[1])
+                result.append(info)
+                child_key = key
+                pid = info.ppid
+                continue
+            # cache hit: follow the chain of known parents as far as it goes
+            info, parent_key = cached
+            result.append(info)
+            while parent_key is not None:
+                cached = self._get(parent_key, count_miss=False)
+                if cached is None:
+                    break
+                info, parent_key = cached
+                result.append(info)
+            child_key = info.key
+            pid = info.ppid
+        return result
+
+    def lookup(self, pid: int, start_time: Optional[float] = None) -> Optional[ProcessInfo]:
+        """ Get information for a single process
+
+        :param int pid: process ID
+        :param float start_time: (optional) process creation timestamp, if known
+                                 it is used to make sure the PID was not reused
+        :return: process information, None if the process is not found
+        """
+        if start_time is not None:
+            cached = self._get((pid, start_time), count_miss=False)
+        else:
+            cached = self._get_tracked(pid)
+        if cached is not None:
+            return cached[0]
+        try:
+            proc = psutil.Process(pid)
+            key = (pid, proc.create_time())
+            if start_time is not None and abs(key[1] - start_time) >= 1 / CLOCK_TICKS:
+                # PID was reused by a different process
+                return None
+            cached = self._get(key)
+            return cached[0] if cached is not None else self._read_proc(proc, key[1])
+        except psutil.Error:
+            return None
+
+    def _has_exec_since(self, proc: psutil.Process, info: ProcessInfo) -> bool:
+        """ Check if the process executed a different program since it was cached
+
+        :param psutil.Process proc: process
+        :param ProcessInfo info: cached process information
+        :return: True if the command line changed
+        """
+        if ' '.join(proc.cmdline()).strip() == info.cmdline:
+            return False
+        self._discard(info.key)
+        return True
+
+    def track_exec(self, info: ProcessInfo):
+        """ Record process information for a newly executed program
+
+        :param ProcessInfo info: process information
+        """
+        with self._lock:
+            parent_key = self._live.get(info.ppid)
+            if parent_key is None and info.key in self._entries:
+                # exec does not change the parent, keep what we already knew
+                parent_key = self._entries[info.key][1]
+            self._insert(info, parent_key)
+            self._live[info.pid] = info.key
+            self._exited.pop(info.key, None)
+
+    def track_fork(self, pid: int, ppid: int, start_time: float):
+        """ Record a new process, inheriting command line and user from its parent.
+        Forks of processes which are not tracked are ignored, as there is no
+        information to inherit: they will be resolved from /proc when needed.
+        Any process previously tracked with the same PID is forgotten though.
+
+        :param int pid: process ID
+        :param int ppid: parent process ID
+        :param float start_time: process creation timestamp
+        """
+        with self._lock:
+            parent_key = self._live.get(ppid)
+            parent_entry = self._entries.get(parent_key) if parent_key else None
+            if parent_entry is None:
+                # PID was reused, the previous process must not be looked up anymore
+                self._live.pop(pid, None)
+                return
+            parent = parent_entry[0]
+            info = ProcessInfo(pid, ppid, start_time, parent.cmdline, parent.username)
+            self._insert(info, parent_key)
+            self._live[pid] = info.key
+            self._exited.pop(info.key, None)
+
+    def track_exit(self, pid: int, start_time: float):
+        """ Mark process as exited, it will still be tracked until `expire_exited` is called.
+
+        :param int pid: process ID
+        :param float start_time: process creation timestamp
+        """
+        with self._lock:
+            if self._live.get(pid) == (pid, start_time):
+                self._exited[(pid, start_time)] = time.monotonic()
+
+    def expire_exited(self, grace_period: float):
+        """ Stop tracking processes which exited more than `grace_period` seconds ago.
+        Their information is left in cache, but they won't be looked up by PID anymore.
+
+        :param float grace_period: seconds after exit during which processes are tracked
+        """
+        deadline = time.monotonic() - grace_period
+        with self._lock:
+            while self._exited:
+                key, exit_time = next(iter(self._exited.items()))
+                if exit_time > deadline:
+                    break
+                self._exited.popitem(last=False)
+                if self._live.get(key[0]) == key:
+                    del self._live[key[0]]
+
+    def reset_tracking(self):
+        """ Stop tracking all processes, to be used when lifecycle events are lost
+        and the tracking state may no longer be coherent.
+        """
+        with self._lock:
+            # entries of formerly tracked processes are no longer kept up to date
+            now = time.monotonic()
+            for key in self._live.values():
+                if key in self._entries:
+                    self._read_times[key] = now
+            self._live.clear()
+            self._exited.clear()
+
+    def stats(self) -> dict:
+        """ Cache usage statistics
+
+        :return: dictionary with hit/miss counters and current size
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+            'tracked': len(self._live),
+        }
+
+    def clear(self):
+        """ Drop all entries and reset counters """
+        with self._lock:
+            self._entries.clear()
+            self._live.clear()
+            self._exited.clear()
+            self._read_times.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def _get_tracked(self, pid: int) -> Optional[Tuple[ProcessInfo, Optional[ProcessKey]]]:
+        with self._lock:
+            key = self._live.get(pid)
+            if key is None:
+                return None
+            entry = self._entries.get(key)
+            if entry is None:
+                # evicted from cache, no point in tracking it anymore
+                del self._live[pid]
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry
+
+    def _get(
+        self,
+        key: ProcessKey,
+        count_miss: bool = True,
+    ) -> Optional[Tuple[ProcessInfo, Optional[ProcessKey]]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            read_time = self._read_times.get(key)
+            if (
+                entry is not None
+                and read_time is not None
+                and time.monotonic() - read_time > self.max_age
+            ):
+                # may have exec'd since, and lifecycle events are not there to tell
+                self._remove(key)
+                entry = None
+            if entry is None:
+                if count_miss:
+                    self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry
+
+    def _read_proc(self, proc: psutil.Process, start_time: float) -> ProcessInfo:
+        """ Read process information from /proc and store it in cache """
+        with proc.oneshot():
+            info = ProcessInfo(
+                pid=proc.pid,
+                ppid=proc.ppid(),
+                start_time=start_time,
+                cmdline=' '.join(proc.cmdline()).strip(),
+                username=proc.username(),
+            )
+        self._put(info)
+        return info
+
+    def _put(self, info: ProcessInfo):
+        with self._lock:
+            self._insert(info, None)
+            self._read_times[info.key] = time.monotonic()
+
+    def _insert(self, info: ProcessInfo, parent_key: Optional[ProcessKey]):
+        """ Insert entry in cache, evicting the least recently used ones if needed (lock must be held) """
+        self._entries[info.key] = (info, parent_key)
+        self._entries.move_to_end(info.key)
+        self._read_times.pop(info.key, None)
+        while len(self._entries) > self.max_size:
+            self._read_times.pop(self._entries.popitem(last=False)[0], None)
+
+    def _discard(self, key: ProcessKey):
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key: ProcessKey):
+        """ Remove entry from cache (lock must be held) """
+        self._entries.pop(key, None)
+        self._read_times.pop(key, None)
+
+    def _link(self, child_key: ProcessKey, parent_key: ProcessKey):
+        with self._lock:
+            entry = self._entries.get(child_key)
+            if entry is not None:
+                self._entries[child_key] = (entry[0], parent_key)
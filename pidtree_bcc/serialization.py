@@ -0,0 +1,291 @@
+import json
+import struct
+import time
+from collections import OrderedDict
+from itertools import count
+from threading import Lock
+from typing import Callable
+from typing import Hashable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+OUTPUT_FORMATS = ('json', 'msgpack')
+
+
+class JSONEncoder(NamedTuple):
+    encode: Callable[[dict], str]
+    item_separator: str
+
+
+def _orjson_encode(obj: dict) -> str:
+    return orjson.dumps(obj).decode()
+
+
+# The stdlib encoder is the default, as it produces the canonical output format.
+# Faster encoders produce equivalent, but more compact, JSON (no whitespace between items,
+# non-ASCII characters not escaped), so they need to be opted into explicitly.
+JSON_ENCODERS = {
+    'json': JSONEncoder(json.JSONEncoder().encode, ', '),
+    'orjson': JSONEncoder(_orjson_encode, ','),
+}
+
+
+def get_json_encoder(name: str) -> JSONEncoder:
+    """ Get JSON encoder by name
+
+    :param str name: encoder name
+    :return: encoder
+    """
+    if name not in JSON_ENCODERS:
+        raise RuntimeError('{} is not among supported JSON encoders {}'.format(name, tuple(JSON_ENCODERS)))
+    if name == 'orjson' and orjson is None:
+        raise RuntimeError('orjson JSON encoder selected, but the module is not installed')
+    return JSON_ENCODERS[name]
+
+
+class TimestampFormatter:
+    """ Formats current UTC time exactly as `datetime.utcnow().isoformat() + 'Z'` would.
+    The date and time part is cached, so that it is only computed once per second.
+    """
+
+    def __init__(self):
+        # (second, formatted prefix), swapped as a whole as it is used from multiple threads
+        self._cached = (None, '')
+
+    def __call__(self) -> str:
+        second, nanos = divmod(time.time_ns(), 10 ** 9)
+        cached_second, prefix = self._cached
+        if second != cached_second:
+            prefix = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(second))
+            self._cached = (second, prefix)
+        micros = nanos // 1000
+        return '{}.{:06d}Z'.format(prefix, micros) if micros else prefix + 'Z'
+
+
+class EventSerializer:
+    """ Serializes events of a probe, adding the timestamp and probe name metadata.
+
+    As metadata fields always come last, they are appended to the encoded event as
+    pre-encoded text, rather than going through the encoder every time.
+    """
+
+    TIMESTAMP_PLACEHOLDER = '@TIMESTAMP@'
+
+    def __init__(self, probe_name: str, encoder: str = 'json'):
+        """ Constructor
+
+        :param str probe_name: name of the probe generating the events
+        :param str encoder: name of the JSON encoder to use
+        """
+        self.probe_name = probe_name
+        self.encode, item_separator = get_json_encoder(encoder)
+        self.timestamp = TimestampFormatter()
+        metadata = self.encode({'timestamp': self.TIMESTAMP_PLACEHOLDER, 'probe': probe_name})
+        self._metadata_head, self._metadata_tail = metadata[1:].split(self.TIMESTAMP_PLACEHOLDER)
+        self._separated_metadata_head = item_separator + self._metadata_head
+
+    def add_metadata(self, event: dict):
+        """ Adds probe name and current ISO-format timestamp to event dictionary (in place)
+
+        :param dict event: event dictionary
+        """
+        event['timestamp'] = self.timestamp()
+        event['probe'] = self.probe_name
+
+    def serialize_with_metadata(self, event: dict) -> str:
+        """ Serialize event, adding metadata to it.
+        Equivalent to calling `add_metadata` and then `encode`, without modifying the event.
+
+        :param dict event: event dictionary
+        :return: serialized event
+        """
+        if 'timestamp' in event or 'probe' in event:
+            event = event.copy()
+            self.add_metadata(event)
+            return self.encode(event)
+        body = self.encode(event)
+        if body == '{}':
+            return '{' + self._metadata_head + self.timestamp() + self._metadata_tail
+        return body[:-1] + self._separated_metadata_head + self.timestamp() + self._metadata_tail
+
+    def header(self) -> Optional[Union[str, bytes]]:
+        """ Record to be output before any event of the probe, if the format requires one """
+        return None
+
+
+class MsgpackEventSerializer(EventSerializer):
+    """ Serializes events as length-prefixed msgpack frames.
+
+    Each frame is a 4 bytes big-endian payload length, followed by the msgpack payload.
+    Events have the same fields as in JSON format, except for process tree entries,
+    which are encoded as arrays rather than maps. The array fields are described by
+    a schema record, output by each probe before any of its events. Any other field of
+    a process, e.g. added by plugins, is appended to its array as a trailing map.
+    """
+
+    FORMAT_VERSION = 1
+    FRAME_HEADER = struct.Struct('>I')
+    PROCTREE_FIELDS = ('pid', 'cmdline', 'username')
+
+    def __init__(self, probe_name: str):
+        """ Constructor
+
+        :param str probe_name: name of the probe generating the events
+        """
+        if msgpack is None:
+            raise RuntimeError('msgpack output format selected, but the module is not installed')
+        self.probe_name = probe_name
+        self.timestamp = TimestampFormatter()
+
+    def encode(self, event: dict) -> bytes:
+        """ Encode event as msgpack frame
+
+        :param dict event: event dictionary
+        :return: msgpack frame
+        """
+        if 'proctree' in event:
+            event = event.copy()
+            event['proctree'] = [self._encode_process(proc) for proc in event['proctree']]
+        payload = msgpack.packb(event)
+        return self.FRAME_HEADER.pack(len(payload)) + payload
+
+    def _encode_process(self, proc: dict) -> list:
+        """ Encode process tree entry as array of the schema fields, plus a map of any other field
+
+        :param dict proc: process tree entry
+        :return: process array
+        """
+        encoded = [proc.get(field) for field in self.PROCTREE_FIELDS]
+        extra = {key: value for key, value in proc.items() if key not in self.PROCTREE_FIELDS}
+        if extra:
+            encoded.append(extra)
+        return encoded
+
+    def serialize_with_metadata(self, event: dict) -> bytes:
+        event = event.copy()
+        self.add_metadata(event)
+        return self.encode(event)
+
+    def header(self) -> bytes:
+        return self.encode({
+            'type': 'schema',
+            'probe': self.probe_name,
+            'format_version': self.FORMAT_VERSION,
+            'proctree_fields': list(self.PROCTREE_FIELDS),
+        })
+
+
+class ProcessInterner:
+    """ Replaces process trees in events with references to process records.
+
+    The first time a process, identified by PID and start time, appears in a process tree,
+    a `process` record with its information is emitted, and the process gets assigned a
+    numeric ID, unique within the probe. Events then only list the IDs of their ancestors.
+    Records are emitted again when referenced after `reannounce_interval` seconds from the
+    last time, so that consumers starting to read the output midway can catch up.
+    The least recently referenced processes are forgotten past `max_size` entries, and get
+    a new ID if they show up again. Process trees with unhashable information for processes
+    lacking a start time (e.g. lists added by plugins) are left as they are.
+    """
+
+    DEFAULT_REANNOUNCE_INTERVAL = 600  # seconds
+    DEFAULT_MAX_SIZE = 16384
+
+    def __init__(self, reannounce_interval: float = DEFAULT_REANNOUNCE_INTERVAL, max_size: int = DEFAULT_MAX_SIZE):
+        """ Constructor
+
+        :param float reannounce_interval: minimum seconds between records of the same process
+        :param int max_size: maximum number of processes remembered
+        """
+        self.reannounce_interval = reannounce_interval
+        self.max_size = max_size
+        self._processes = OrderedDict()  # key -> [id, last announcement time]
+        self._ids = count(1)
+        self._lock = Lock()
+
+    @staticmethod
+    def _process_key(proc: dict) -> Hashable:
+        """ Identify process tree entry, by PID and start time when available (see `ProcessDict`),
+        and by all of its information otherwise.
+        """
+        start_time = getattr(proc, 'start_time', None)
+        return (proc.get('pid'), start_time) if start_time is not None else tuple(proc.items())
+
+    def intern(self, proctree: List[dict]) -> Tuple[List[int], List[dict]]:
+        """ Assign IDs to the processes in a process tree
+
+        :param List[dict] proctree: process tree
+        :raises TypeError: if processes cannot be identified because of unhashable information
+        :return: process IDs, and process records to be output before the event referencing them
+        """
+        ids = []
+        records = []
+        keys = list(map(self._process_key, proctree))
+        hash(tuple(keys))  # raises for unhashable keys, before any change in state
+        now = time.monotonic()
+        with self._lock:
+            for proc, key in zip(proctree, keys):
+                entry = self._processes.get(key)
+                if entry is None:
+                    entry = self._processes[key] = [next(self._ids), None]
+                    if len(self._processes) > self.max_size:
+                        self._processes.popitem(last=False)
+                else:
+                    self._processes.move_to_end(key)
+                if entry[1] is None or now - entry[1] >= self.reannounce_interval:
+                    entry[1] = now
+                    record = {'type': 'process', 'id': entry[0], **proc}
+                    if getattr(proc, 'start_time', None) is not None:
+                        record['start_time'] = proc.start_time
+                    records.append(record)
+                ids.append(entry[0])
+        return ids, records
+
+    def intern_event(self, event: dict) -> Tuple[dict, List[dict]]:
+        """ Replace `proctree` in event with `proctree_ids` (in the same position)
+
+        :param dict event: event dictionary
+        :return: updated event, and process records to be output before it
+        """
+        if 'proctree' not in event:
+            return event, []
+        try:
+            ids, records = self.intern(event['proctree'])
+        except TypeError:
+            return event, []
+        return (
+            {
+                ('proctree_ids' if key == 'proctree' else key): (ids if key == 'proctree' else value)
+                for key, value in event.items()
+            },
+            records,
+        )
+
+
+def create_serializer(probe_name: str, output_format: str = 'json', json_encoder: str = 'json') -> EventSerializer:
+    """ Create event serializer for a probe
+
+    :param str probe_name: name of the probe generating the events
+    :param str output_format: event output format
+    :param str json_encoder: name of the JSON encoder, for JSON output format
+    :return: event serializer
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise RuntimeError('{} is not among supported output formats {}'.format(output_format, OUTPUT_FORMATS))
+    if output_format == 'msgpack':
+        return MsgpackEventSerializer(probe_name)
+    return EventSerializer(probe_name, json_encoder)
@@ -0,0 +1,299 @@
+import asyncio
+import os
+import platform
+import struct
+import time
+from itertools import chain
+from multiprocessing import Lock as ProcessLock
+from multiprocessing import Pipe
+from multiprocessing.shared_memory import SharedMemory
+from threading import Lock
+from typing import Callable
+from typing import Iterable
+from typing import List
+from typing import Union
+
+from pidtree_bcc.utils import never_crash
+
+
+class EventTransport:
+    """ Base class for transports carrying serialized events from
+    the probe processes to the main process, where they get written out.
+
+    Producers run in the probe processes, while the consumer runs in the main
+    process, so instances must be created before probe processes are started.
+    """
+
+    # number of events dropped because the transport was full
+    overflow_count = 0
+    # whether consumers should also check for events periodically, as availability notifications may be lost
+    needs_polling = False
+
+    def put(self, item: Union[str, bytes]):
+        """ Send serialized event (producer side)
+
+        :param Union[str, bytes] item: serialized event
+        """
+        raise NotImplementedError
+
+    def flush(self):
+        """ Send out any event being buffered (producer side) """
+        pass
+
+    @never_crash
+    def flush_worker(self):
+        """ Handler function for a producer-side thread taking care of flushing
+        buffered events in a timely manner. Does nothing for unbuffered transports.
+        """
+        pass
+
+    def fileno(self) -> int:
+        """ File descriptor becoming readable when events are available (consumer side) """
+        raise NotImplementedError
+
+    def drain(self) -> List[Union[str, bytes]]:
+        """ Get all the events currently available, without blocking (consumer side)
+
+        :return: list of serialized events
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """ Release resources held by the transport (consumer side) """
+        pass
+
+
+class BatchingQueueTransport(EventTransport):
+    """ Event transport based on a pipe, shared by all probes.
+
+    Rather than sending events one by one, each producer accumulates them
+    and pushes them in batches, bounded by size and age. This way, the cost of
+    locking and pickling is paid once per batch, rather than once per event.
+    """
+
+    DEFAULT_MAX_BATCH = 64
+    DEFAULT_FLUSH_INTERVAL = 0.1  # seconds
+
+    def __init__(self, max_batch: int = DEFAULT_MAX_BATCH, flush_interval: float = DEFAULT_FLUSH_INTERVAL):
+        """ Constructor
+
+        :param int max_batch: maximum number of events in a batch
+        :param float flush_interval: maximum time in seconds events are buffered before being sent
+        """
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self._reader, self._writer = Pipe(duplex=False)
+        self._write_lock = ProcessLock()  # producers live in different processes
+        self._buffer = []
+        self._buffer_since = 0
+        self._lock = Lock()
+
+    def put(self, item: Union[str, bytes]):
+        with self._lock:
+            now = time.monotonic()
+            if not self._buffer:
+                self._buffer_since = now
+            self._buffer.append(item)
+            if len(self._buffer) >= self.max_batch or now - self._buffer_since >= self.flush_interval:
+                self._send_buffer()
+
+    def flush(self):
+        with self._lock:
+            self._send_buffer()
+
+    @never_crash
+    def flush_worker(self):
+        while True:
+            time.sleep(self.flush_interval)
+            with self._lock:
+                if self._buffer and time.monotonic() - self._buffer_since >= self.flush_interval:
+                    self._send_buffer()
+
+    def fileno(self) -> int:
+        return self._reader.fileno()
+
+    def drain(self) -> List[Union[str, bytes]]:
+        batch = []
+        while self._reader.poll():
+            batch.extend(self._reader.recv())
+        return batch
+
+    def _send_buffer(self):
+        """ Push buffered events to the pipe (lock must be held) """
+        if self._buffer:
+            with self._write_lock:
+                self._writer.send(self._buffer)
+            self._buffer = []
+
+
+class SharedMemoryRingTransport(EventTransport):
+    """ Event transport based on a single-producer/single-consumer ring buffer
+    in shared memory, meant to be used by a single probe.
+
+    Events are stored as length-prefixed records. The ring has a bounded capacity:
+    when it is full, events are dropped and counted in `overflow_count`, rather than
+    blocking the probe. Read and write positions are stored in the shared memory
+    header as ever increasing byte counters, each of them written by one side only.
+    The producer notifies the consumer via a pipe only when the ring goes from empty
+    to non-empty, so that the vast majority of events cost no system calls at all.
+
+    NOTE: the synchronization scheme relies on stores not being reordered with other
+    stores, which holds on x86 but not on weakly ordered architectures (e.g. arm64),
+    where the transport refuses to run. Consumers should wait for events with a timeout,
+    which takes care of the (rare) notifications lost due to races between the two sides.
+    """
+
+    DEFAULT_CAPACITY = 8 * 1024 * 1024  # bytes
+    needs_polling = True
+    HEAD_OFFSET = 0  # write position
+    TAIL_OFFSET = 64  # read position, in a different cache line from the write position
+    DATA_OFFSET = 128
+    POSITION = struct.Struct('=Q')
+    RECORD_HEADER = struct.Struct('=I')
+    SUPPORTED_MACHINES = ('x86_64', 'amd64', 'i386', 'i686')  # architectures with total store order
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY, binary: bool = False):
+        """ Constructor
+
+        :param int capacity: size in bytes of the ring buffer
+        :param bool binary: events are serialized to bytes rather than text
+        """
+        if not self.is_supported():
+            raise RuntimeError(
+                'Shared memory transport is not supported on {} (x86 only), use the queue transport instead'.format(
+                    platform.machine(),
+                ),
+            )
+        self.capacity = capacity
+        self.binary = binary
+        self._shm = SharedMemory(create=True, size=self.DATA_OFFSET + capacity)
+        self._data = self._shm.buf[self.DATA_OFFSET:self.DATA_OFFSET + capacity]
+        self._store(self.HEAD_OFFSET, 0)
+        self._store(self.TAIL_OFFSET, 0)
+        self._notify_reader, self._notify_writer = os.pipe()
+        os.set_blocking(self._notify_reader, False)
+        os.set_blocking(self._notify_writer, False)
+        self._lock = Lock()
+
+    @classmethod
+    def is_supported(cls) -> bool:
+        """ Check if the memory ordering of the current architecture is what the transport relies on """
+        return platform.machine().lower() in cls.SUPPORTED_MACHINES
+
+    def put(self, item: Union[str, bytes]):
+        data = item if self.binary else item.encode('utf8')
+        record_size = self.RECORD_HEADER.size + len(data)
+        with self._lock:
+            head = self._load(self.HEAD_OFFSET)
+            tail = self._load(self.TAIL_OFFSET)
+            if record_size > self.capacity - (head - tail):
+                self.overflow_count += 1
+                return
+            self._write(head, self.RECORD_HEADER.pack(len(data)))
+            self._write(head + self.RECORD_HEADER.size, data)
+            self._store(self.HEAD_OFFSET, head + record_size)
+            if head == tail:
+                self._notify()
+
+    def fileno(self) -> int:
+        return self._notify_reader
+
+    def drain(self) -> List[Union[str, bytes]]:
+        self._clear_notifications()
+        batch = []
+        tail = self._load(self.TAIL_OFFSET)
+        head = self._load(self.HEAD_OFFSET)
+        while tail < head:
+            while tail < head:
+                size, = self.RECORD_HEADER.unpack(self._read(tail, self.RECORD_HEADER.size))
+                record = self._read(tail + self.RECORD_HEADER.size, size)
+                batch.append(record if self.binary else record.decode('utf8'))
+                tail += self.RECORD_HEADER.size + size
+            self._store(self.TAIL_OFFSET, tail)
+            # check again in case the producer added records without notifying
+            head = self._load(self.HEAD_OFFSET)
+        return batch
+
+    def close(self):
+        self._data.release()
+        self._shm.close()
+        self._shm.unlink()
+        os.close(self._notify_reader)
+        os.close(self._notify_writer)
+
+    def _load(self, offset: int) -> int:
+        return self.POSITION.unpack_from(self._shm.buf, offset)[0]
+
+    def _store(self, offset: int, value: int):
+        self.POSITION.pack_into(self._shm.buf, offset, value)
+
+    def _write(self, position: int, data: bytes):
+        """ Write data to the ring, wrapping around if needed """
+        start = position % self.capacity
+        first_chunk = min(len(data), self.capacity - start)
+        self._data[start:start + first_chunk] = data[:first_chunk]
+        if first_chunk < len(data):
+            self._data[:len(data) - first_chunk] = data[first_chunk:]
+
+    def _read(self, position: int, size: int) -> bytes:
+        """ Read data from the ring, wrapping around if needed """
+        start = position % self.capacity
+        first_chunk = min(size, self.capacity - start)
+        data = bytes(self._data[start:start + first_chunk])
+        if first_chunk < size:
+            data += bytes(self._data[:size - first_chunk])
+        return data
+
+    def _notify(self):
+        try:
+            os.write(self._notify_writer, b'\0')
+        except BlockingIOError:
+            pass  # pipe is full, consumer will be woken up anyway
+
+    def _clear_notifications(self):
+        try:
+            while os.read(self._notify_reader, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+
+async def forward_events(
+    transports: Iterable[EventTransport],
+    write_batch: Callable[[List[Union[str, bytes]]], None],
+    poll_interval: float,
+):
+    """ Forward events to the writer function as soon as they are available on any of the transports.
+    Transports are watched through the running event loop; those which may miss notifications are
+    also checked every `poll_interval` seconds, so the loop never wakes up needlessly otherwise.
+
+    :param Iterable[EventTransport] transports: event transports
+    :param Callable write_batch: function taking care of writing out a list of serialized events
+    :param float poll_interval: seconds between safety-net checks of transports needing polling
+    """
+    loop = asyncio.get_running_loop()
+    transports = list(transports)
+    polled = [transport for transport in transports if transport.needs_polling]
+    ready = {}  # used as insertion-ordered set
+    wakeup = asyncio.Event()
+
+    def mark_ready(transport: EventTransport):
+        ready[transport] = None
+        wakeup.set()
+
+    for transport in transports:
+        loop.add_reader(transport.fileno(), mark_ready, transport)
+    try:
+        while True:
+            try:
+                await asyncio.wait_for(wakeup.wait(), poll_interval if polled else None)
+            except asyncio.TimeoutError:
+                ready.update(dict.fromkeys(polled))
+            wakeup.clear()
+            batch = list(chain.from_iterable(transport.drain() for transport in ready))
+            ready.clear()
+            if batch:
+                write_batch(batch)
+    finally:
+        for transport in transports:
+            loop.remove_reader(transport.fileno())
@@ -10,33 +10,28 @@ import struct
 import sys
 from typing import Callable
 from typing import List
+from typing import Sequence
 from typing import TextIO
 from typing import Type
 from typing import Union
 
-import psutil
+from pidtree_bcc.metrics import timed
+from pidtree_bcc.process_cache import ProcessTreeCache
+
+
+# Shared by all the probes running in the same process
+PROCESS_CACHE = ProcessTreeCache()
 
 
 def crawl_process_tree(pid: int) -> List[dict]:
-    """ Takes a process and returns all process ancestry until the ppid is 0
+    """ Takes a process and returns all process ancestry until the ppid is 0.
+    Ancestors are looked up in the process cache before falling back to /proc.
 
     :param int pid: child process ID
     :return: yields dicts with pid, cmdline and username navigating up the tree
     """
-    result = []
-    while True:
-        if pid == 0:
-            break
-        proc = psutil.Process(pid)
-        result.append(
-            {
-                'pid': proc.pid,
-                'cmdline': ' '.join(proc.cmdline()).strip(),
-                'username': proc.username(),
-            },
-        )
-        pid = proc.ppid()
-    return result
+    with timed('crawl_process_tree_seconds'):
+        return [proc.to_dict() for proc in PROCESS_CACHE.crawl(pid)]
 
 
 def smart_open(filename: str = None, mode: str = 'r') -> TextIO:
@@ -49,7 +44,7 @@ def smart_open(filename: str = None, mode: str = 'r') -> TextIO:
     if filename and filename != '-':
         return open(filename, mode)
     else:
-        return sys.stdout
+        return sys.stdout.buffer if 'b' in mode else sys.stdout
 
 
 def find_subclass(module_path: Union[str, List[str]], base_class: Type) -> Type:
@@ -102,12 +97,49 @@ def int_to_ip(encoded_ip: int) -> str:
     return socket.inet_ntoa(struct.pack('<L', encoded_ip))
 
 
+def is_ipv6(address: str) -> bool:
+    """ Check if an IP address or netmask is in IPv6 notation
+
+    :param str address: ip address
+    :return: True if IPv6
+    """
+    return ':' in address
+
+
+def ipv6_to_bytes(address: str) -> bytes:
+    """ Takes an IPv6 address and returns its 16 bytes, in network byte order
+
+    :param str address: ipv6 address
+    :return: packed address
+    """
+    return socket.inet_pton(socket.AF_INET6, address)
+
+
+def format_ip(encoded_ip: Union[int, Sequence[int]]) -> str:
+    """ Makes IP address sent from the kernel human readable, accepting both the
+    integer encoding of IPv4 addresses and the 16 bytes of IPv6 addresses
+
+    :param Union[int, Sequence[int]] encoded_ip: integer encoded IPv4 or packed IPv6 address
+    :return: IP address string
+    """
+    if isinstance(encoded_ip, int):
+        return int_to_ip(encoded_ip)
+    return socket.inet_ntop(socket.AF_INET6, bytes(encoded_ip))
+
+
 def netmask_to_prefixlen(netmask: str) -> int:
     """ Takes an IP netmask and returns the corresponding prefix length
 
-    :param str netmask: IP netmask (e.g. 255.255.0.0)
+    :param str netmask: IP netmask (e.g. 255.255.0.0 or ffff:ffff::)
     :return: prefix length
     """
+    if is_ipv6(netmask):
+        # IPv6 networks can only be defined by prefix length in `ipaddress`
+        bitmask = int.from_bytes(ipv6_to_bytes(netmask), 'big')
+        prefixlen = bin(bitmask).count('1')
+        if bitmask != ((1 << 128) - 1) ^ ((1 << (128 - prefixlen)) - 1):
+            raise ValueError('{} is not a valid netmask'.format(netmask))
+        return prefixlen
     return ipaddress.ip_network('0.0.0.0/{}'.format(netmask)).prefixlen
 
 
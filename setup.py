@@ -18,11 +18,15 @@ setuptools.setup(
     long_description_content_type='text/markdown',
     url='https://github.com/Yelp/pidtree-bcc',
     packages=setuptools.find_packages(
-        exclude=('tests*', 'itest*', 'packaging*'),
+        exclude=('tests*', 'itest*', 'packaging*', 'benchmarks*'),
     ),
     include_package_data=True,
     license='BSD 3-clause "New" or "Revised License"',
     scripts=['bin/pidtree-bcc'],
+    extras_require={
+        'msgpack': ['msgpack'],
+        'orjson': ['orjson'],
+    },
     classifiers=[
         'Programming Language :: Python :: 3',
         'License :: OSI Approved :: BSD License',
@@ -1,4 +1,17 @@
+import ctypes
+import json
+import time
+from collections import defaultdict
+from threading import Event
+from threading import Thread
+from unittest.mock import call
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import pytest
+
 from pidtree_bcc.probes import BPFProbe
+from pidtree_bcc.process_cache import ProcessInfo
 
 
 class MockProbe(BPFProbe):
@@ -17,3 +30,330 @@ some other text'''
     assert mock_probe.expanded_bpf_text == '''some text
 some_value
 some other text'''
+
+
+class MockProcEvent(ctypes.Structure):
+    _fields_ = [
+        ('type', ctypes.c_uint8),
+        ('pid', ctypes.c_uint32),
+        ('ppid', ctypes.c_uint32),
+        ('uid', ctypes.c_uint32),
+        ('args_size', ctypes.c_uint32),
+        ('start_ns', ctypes.c_uint64),
+        ('args', ctypes.c_char * 16),
+    ]
+
+
+def _mock_proc_event(args: bytes, **kwargs) -> MockProcEvent:
+    event = MockProcEvent(**kwargs)
+    ctypes.memmove(ctypes.addressof(event) + MockProcEvent.args.offset, args, min(len(args), MockProcEvent.args.size))
+    return event
+
+
+@patch('pidtree_bcc.probes.psutil')
+def test_decode_proc_event_args(mock_psutil):
+    event = _mock_proc_event(b'curl\x001.1.1.1\x00', args_size=15)
+    assert MockProbe._decode_proc_event_args(event) == 'curl 1.1.1.1'
+    mock_psutil.Process.assert_not_called()
+    mock_psutil.Process.return_value.cmdline.return_value = ['curl', '--silent', 'example.com']
+    event = _mock_proc_event(b'curl\x00--silent\x00ex', pid=123, args_size=25)
+    assert MockProbe._decode_proc_event_args(event) == 'curl --silent example.com'
+    mock_psutil.Process.assert_called_once_with(123)
+
+
+class MockAncestryEvent(ctypes.Structure):
+    _fields_ = [
+        ('pid', ctypes.c_uint32),
+        ('ancestry_size', ctypes.c_uint8),
+        ('ancestry_pid', ctypes.c_uint32 * 3),
+        ('ancestry_tgid', ctypes.c_uint32 * 3),
+        ('ancestry_start_ns', ctypes.c_uint64 * 3),
+        ('ancestry_comm', ctypes.c_char * 48),
+    ]
+
+
+def _mock_ancestry_event(ancestors: list) -> MockAncestryEvent:
+    event = MockAncestryEvent(pid=ancestors[0][0], ancestry_size=len(ancestors))
+    comms = b''.join(comm.ljust(16, b'\x00') for _, comm in ancestors)
+    ctypes.memmove(ctypes.addressof(event) + MockAncestryEvent.ancestry_comm.offset, comms, len(comms))
+    for i, (pid, _) in enumerate(ancestors):
+        event.ancestry_pid[i] = event.ancestry_tgid[i] = pid
+        event.ancestry_start_ns[i] = i
+    return event
+
+
+@patch('pidtree_bcc.probes.boot_ns_to_start_time', new=float)
+@patch('pidtree_bcc.probes.PROCESS_CACHE')
+def test_kernel_process_tree(mock_cache):
+    MockProbe.TEMPLATE_VARS = ['kernel_ancestry_depth']
+    probe = MockProbe(None, {'kernel_ancestry_depth': 3})
+    mock_cache.lookup.side_effect = [
+        None,
+        ProcessInfo(50, 1, 1.0, 'bash -i', 'foo'),
+    ]
+    event = _mock_ancestry_event([(123, b'curl'), (50, b'bash')])
+    assert probe.kernel_process_tree(event) == [
+        {'pid': 123, 'cmdline': 'curl', 'username': ''},
+        {'pid': 50, 'cmdline': 'bash -i', 'username': 'foo'},
+    ]
+    mock_cache.lookup.assert_has_calls([call(123, 0.0), call(50, 1.0)])
+    mock_cache.crawl.assert_not_called()
+    # truncated ancestry gets completed from userland
+    mock_cache.lookup.side_effect = lambda pid, _: ProcessInfo(pid, pid - 1, 1.0, 'foo', 'bar')
+    mock_cache.crawl.return_value = [ProcessInfo(1, 0, 1.0, 'init', 'root')]
+    event = _mock_ancestry_event([(4, b'a'), (3, b'b'), (2, b'c')])
+    assert [p['pid'] for p in probe.kernel_process_tree(event)] == [4, 3, 2, 1]
+    mock_cache.crawl.assert_called_once_with(1)
+
+
+@patch('pidtree_bcc.probes.PROCESS_CACHE')
+def test_kernel_process_tree_comm_only(mock_cache):
+    MockProbe.TEMPLATE_VARS = ['kernel_ancestry_depth', 'kernel_ancestry_mode']
+    probe = MockProbe(None, {'kernel_ancestry_depth': 3, 'kernel_ancestry_mode': 'comm'})
+    event = _mock_ancestry_event([(123, b'curl'), (50, b'bash'), (1, b'systemd')])
+    assert probe.kernel_process_tree(event) == [
+        {'pid': 123, 'cmdline': 'curl', 'username': ''},
+        {'pid': 50, 'cmdline': 'bash', 'username': ''},
+        {'pid': 1, 'cmdline': 'systemd', 'username': ''},
+    ]
+    mock_cache.lookup.assert_not_called()
+    mock_cache.crawl.assert_not_called()
+    event.ancestry_size = 0
+    assert probe.kernel_process_tree(event) is None
+
+
+@pytest.mark.parametrize(
+    'config',
+    (
+        {'kernel_ancestry_depth': 9},
+        {'kernel_ancestry_depth': -1},
+        {'kernel_ancestry_depth': 2, 'kernel_ancestry_mode': 'foo'},
+    ),
+)
+def test_validate_kernel_ancestry_config(config):
+    with pytest.raises(RuntimeError):
+        MockProbe(None, config)
+
+
+@pytest.mark.parametrize(
+    'kernel_version,config,expected',
+    (
+        ('5.15.0-generic', {}, BPFProbe.RING_BUFFER_PAGES_DEFAULT),
+        ('5.15.0-generic', {'ring_buffer_pages': 1024}, 1024),
+        ('5.15.0-generic', {'ring_buffer': False}, 0),
+        ('5.4.0-generic', {}, 0),
+    ),
+)
+@patch('pidtree_bcc.probes.platform')
+def test_ring_buffer_config(mock_platform, kernel_version, config, expected):
+    mock_platform.uname.return_value.release = kernel_version
+    MockProbe.TEMPLATE_VARS = []
+    probe = MockProbe(None, config)
+    assert probe.ring_buffer_pages == expected
+
+
+@pytest.mark.parametrize('kernel_version', ('5.15.0-generic', '5.4.0-generic'))
+@patch('pidtree_bcc.probes.platform')
+def test_open_event_buffers_ipv6(mock_platform, kernel_version):
+    mock_platform.uname.return_value.release = kernel_version
+    MockProbe.TEMPLATE_VARS = ['ipv6']
+    probe = MockProbe(None, {'ipv6': True})
+    probe.bpf = defaultdict(MagicMock)
+    probe._open_event_buffers()
+    assert set(probe.bpf) == {'events', 'events_v6'}
+    if probe.ring_buffer_pages:
+        probe.bpf['events'].open_ring_buffer.assert_called_once_with(probe._process_events)
+        probe.bpf['events_v6'].open_ring_buffer.assert_called_once_with(probe._process_ipv6_events)
+        probe.bpf['events_lost'][0].value = 2
+        probe.bpf['events_v6_lost'][0].value = 3
+        assert probe._ring_buffer_lost_event_count() == 5
+    else:
+        probe.bpf['events_v6'].open_perf_buffer.assert_called_once_with(
+            probe._process_ipv6_events,
+            page_cnt=BPFProbe.PERF_BUFFER_PAGES_DEFAULT,
+            lost_cb=probe._lost_event_callback,
+        )
+
+
+@pytest.mark.parametrize('pages', (0, 3, 'foo'))
+def test_validate_ring_buffer_config(pages):
+    with pytest.raises(RuntimeError):
+        MockProbe(None, {'ring_buffer_pages': pages})
+
+
+@pytest.mark.parametrize(
+    'config',
+    (
+        {'perf_buffer_pages': 6},
+        {'perf_buffer_max_pages': 0},
+        {'perf_buffer_pages': 64, 'perf_buffer_max_pages': 32},
+        {'poll_timeout_ms': -2},
+        {'poll_timeout_ms': 1.5},
+    ),
+)
+def test_validate_perf_buffer_config(config):
+    with pytest.raises(RuntimeError):
+        MockProbe(None, config)
+
+
+@patch('pidtree_bcc.probes.time')
+@patch('pidtree_bcc.probes.platform')
+def test_adapt_perf_buffer(mock_platform, mock_time):
+    mock_platform.uname.return_value.release = '5.4.0-generic'
+    mock_time.monotonic.return_value = 0
+    MockProbe.TEMPLATE_VARS = []
+    probe = MockProbe(None, {'perf_buffer_adaptive': True, 'perf_buffer_max_pages': 16})
+    probe.bpf = MagicMock()
+    events_table = probe.bpf.__getitem__.return_value
+    events_table.__len__.return_value = 2
+    for window in range(1, 7):
+        probe._lost_event_callback(10)
+        mock_time.monotonic.return_value = window * BPFProbe.PERF_BUFFER_LOSS_WINDOW
+        probe._adapt_perf_buffer()
+        if window == 3:
+            assert probe.perf_buffer_pages == 16
+            events_table.__delitem__.assert_has_calls([call(0), call(1)])
+            events_table.open_perf_buffer.assert_called_once_with(
+                probe._process_events,
+                page_cnt=16,
+                lost_cb=probe._lost_event_callback,
+            )
+        elif window < 3:
+            assert probe.perf_buffer_pages == 8
+    # already at the maximum size
+    events_table.open_perf_buffer.assert_called_once()
+
+
+def test_output_event_proctree_interning():
+    MockProbe.TEMPLATE_VARS = []
+    output_queue = MagicMock()
+    probe = MockProbe(output_queue, {'proctree_interning': True})
+    probe.serializer.timestamp = lambda: '2023-11-14T22:13:20Z'
+    proctree = [ProcessInfo(1, 0, 100.0, 'init', 'root').to_dict()]
+    probe._output_event({'pid': 1, 'proctree': proctree, 'error': ''})
+    probe._output_event({'pid': 1, 'proctree': proctree, 'error': ''})
+    assert [args[0] for args, _ in output_queue.put.call_args_list] == [
+        '{"type": "process", "id": 1, "pid": 1, "cmdline": "init", "username": "root", "start_time": 100.0, '
+        '"timestamp": "2023-11-14T22:13:20Z", "probe": "bpf_probe_test"}',
+        '{"pid": 1, "proctree_ids": [1], "error": "", "timestamp": "2023-11-14T22:13:20Z", "probe": "bpf_probe_test"}',
+        '{"pid": 1, "proctree_ids": [1], "error": "", "timestamp": "2023-11-14T22:13:20Z", "probe": "bpf_probe_test"}',
+    ]
+
+
+def test_output_event_proctree_interning_unhashable_plugin_field():
+    MockProbe.TEMPLATE_VARS = []
+    output_queue = MagicMock()
+    probe = MockProbe(output_queue, {'proctree_interning': True})
+    probe.serializer.timestamp = lambda: '2023-11-14T22:13:20Z'
+
+    def add_tags(event):
+        for proc in event['proctree']:
+            proc['tags'] = ['foo']
+        return event
+
+    probe.plugins = [MagicMock(process=add_tags)]
+    probe._output_event({'pid': 3, 'proctree': [{'pid': 3, 'cmdline': 'curl'}], 'error': ''})
+    output_queue.put.assert_called_once()
+    assert json.loads(output_queue.put.call_args[0][0])['proctree'] == [{'pid': 3, 'cmdline': 'curl', 'tags': ['foo']}]
+
+
+def test_output_event_proctree_interning_concurrent():
+    MockProbe.TEMPLATE_VARS = []
+    output = []
+    record_put = Event()
+
+    def slow_put(item):
+        if '"type": "process"' in item:
+            record_put.set()
+            time.sleep(0.1)  # give the other thread time to output its event, if it could
+        output.append(item)
+
+    probe = MockProbe(MagicMock(put=slow_put), {'proctree_interning': True})
+    proctree = [ProcessInfo(1, 0, 100.0, 'init', 'root').to_dict()]
+    first = Thread(target=probe._output_event, args=({'pid': 1, 'proctree': proctree, 'error': ''},))
+    first.start()
+    record_put.wait(1)
+    probe._output_event({'pid': 2, 'proctree': proctree, 'error': ''})
+    first.join()
+    assert ['"type": "process"' in item for item in output] == [True, False, False]
+
+
+def test_validate_proctree_interning_config():
+    with pytest.raises(RuntimeError):
+        MockProbe(None, {'proctree_interning': True, 'proctree_reannounce_interval': 0})
+
+
+class MockEvent(ctypes.Structure):
+    _fields_ = [
+        ('pid', ctypes.c_uint32),
+        ('value', ctypes.c_uint32),
+    ]
+
+
+def test_enrichment_workers():
+    MockProbe.TEMPLATE_VARS = []
+    output_queue = MagicMock()
+    probe = MockProbe(output_queue, {'enrichment_workers': 2, 'enrichment_queue_size': 2})
+    probe.bpf = MagicMock()
+    probe.serializer.timestamp = lambda: '2023-11-14T22:13:20Z'
+    probe.enrich_event = lambda event: {'pid': event.pid, 'value': event.value}
+    raw_event = MockEvent(pid=3, value=1)
+    probe.bpf.__getitem__.return_value.event.return_value = raw_event
+    for _ in range(3):
+        probe._process_events(None, None, None)
+    raw_event.value = 2  # buffer reused by the kernel
+    assert probe.enrichment_queues[0].qsize() == 0
+    assert probe.enrichment_queues[1].qsize() == 2
+    assert probe.enrichment_drop_count == 1
+    Thread(target=probe._enrichment_worker, args=(probe.enrichment_queues[1],), daemon=True).start()
+    for _ in range(100):
+        if output_queue.put.call_count == 2:
+            break
+        time.sleep(0.01)
+    assert [args[0] for args, _ in output_queue.put.call_args_list] == [
+        '{"pid": 3, "value": 1, "timestamp": "2023-11-14T22:13:20Z", "probe": "bpf_probe_test"}',
+    ] * 2
+
+
+@pytest.mark.parametrize(
+    'config',
+    (
+        {'enrichment_workers': -1},
+        {'enrichment_workers': 2, 'enrichment_queue_size': 0},
+    ),
+)
+def test_validate_enrichment_config(config):
+    with pytest.raises(RuntimeError):
+        MockProbe(None, config)
+
+
+def test_process_events_metrics():
+    MockProbe.TEMPLATE_VARS = []
+    probe = MockProbe(MagicMock(), {})
+    probe.bpf = MagicMock()
+    probe.enrich_event = lambda event: {'pid': event.pid} if event.pid else None
+    for pid in (0, 1, 2):
+        probe.bpf.__getitem__.return_value.event.return_value = MockEvent(pid=pid)
+        probe._process_events(None, None, None)
+    counters = probe.metrics.snapshot()['counters']
+    assert counters['events_received'] == 3
+    assert counters['events_filtered'] == 1
+    assert counters['events_enriched'] == 2
+    assert counters['events_output'] == 2
+    assert probe.metrics.snapshot()['histograms']['enrichment_seconds']['count'] == 3
+
+
+def test_sync_filter_counters():
+    MockProbe.TEMPLATE_VARS = []
+    probe = MockProbe(MagicMock(overflow_count=0), {'ring_buffer': False})
+    probe.bpf = MagicMock()
+    table = probe.bpf.__getitem__.return_value
+    table.Key.side_effect = lambda i: i
+    table.sum.side_effect = lambda i: ctypes.c_uint64(10 * i)
+    probe._sync_metrics()
+    counters = probe.metrics.snapshot()['counters']
+    assert counters['kernel_filtered_net'] == 0
+    assert counters['kernel_filtered_port'] == 10
+    assert counters['kernel_kretprobe_miss'] == 50
+    probe.bpf.__getitem__.side_effect = KeyError('filter_counters')
+    assert probe._read_filter_counters() == {}
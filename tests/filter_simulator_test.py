@@ -0,0 +1,192 @@
+import io
+import random
+import socket
+import struct
+
+import pytest
+
+from pidtree_bcc.filter_simulator import FILTERED_NET
+from pidtree_bcc.filter_simulator import FILTERED_PORT
+from pidtree_bcc.filter_simulator import FilterSimulator
+from pidtree_bcc.filter_simulator import read_csv
+from pidtree_bcc.filter_simulator import read_pcap
+from pidtree_bcc.filter_simulator import SUBMITTED
+from pidtree_bcc.filtering import NetFilter
+from pidtree_bcc.utils import ip_to_int
+from pidtree_bcc.utils import ipv6_to_bytes
+
+
+FILTERS = [
+    {'network': '10.0.0.0', 'network_mask': '255.0.0.0'},
+    {'network': '10.1.0.0', 'network_mask': '255.255.0.0', 'include_ports': [443]},
+    {'network': '10.1.2.0', 'network_mask': '255.255.255.0', 'except_ports': ['8000-8100']},
+    {'network': '192.168.0.1', 'network_mask': '255.255.255.255'},
+]
+
+
+@pytest.mark.parametrize(
+    'address,port,expected',
+    [
+        ('10.9.9.9', 80, FILTERED_NET),
+        # longest prefix wins, so the /8 filter is not considered
+        ('10.1.9.9', 80, SUBMITTED),
+        ('10.1.9.9', 443, FILTERED_NET),
+        ('10.1.2.3', 443, FILTERED_NET),
+        ('10.1.2.3', 8050, SUBMITTED),
+        ('192.168.0.1', 22, FILTERED_NET),
+        ('192.168.0.2', 22, FILTERED_PORT),
+        ('192.168.0.2', 80, SUBMITTED),
+    ],
+)
+def test_filter_simulator_classify(address, port, expected):
+    simulator = FilterSimulator.from_config(FILTERS, excludeports=[22, '100-200'])
+    assert simulator.classify(ip_to_int(address), port) == expected
+
+
+def test_filter_simulator_include_ports():
+    simulator = FilterSimulator.from_config([], includeports=[80, '8000-8001'])
+    assert [simulator.classify(ip_to_int('1.2.3.4'), port) for port in (80, 8001, 8002, 22)] == [
+        SUBMITTED, SUBMITTED, FILTERED_PORT, FILTERED_PORT,
+    ]
+
+
+@pytest.mark.parametrize('global_filters', ({'excludeports': [22, '100-200']}, {'includeports': [443, '0-10']}))
+def test_filter_simulator_port_bitmap(global_filters):
+    array_simulator = FilterSimulator.from_config(FILTERS, **global_filters)
+    bitmap_simulator = FilterSimulator.from_config(FILTERS, port_bitmap=True, **global_filters)
+    for port in range(0, 65536, 7):
+        assert bitmap_simulator.is_port_globally_filtered(port) == array_simulator.is_port_globally_filtered(port)
+
+
+def test_filter_simulator_filter_port_bitmap():
+    except_ports = [22, 80, 443, '1000-1100', 3306, 5432, 6379, 8080, 9090, '10000-10010']
+    simulator = FilterSimulator.from_config([
+        {'network': '10.0.0.0', 'network_mask': '255.0.0.0', 'except_ports': except_ports},
+    ])
+    address = ip_to_int('10.1.2.3')
+    assert [simulator.classify(address, port) for port in (22, 1050, 10010, 10011, 53)] == [
+        SUBMITTED, SUBMITTED, SUBMITTED, FILTERED_NET, FILTERED_NET,
+    ]
+
+
+def test_filter_simulator_no_filters():
+    simulator = FilterSimulator.from_config([])
+    assert simulator.classify(ip_to_int('1.2.3.4'), 22) == SUBMITTED
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_filter_simulator_matches_net_filter(seed):
+    rng = random.Random(seed)
+    filters = [
+        {
+            'network': '10.{}.0.0'.format(i),
+            'network_mask': rng.choice(('255.255.0.0', '255.255.255.0')),
+            **rng.choice(({}, {'except_ports': [80]}, {'include_ports': [22, 443]})),
+        }
+        for i in range(20)
+    ]
+    # overlapping all the others, and only deciding for addresses none of them match
+    filters.append({'network': '10.0.0.0', 'network_mask': '255.0.0.0', 'except_ports': [443]})
+    simulator = FilterSimulator.from_config(filters)
+    net_filter = NetFilter(filters)
+    for _ in range(500):
+        address = ip_to_int('10.{}.{}.1'.format(rng.randint(0, 25), rng.randint(0, 2)))
+        port = rng.choice((22, 80, 443))
+        assert simulator.is_addr_port_filtered(address, port) == net_filter.is_filtered(address, port)
+
+
+def test_filter_simulator_ipv6():
+    filters = FILTERS + [
+        {'network': 'fd00::', 'network_mask': 'ff00::'},
+        {'network': 'fd00:1::', 'network_mask': 'ffff:ffff::', 'include_ports': [443]},
+    ]
+    simulator = FilterSimulator.from_config(filters, excludeports=[22], ipv6=True)
+    assert [
+        simulator.classify(ipv6_to_bytes(address), port)
+        for address, port in (('fd12::1', 80), ('fd00:1::1', 80), ('fd00:1::1', 443), ('2001:db8::1', 22))
+    ] == [FILTERED_NET, SUBMITTED, FILTERED_NET, FILTERED_PORT]
+    # IPv4-mapped addresses are looked up among IPv4 filters
+    assert simulator.classify(ipv6_to_bytes('::ffff:10.9.9.9'), 80) == FILTERED_NET
+    # the same as NetFilter, also for IPv6
+    net_filter = NetFilter(filters)
+    for address in ('fd12::1', 'fd00:1::1', '2001:db8::1', '::ffff:10.1.9.9', '::ffff:192.168.0.1'):
+        for port in (80, 443):
+            expected = net_filter.is_filtered(address, port)
+            assert simulator.is_addr_port_filtered(ipv6_to_bytes(address), port) == expected
+    with pytest.raises(ValueError, match='not configured to capture IPv6'):
+        FilterSimulator.from_config(filters).classify(ipv6_to_bytes('fd12::1'), 80)
+
+
+def test_filter_simulator_count():
+    simulator = FilterSimulator.from_config(FILTERS, excludeports=[22])
+    csv_data = io.StringIO('daddr,port\n10.9.9.9,80\n10.1.9.9,80\n10.1.9.9,80\n1.1.1.1,22\n10.1.9.9,443\n')
+    assert simulator.count(read_csv(csv_data)) == {FILTERED_NET: 2, FILTERED_PORT: 1, SUBMITTED: 2}
+
+
+def _ipv4_packet(protocol: int, daddr: str, dport: int, tcp_flags: int = 0) -> bytes:
+    if protocol == socket.IPPROTO_TCP:
+        transport = struct.pack('!HHIIBBHHH', 12345, dport, 0, 0, 5 << 4, tcp_flags, 1024, 0, 0)
+    else:
+        transport = struct.pack('!HHHH', 12345, dport, 8, 0)
+    return struct.pack(
+        '!BBHHHBBH4s4s', 0x45, 0, 20 + len(transport), 0, 0, 64, protocol, 0,
+        socket.inet_aton('10.0.0.1'), socket.inet_aton(daddr),
+    ) + transport
+
+
+def _pcap(linktype: int, frames: list) -> bytes:
+    data = struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, linktype)
+    for frame in frames:
+        data += struct.pack('<IIII', 0, 0, len(frame), len(frame)) + frame
+    return data
+
+
+def test_read_pcap_ethernet():
+    ethernet = b'\x00' * 12
+    frames = [
+        ethernet + b'\x08\x00' + _ipv4_packet(socket.IPPROTO_TCP, '10.1.2.3', 443, tcp_flags=0x02),
+        # SYN-ACK and plain ACK are not connection attempts
+        ethernet + b'\x08\x00' + _ipv4_packet(socket.IPPROTO_TCP, '10.1.2.3', 443, tcp_flags=0x12),
+        ethernet + b'\x08\x00' + _ipv4_packet(socket.IPPROTO_TCP, '10.1.2.3', 443, tcp_flags=0x10),
+        ethernet + b'\x81\x00\x00\x01\x08\x00' + _ipv4_packet(socket.IPPROTO_UDP, '10.0.0.2', 53),
+        ethernet + b'\x08\x06' + b'\x00' * 28,  # ARP
+    ]
+    assert list(read_pcap(io.BytesIO(_pcap(1, frames)))) == [
+        (ip_to_int('10.1.2.3'), 443),
+        (ip_to_int('10.0.0.2'), 53),
+    ]
+
+
+def test_read_pcap_raw_ip():
+    frames = [_ipv4_packet(socket.IPPROTO_UDP, '127.0.0.1', 8125)]
+    assert list(read_pcap(io.BytesIO(_pcap(101, frames)))) == [(ip_to_int('127.0.0.1'), 8125)]
+
+
+def test_read_csv_ipv6():
+    csv_data = io.StringIO('daddr,port\n10.9.9.9,80\nfd00::1,443\n')
+    assert list(read_csv(csv_data)) == [(ip_to_int('10.9.9.9'), 80), (ipv6_to_bytes('fd00::1'), 443)]
+
+
+def test_read_pcap_ipv6():
+    udp = struct.pack('!HHHH', 12345, 53, 8, 0)
+    ipv6_packet = struct.pack(
+        '!IHBB16s16s', 6 << 28, len(udp), socket.IPPROTO_UDP, 64,
+        ipv6_to_bytes('fd00::2'), ipv6_to_bytes('fd00::53'),
+    ) + udp
+    frames = [
+        b'\x00' * 12 + b'\x86\xdd' + ipv6_packet,
+        b'\x00' * 12 + b'\x08\x00' + _ipv4_packet(socket.IPPROTO_UDP, '10.0.0.2', 53),
+    ]
+    assert list(read_pcap(io.BytesIO(_pcap(1, frames)), ipv6=True)) == [
+        (ipv6_to_bytes('fd00::53'), 53),
+        (ip_to_int('10.0.0.2'), 53),
+    ]
+    # not captured by probes without IPv6 support
+    assert list(read_pcap(io.BytesIO(_pcap(1, frames)))) == [(ip_to_int('10.0.0.2'), 53)]
+
+
+def test_read_pcap_unsupported():
+    with pytest.raises(ValueError):
+        list(read_pcap(io.BytesIO(b'\x0a\x0d\x0d\x0a' + b'\x00' * 20)))
+    with pytest.raises(ValueError):
+        list(read_pcap(io.BytesIO(_pcap(105, []))))
@@ -1,18 +1,25 @@
 import ctypes
+import ipaddress
+import random
 from unittest.mock import MagicMock
 
 import pytest
 
+from pidtree_bcc.filter_simulator import FilterSimulator
 from pidtree_bcc.filtering import CFilterKey
+from pidtree_bcc.filtering import CFilterKeyV6
 from pidtree_bcc.filtering import CFilterValue
+from pidtree_bcc.filtering import CPortBitmap
 from pidtree_bcc.filtering import CPortRange
 from pidtree_bcc.filtering import load_filters_into_map
 from pidtree_bcc.filtering import load_intset_into_map
+from pidtree_bcc.filtering import load_port_bitmap_into_map
 from pidtree_bcc.filtering import load_port_filters_into_map
 from pidtree_bcc.filtering import NetFilter
 from pidtree_bcc.filtering import port_range_mapper
 from pidtree_bcc.filtering import PortFilterMode
 from pidtree_bcc.utils import ip_to_int
+from pidtree_bcc.utils import ipv6_to_bytes
 
 
 @pytest.fixture
@@ -57,6 +64,62 @@ def test_filter_ip_include_port(net_filtering):
     assert not net_filtering.is_filtered('192.168.0.1', 80)
 
 
+def test_filter_ipv6():
+    net_filter = NetFilter([
+        {'network': 'fd00::', 'network_mask': 'ff00::'},
+        {'network': '2001:db8::', 'network_mask': 'ffff:ffff::', 'include_ports': [443]},
+        {'network': '10.0.0.0', 'network_mask': '255.0.0.0'},
+    ])
+    assert net_filter.is_filtered('fd12::1', 80)
+    assert net_filter.is_filtered(ipv6_to_bytes('fd12::1'), 80)
+    assert net_filter.is_filtered('2001:db8::1', 443)
+    assert not net_filter.is_filtered('2001:db8::1', 80)
+    assert not net_filter.is_filtered('fe80::1', 80)
+    assert net_filter.is_filtered('10.1.2.3', 80)
+    # IPv4-mapped addresses are checked against IPv4 filters
+    assert net_filter.is_filtered('::ffff:10.1.2.3', 80)
+    assert not net_filter.is_filtered(ipv6_to_bytes('::ffff:11.1.2.3'), 80)
+
+
+def test_filter_longest_prefix_match():
+    net_filter = NetFilter([
+        {'network': '10.0.0.0', 'network_mask': '255.0.0.0'},
+        {'network': '10.1.0.0', 'network_mask': '255.255.0.0', 'except_ports': [80, '8000-8100']},
+        {'network': '10.2.0.0', 'network_mask': '255.255.0.0', 'include_ports': [443]},
+        # replaces the previous filter for the same network, as in kernel
+        {'network': '10.2.0.0', 'network_mask': '255.255.0.0', 'include_ports': [22]},
+    ])
+    assert net_filter.is_filtered('10.3.2.1', 80)
+    assert not net_filter.is_filtered('10.1.2.3', 80)
+    assert not net_filter.is_filtered('10.1.2.3', 8100)
+    assert net_filter.is_filtered('10.1.2.3', 443)
+    assert net_filter.is_filtered('10.2.3.4', 22)
+    assert not net_filter.is_filtered('10.2.3.4', 443)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_net_filter_equivalent_to_kernel(seed):
+    rng = random.Random(seed)
+    ports = [22, 53, 80, 123, 443, 8080]
+    # few distinct networks, so that filters overlap and repeat
+    networks = [rng.getrandbits(32) for _ in range(4)]
+    filters = []
+    for _ in range(rng.randint(1, 20)):
+        prefixlen = rng.choice((0, 4, 8, 12, 16, 20, 24, 28, 31, 32, 32))
+        port_filter = rng.choice(((), ('except_ports',), ('include_ports',)))
+        filters.append({
+            'network': str(ipaddress.IPv4Address(rng.choice(networks) ^ rng.getrandbits(32 - prefixlen or 1))),
+            'network_mask': str(ipaddress.IPv4Network('0.0.0.0/{}'.format(prefixlen)).netmask),
+            **{key: rng.sample(ports, rng.randint(1, 3)) for key in port_filter},
+        })
+    net_filter = NetFilter(filters)
+    kernel_model = FilterSimulator.from_config(filters)
+    for _ in range(500):
+        address = ip_to_int(str(ipaddress.IPv4Address(rng.choice(networks) ^ rng.getrandbits(rng.randint(1, 32)))))
+        port = rng.choice(ports)
+        assert net_filter.is_filtered(address, port) == kernel_model.is_addr_port_filtered(address, port)
+
+
 def test_load_filters_into_map():
     mock_filters = [
         {
@@ -89,6 +152,59 @@ def test_load_filters_into_map():
     }
 
 
+def test_load_filters_into_map_port_bitmap():
+    many_ports = [22, 80, 443, '1000-1100', 3306, 5432, 6379, 8080, 9090]
+    mock_filters = [
+        {'network': '10.0.0.0', 'network_mask': '255.0.0.0', 'except_ports': many_ports},
+        {'network': '127.0.0.0', 'network_mask': '255.0.0.0', 'include_ports': many_ports[1:]},
+        {'network': '192.168.0.0', 'network_mask': '255.255.0.0', 'include_ports': many_ports},
+    ]
+    res_map = {}
+    bitmap_map = MagicMock()
+    load_filters_into_map(mock_filters, res_map, bitmap_map=bitmap_map)
+    assert res_map == {
+        CFilterKey(prefixlen=8, data=10): CFilterValue(mode=1, bitmap_index=1),
+        CFilterKey(prefixlen=8, data=127): CFilterValue(
+            mode=2,
+            range_size=8,
+            ranges=CFilterValue.range_array_t(*map(CPortRange.from_conf_value, many_ports[1:])),
+        ),
+        CFilterKey(prefixlen=16, data=43200): CFilterValue(mode=2, bitmap_index=2),
+    }
+    bitmaps = {call_args[0][0].value: call_args[0][1] for call_args in bitmap_map.__setitem__.call_args_list}
+    assert list(bitmaps) == [0, 1]
+    expected_ports = {22, 80, 443, *range(1000, 1101), 3306, 5432, 6379, 8080, 9090}
+    assert {port for port in range(65536) if bitmaps[0].is_set(port)} == expected_ports
+    assert bitmaps[0] == bitmaps[1]
+    with pytest.raises(ValueError):
+        load_filters_into_map(mock_filters, {})
+
+
+def test_load_filters_into_map_ipv6():
+    mock_filters = [
+        {'network': '10.0.0.0', 'network_mask': '255.0.0.0'},
+        {'network': 'fd00::1', 'network_mask': 'ff00::', 'except_ports': [123]},
+        {'network': '2001:db8::', 'network_mask': 'ffff:ffff::', 'include_ports': [443]},
+    ]
+    res_map, ipv6_map = {}, {}
+    # IPv6 filters are skipped if there is no map for them
+    load_filters_into_map(mock_filters, res_map)
+    assert list(res_map) == [CFilterKey(prefixlen=8, data=10)]
+    load_filters_into_map(mock_filters, res_map, ipv6_map=ipv6_map)
+    assert list(res_map) == [CFilterKey(prefixlen=8, data=10)]
+    assert ipv6_map == {
+        CFilterKeyV6(prefixlen=8, data=CFilterKeyV6.data_array_t(0xfd)): CFilterValue(
+            mode=1, range_size=1, ranges=CFilterValue.range_array_t(CPortRange(123, 123)),
+        ),
+        CFilterKeyV6(prefixlen=32, data=CFilterKeyV6.data_array_t(0x20, 0x01, 0x0d, 0xb8)): CFilterValue(
+            mode=2, range_size=1, ranges=CFilterValue.range_array_t(CPortRange(443, 443)),
+        ),
+    }
+    load_filters_into_map(mock_filters[:2], res_map, do_diff=True, ipv6_map=ipv6_map)
+    assert list(res_map) == [CFilterKey(prefixlen=8, data=10)]
+    assert list(ipv6_map) == [CFilterKeyV6(prefixlen=8, data=CFilterKeyV6.data_array_t(0xfd))]
+
+
 def test_load_filters_into_map_diff():
     mock_filters = [
         {
@@ -130,6 +246,44 @@ def test_load_port_filters_into_map(filter_input, mode, expected):
     }
 
 
+def _is_port_globally_filtered(mode: int, match: bool) -> bool:
+    """ Reference of `is_port_globally_filtered` in `utils.j2` """
+    return (mode == PortFilterMode.exclude and match) or (mode == PortFilterMode.include and not match)
+
+
+@pytest.mark.parametrize(
+    'filter_input,mode',
+    [
+        ((22, 80, 443), PortFilterMode.include),
+        (('10-20',), PortFilterMode.exclude),
+        ((1, '2-9', 10), PortFilterMode.exclude),
+        (('0-65535',), PortFilterMode.exclude),
+        (('100-100000000', 5), PortFilterMode.include),
+        ((), PortFilterMode.include),
+    ],
+)
+def test_port_bitmap_equivalent_to_array(filter_input, mode):
+    res_map = MagicMock()
+    load_port_filters_into_map(filter_input, mode, res_map)
+    array = {call_args[0][0].value: call_args[0][1].value for call_args in res_map.__setitem__.call_args_list}
+    bitmap_map = MagicMock()
+    load_port_bitmap_into_map(filter_input, mode, bitmap_map)
+    bitmap_map.__setitem__.assert_called_once()
+    key, bitmap = bitmap_map.__setitem__.call_args[0]
+    assert key.value == 0
+    assert bitmap == CPortBitmap.from_port_filters(filter_input, mode)
+    for port in range(65536):
+        assert (
+            _is_port_globally_filtered(bitmap.mode, bitmap.is_set(port))
+            == _is_port_globally_filtered(array[0], array.get(port, 0))
+        )
+
+
+def test_load_port_bitmap_into_map_invalid_mode():
+    with pytest.raises(ValueError):
+        load_port_bitmap_into_map([22], PortFilterMode.all, MagicMock())
+
+
 def test_load_port_filters_into_map_diff():
     res_map = MagicMock()
     res_map.items.return_value = [(ctypes.c_int(i), ctypes.c_uint8(i % 2)) for i in range(16)]
@@ -155,6 +309,14 @@ def test_lpm_trie_key():
         CFilterKey.from_network_definition('255.255.0.0', '192.168.0.0')
         == CFilterKey.from_network_definition('255.255.0.0', '192.168.2.3')
     )
+    assert (
+        CFilterKeyV6.from_network_definition('ffff:ffff::', '2001:db8::')
+        == CFilterKeyV6.from_network_definition('ffff:ffff::', '2001:db8:1::1')
+    )
+    assert len({
+        CFilterKeyV6.from_network_definition('ffff:ffff::', '2001:db8::'),
+        CFilterKeyV6.from_network_definition('ffff:ffff::', '2001:db8:1::1'),
+    }) == 1
 
 
 @pytest.mark.parametrize(
@@ -182,3 +344,112 @@ def test_load_intset_into_map(intset, initial, expected, do_diff):
             call_args[0][0].value
             for call_args in mapping.__delitem__.call_args_list
         }
+
+
+class FakeBatchTable:
+    """ Minimal eBPF table with batch operations, counting the system calls that a real one would issue """
+
+    def __init__(self, key_type, leaf_type, batch_supported=True):
+        self.Key = key_type
+        self.Leaf = leaf_type
+        self.batch_supported = batch_supported
+        self.data = {}
+        self.syscalls = 0
+
+    def _check_batch_support(self):
+        self.syscalls += 1
+        if not self.batch_supported:
+            raise Exception('BPF_MAP_UPDATE_BATCH failed: Invalid argument')
+
+    @staticmethod
+    def _elements(array):
+        size, data = ctypes.sizeof(array._type_), bytes(array)
+        return [data[i:i + size] for i in range(0, len(data), size)]
+
+    def items_update_batch(self, keys, values):
+        self._check_batch_support()
+        self.data.update(zip(self._elements(keys), self._elements(values)))
+
+    def items_delete_batch(self, keys):
+        self._check_batch_support()
+        for key in self._elements(keys):
+            del self.data[key]
+
+    def items_lookup_batch(self):
+        self._check_batch_support()
+        for key, value in list(self.data.items()):
+            yield self.Key.from_buffer_copy(key), self.Leaf.from_buffer_copy(value)
+
+    def items(self):
+        self.syscalls += 2 * len(self.data)
+        return [(self.Key.from_buffer_copy(k), self.Leaf.from_buffer_copy(v)) for k, v in self.data.items()]
+
+    def __setitem__(self, key, value):
+        self.syscalls += 1
+        self.data[bytes(self.Key(key.value) if hasattr(key, 'value') else key)] = bytes(
+            self.Leaf(value.value) if hasattr(value, 'value') else value,
+        )
+
+    def __delitem__(self, key):
+        self.syscalls += 1
+        del self.data[bytes(self.Key(key.value) if hasattr(key, 'value') else key)]
+
+    def as_dict(self):
+        return {self.Key.from_buffer_copy(k).value: self.Leaf.from_buffer_copy(v).value for k, v in self.data.items()}
+
+
+@pytest.mark.parametrize(
+    'batch_supported,expected_syscalls',
+    (
+        # batch update and mode update; then batch lookup, batch update and mode update
+        (True, (2, 3)),
+        # failed batch attempt and one update per port; then failed batch attempt,
+        # key iteration plus lookup for every slot, failed batch attempt and one update per port
+        (False, (65536, 1 + 2 * 65535 + 1 + 65534 + 1)),
+    ),
+)
+def test_load_port_filters_into_map_batch(batch_supported, expected_syscalls):
+    table = FakeBatchTable(ctypes.c_int, ctypes.c_uint8, batch_supported)
+    load_port_filters_into_map(['1-65535'], PortFilterMode.exclude, table)
+    assert table.as_dict() == {0: 1, **{i: 1 for i in range(1, 65535)}}
+    assert table.syscalls == expected_syscalls[0]
+    table.syscalls = 0
+    load_port_filters_into_map([22], PortFilterMode.include, table, do_diff=True)
+    assert table.as_dict() == {0: 2, 22: 1, **{i: 0 for i in range(1, 65535) if i != 22}}
+    assert table.syscalls == expected_syscalls[1]
+
+
+class AutoGeneratedFilterKey(ctypes.Structure):
+    """ Stand-in for the key type bcc generates for the network filter map """
+    _fields_ = [('prefixlen', ctypes.c_uint32), ('data', ctypes.c_uint32)]
+
+
+class AutoGeneratedFilterValue(ctypes.Structure):
+    """ Stand-in for the leaf type bcc generates for the network filter map """
+    _fields_ = [
+        ('mode', ctypes.c_int),
+        ('range_size', ctypes.c_uint8),
+        ('ranges', CFilterValue.range_array_t),
+        ('bitmap_index', ctypes.c_uint32),
+    ]
+
+
+def test_load_filters_into_map_batch():
+    table = FakeBatchTable(AutoGeneratedFilterKey, AutoGeneratedFilterValue)
+    mock_filters = [
+        {'network': '127.0.0.0', 'network_mask': '255.0.0.0'},
+        {'network': '10.0.0.0', 'network_mask': '255.0.0.0', 'except_ports': [123, 456]},
+    ]
+    load_filters_into_map(mock_filters, table)
+    assert table.syscalls == 1
+    table.syscalls = 0
+    load_filters_into_map(mock_filters[1:], table, do_diff=True)
+    assert table.syscalls == 3  # lookup, update and delete
+    assert list(table.data.items()) == [(
+        bytes(CFilterKey(prefixlen=8, data=10)),
+        bytes(CFilterValue(
+            mode=1,
+            range_size=2,
+            ranges=CFilterValue.range_array_t(CPortRange(123, 123), CPortRange(456, 456)),
+        )),
+    )]
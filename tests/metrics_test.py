@@ -0,0 +1,91 @@
+import asyncio
+
+from pidtree_bcc import metrics
+from pidtree_bcc.metrics import MetricsExporter
+from pidtree_bcc.metrics import ProbeMetrics
+
+
+def test_probe_metrics():
+    probe_metrics = ProbeMetrics('tcp_connect')
+    probe_metrics.inc('events_received')
+    probe_metrics.inc('events_received', 2)
+    probe_metrics.set('events_lost_kernel', 5)
+    probe_metrics.observe('enrichment_seconds', 0.00003)
+    probe_metrics.observe('enrichment_seconds', 0.002)
+    probe_metrics.observe('enrichment_seconds', 10)
+    snapshot = probe_metrics.snapshot()
+    assert snapshot['counters']['events_received'] == 3
+    assert snapshot['counters']['events_lost_kernel'] == 5
+    assert probe_metrics.get('events_received') == 3
+    histogram = snapshot['histograms']['enrichment_seconds']
+    assert histogram['buckets'] == [0, 1, 1, 1, 1, 2, 2, 2, 2, 2, 2, 3]
+    assert histogram['count'] == 3
+    assert abs(histogram['sum'] - 10.00203) < 1e-9
+    assert snapshot['histograms']['plugin_seconds']['count'] == 0
+
+
+def test_timed_active_metrics():
+    probe_metrics = ProbeMetrics('tcp_connect')
+    try:
+        with metrics.timed('crawl_process_tree_seconds'):
+            pass
+        assert probe_metrics.snapshot()['histograms']['crawl_process_tree_seconds']['count'] == 0
+        probe_metrics.activate()
+        with metrics.timed('crawl_process_tree_seconds'):
+            pass
+        assert probe_metrics.snapshot()['histograms']['crawl_process_tree_seconds']['count'] == 1
+    finally:
+        metrics._active_metrics = None
+
+
+def test_telemetry_record():
+    probe_metrics = ProbeMetrics('udp_session')
+    probe_metrics.inc('events_output')
+    probe_metrics.observe('plugin_seconds', 0.2)
+    record = probe_metrics.telemetry_record()
+    assert record['type'] == 'telemetry'
+    assert record['events_output'] == 1
+    assert record['plugin_seconds']['count'] == 1
+    assert record['plugin_seconds']['buckets']['0.1'] == 0
+    assert record['plugin_seconds']['buckets']['0.5'] == 1
+    assert record['plugin_seconds']['buckets']['+Inf'] == 1
+
+
+def test_metrics_exporter_render():
+    probe_metrics = ProbeMetrics('tcp_connect')
+    probe_metrics.inc('events_enriched', 4)
+    probe_metrics.observe('queue_wait_seconds', 0.0003)
+    exporter = MetricsExporter([probe_metrics])
+    exporter.events_written = 7
+    lines = exporter.render().splitlines()
+    assert 'pidtree_bcc_events_written_total 7' in lines
+    assert '# TYPE pidtree_bcc_events_enriched_total counter' in lines
+    assert 'pidtree_bcc_events_enriched_total{probe="tcp_connect"} 4' in lines
+    assert 'pidtree_bcc_queue_wait_seconds_bucket{probe="tcp_connect",le="0.0001"} 0' in lines
+    assert 'pidtree_bcc_queue_wait_seconds_bucket{probe="tcp_connect",le="0.0005"} 1' in lines
+    assert 'pidtree_bcc_queue_wait_seconds_bucket{probe="tcp_connect",le="+Inf"} 1' in lines
+    assert 'pidtree_bcc_queue_wait_seconds_count{probe="tcp_connect"} 1' in lines
+
+
+def test_metrics_exporter_serve(tmp_path):
+    socket_path = str(tmp_path / 'metrics.sock')
+    exporter = MetricsExporter([ProbeMetrics('tcp_connect')])
+
+    async def scrape() -> bytes:
+        server_task = asyncio.ensure_future(exporter.serve('unix:' + socket_path))
+        for _ in range(100):
+            try:
+                reader, writer = await asyncio.open_unix_connection(socket_path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(0.01)
+        writer.write(b'GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        response = await reader.read()
+        writer.close()
+        server_task.cancel()
+        return response
+
+    response = asyncio.run(asyncio.wait_for(scrape(), 5))
+    headers, body = response.split(b'\r\n\r\n', 1)
+    assert headers.startswith(b'HTTP/1.0 200 OK')
+    assert body.decode() == exporter.render()
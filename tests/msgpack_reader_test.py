@@ -0,0 +1,66 @@
+import io
+import json
+from unittest.mock import patch
+
+import pytest
+
+from pidtree_bcc.plugins.loginuidmap import LoginuidMap
+from pidtree_bcc.serialization import MsgpackEventSerializer
+
+msgpack_reader = pytest.importorskip('pidtree_bcc.msgpack_reader')
+
+
+EVENTS = (
+    {
+        'pid': 123,
+        'proctree': [
+            {'pid': 123, 'cmdline': 'curl 1.1.1.1', 'username': 'foo'},
+            {'pid': 1, 'cmdline': 'init', 'username': 'root'},
+        ],
+        'daddr': '1.1.1.1',
+        'port': 80,
+        'error': '',
+    },
+    {'pid': 123, 'proctree': [{'pid': 123, 'cmdline': 'curl'}], 'error': ''},
+    {'type': 'lost_event_telemetry', 'count': 0},
+)
+
+
+def test_msgpack_round_trip():
+    serializer = MsgpackEventSerializer('tcp_connect')
+    serializer.timestamp = lambda: '2023-11-14T22:13:20.123456Z'
+    output = io.BytesIO()
+    output.write(serializer.header())
+    for event in EVENTS:
+        output.write(serializer.serialize_with_metadata(event))
+    output.write(serializer.serialize_with_metadata(EVENTS[0])[:-3])  # truncated frame
+    output.seek(0)
+    json_output = io.StringIO()
+    msgpack_reader.convert_to_json(output, json_output)
+    assert json_output.getvalue().splitlines() == [
+        json.dumps({**event, 'timestamp': '2023-11-14T22:13:20.123456Z', 'probe': 'tcp_connect'})
+        for event in EVENTS
+    ]
+
+
+def test_msgpack_proctree_as_arrays():
+    serializer = MsgpackEventSerializer('tcp_connect')
+    frame = serializer.encode(EVENTS[0])
+    output = io.BytesIO(frame)
+    record = next(msgpack_reader.read_frames(output))
+    assert record['proctree'] == [[123, 'curl 1.1.1.1', 'foo'], [1, 'init', 'root']]
+    assert len(frame) == MsgpackEventSerializer.FRAME_HEADER.size + int.from_bytes(frame[:4], 'big')
+
+
+def test_msgpack_proctree_extra_fields():
+    serializer = MsgpackEventSerializer('tcp_connect')
+    with patch.object(LoginuidMap, '_get_loginuid', return_value=(1000, 'foo')):
+        event = LoginuidMap({}).process(json.loads(json.dumps(EVENTS[0])))
+    assert event['proctree'][0]['loginname'] == 'foo'
+    frame = serializer.encode(event)
+    record = next(msgpack_reader.read_frames(io.BytesIO(frame)))
+    assert record['proctree'] == [
+        [123, 'curl 1.1.1.1', 'foo', {'loginuid': 1000, 'loginname': 'foo'}],
+        [1, 'init', 'root'],
+    ]
+    assert next(msgpack_reader.read_events(io.BytesIO(serializer.header() + frame))) == event
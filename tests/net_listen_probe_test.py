@@ -7,6 +7,7 @@ import pytest
 
 from pidtree_bcc.probes.net_listen import NetListenProbe
 from pidtree_bcc.probes.net_listen import NetListenWrapper
+from pidtree_bcc.utils import ipv6_to_bytes
 
 
 @patch('pidtree_bcc.probes.net_listen.crawl_process_tree')
@@ -78,3 +79,41 @@ def test_net_listen_snapshot_worker(mock_psutil, mock_time):
         ])
     mock_psutil.net_connections.assert_called_once_with('inet4')
     mock_time.sleep.assert_has_calls([call(300), call(123)])
+
+
+@patch('pidtree_bcc.probes.net_listen.crawl_process_tree')
+@patch('pidtree_bcc.probes.net_listen.time')
+@patch('pidtree_bcc.probes.net_listen.psutil')
+def test_net_listen_snapshot_worker_ipv6(mock_psutil, mock_time, mock_crawl):
+    mock_time.sleep.side_effect = [None, Exception('foobar')]  # to stop inf loop
+    mock_psutil.net_connections.return_value = [
+        MagicMock(pid=111, status='LISTEN', laddr=MagicMock(ip='::1', port=1337)),
+        MagicMock(pid=112, status='LISTEN', laddr=MagicMock(ip='127.0.0.1', port=1338)),
+    ]
+    probe = NetListenProbe(None, {'ipv6': True, 'protocols': ['udp', 'tcp']})
+    assert 'int kprobe__inet6_bind' in probe.expanded_bpf_text
+    with patch.object(probe, '_process_events') as mock_process:
+        with pytest.raises(Exception, match='foobar'):
+            probe._snapshot_worker.__wrapped__(probe, 123)
+        mock_process.assert_has_calls([
+            call(None, NetListenWrapper(111, ipv6_to_bytes('::1'), 1337, 6), None, False),
+            call(None, NetListenWrapper(112, 16777343, 1338, 6), None, False),
+        ])
+    mock_psutil.net_connections.assert_called_once_with('inet')
+    mock_crawl.return_value = []
+    assert probe.enrich_event(NetListenWrapper(111, ipv6_to_bytes('::1'), 1337, 6))['laddr'] == '::1'
+
+
+@patch('pidtree_bcc.probes.net_listen.get_network_namespace')
+def test_net_listen_filter_counters_template(mock_netns):
+    mock_netns.return_value = 4026531992
+    probe = NetListenProbe(None, {'same_namespace_only': True, 'container_labels': ['foo=bar']})
+    text = probe.expanded_bpf_text
+    assert 'BPF_PERCPU_ARRAY(filter_counters, u64, 6);' in text
+    for i, counter in enumerate(NetListenProbe.FILTER_COUNTERS):
+        assert '#define FILTER_COUNTER_{} {}'.format(counter.upper(), i) in text
+    for counter in ('FILTERED_NET', 'FILTERED_PORT', 'FILTERED_MNTNS', 'FILTERED_NETNS', 'SUBMITTED', 'KRETPROBE_MISS'):
+        assert 'count_filter_decision(FILTER_COUNTER_{});'.format(counter) in text
+    # calls filtered by the kprobes are still recorded, as NULL, so they are not counted as kretprobe misses
+    assert 'count_filter_decision(FILTER_COUNTER_FILTERED_MNTNS);\n        sk = NULL;' in text
+    assert 'if (ret != 0 || *skp == 0) {' in text
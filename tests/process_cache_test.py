@@ -0,0 +1,173 @@
+from unittest.mock import call
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import pytest
+
+from pidtree_bcc.process_cache import boot_ns_to_start_time
+from pidtree_bcc.process_cache import ProcessInfo
+from pidtree_bcc.process_cache import ProcessTreeCache
+
+
+def _mock_process_table(table: dict):
+    """ Build psutil.Process side effect from pid -> (ppid, start_time, cmdline, username) mapping """
+    def factory(pid):
+        ppid, start_time, cmdline, username = table[pid]
+        return MagicMock(
+            pid=pid,
+            create_time=MagicMock(return_value=start_time),
+            ppid=MagicMock(return_value=ppid),
+            cmdline=MagicMock(return_value=cmdline.split()),
+            username=MagicMock(return_value=username),
+        )
+    return factory
+
+
+@pytest.fixture
+def mock_psutil():
+    with patch('pidtree_bcc.process_cache.psutil') as mock_psutil:
+        mock_psutil.Process.side_effect = _mock_process_table({
+            1: (0, 1.0, 'init', 'root'),
+            50: (1, 2.0, 'make -j', 'foo'),
+            123: (50, 3.0, 'curl 1.1.1.1', 'foo'),
+            124: (50, 4.0, 'curl 2.2.2.2', 'foo'),
+        })
+        yield mock_psutil
+
+
+def test_process_cache_crawl(mock_psutil):
+    cache = ProcessTreeCache()
+    assert cache.crawl(123) == [
+        ProcessInfo(123, 50, 3.0, 'curl 1.1.1.1', 'foo'),
+        ProcessInfo(50, 1, 2.0, 'make -j', 'foo'),
+        ProcessInfo(1, 0, 1.0, 'init', 'root'),
+    ]
+    assert cache.stats() == {'hits': 0, 'misses': 3, 'size': 3, 'tracked': 0}
+
+
+def test_process_cache_shared_ancestors(mock_psutil):
+    cache = ProcessTreeCache()
+    cache.crawl(123)
+    mock_psutil.Process.reset_mock()
+    assert [p.pid for p in cache.crawl(124)] == [124, 50, 1]
+    # the parent is found in cache, and the rest of the chain with it
+    mock_psutil.Process.assert_has_calls([call(124), call(50)])
+    assert mock_psutil.Process.call_count == 2
+    assert cache.stats() == {'hits': 2, 'misses': 4, 'size': 4, 'tracked': 0}
+
+
+def test_process_cache_pid_reuse(mock_psutil):
+    cache = ProcessTreeCache()
+    cache.crawl(123)
+    mock_psutil.Process.side_effect = _mock_process_table({
+        1: (0, 1.0, 'init', 'root'),
+        123: (1, 10.0, 'sshd', 'root'),
+    })
+    assert cache.crawl(123) == [
+        ProcessInfo(123, 1, 10.0, 'sshd', 'root'),
+        ProcessInfo(1, 0, 1.0, 'init', 'root'),
+    ]
+
+
+@patch('pidtree_bcc.process_cache.time')
+def test_process_cache_exec(mock_time, mock_psutil):
+    mock_time.monotonic.return_value = 0
+    cache = ProcessTreeCache(max_age=60)
+    cache.crawl(123)
+    # both the parent and the leaf process exec a different program, keeping PID and start time
+    mock_psutil.Process.side_effect = _mock_process_table({
+        1: (0, 1.0, 'init', 'root'),
+        50: (1, 2.0, 'ninja', 'foo'),
+        123: (50, 3.0, 'wget 1.1.1.1', 'foo'),
+    })
+    mock_time.monotonic.return_value = 30
+    assert [p.cmdline for p in cache.crawl(123)] == ['wget 1.1.1.1', 'make -j', 'init']
+    # ancestors are read again once their entries are too old
+    mock_time.monotonic.return_value = 61
+    assert [p.cmdline for p in cache.crawl(123)] == ['wget 1.1.1.1', 'ninja', 'init']
+
+
+def test_process_cache_eviction(mock_psutil):
+    cache = ProcessTreeCache(max_size=3)
+    cache.crawl(123)
+    cache.crawl(124)
+    assert len(cache) == 3
+    # curl 1.1.1.1 was the least recently used entry
+    assert cache.stats()['size'] == 3
+    assert (123, 3.0) not in cache._entries
+    assert [p.pid for p in cache.crawl(123)] == [123, 50, 1]
+
+
+def test_process_cache_missing_process(mock_psutil):
+    mock_psutil.Process.side_effect = Exception('no such process')
+    with pytest.raises(Exception, match='no such process'):
+        ProcessTreeCache().crawl(999)
+
+
+def test_process_cache_tracking(mock_psutil):
+    cache = ProcessTreeCache()
+    cache.crawl(50)
+    cache.track_exec(ProcessInfo(50, 1, 2.0, 'make -j', 'foo'))
+    cache.track_fork(200, 50, 5.0)
+    cache.track_exec(ProcessInfo(201, 50, 6.0, 'gcc main.c', 'foo'))
+    mock_psutil.Process.reset_mock()
+    assert cache.crawl(200) == [
+        ProcessInfo(200, 50, 5.0, 'make -j', 'foo'),
+        ProcessInfo(50, 1, 2.0, 'make -j', 'foo'),
+        ProcessInfo(1, 0, 1.0, 'init', 'root'),
+    ]
+    assert [p.pid for p in cache.crawl(201)] == [201, 50, 1]
+    mock_psutil.Process.assert_not_called()
+    assert cache.stats()['tracked'] == 3
+
+
+def test_process_cache_tracking_untracked_parent(mock_psutil):
+    cache = ProcessTreeCache()
+    cache.track_fork(200, 999, 5.0)
+    assert cache.stats()['tracked'] == 0
+    # exited process whose PID gets reused by the child of an untracked process
+    cache.track_exec(ProcessInfo(201, 1, 6.0, 'curl 2.2.2.2', 'foo'))
+    cache.track_exit(201, 6.0)
+    cache.track_fork(201, 999, 7.0)
+    assert cache.stats()['tracked'] == 0
+    mock_psutil.Error = KeyError  # not in the mock process table
+    assert cache.lookup(201) is None
+
+
+@patch('pidtree_bcc.process_cache.time')
+def test_process_cache_tracking_exit(mock_time, mock_psutil):
+    cache = ProcessTreeCache()
+    mock_time.monotonic.return_value = 100
+    cache.track_exec(ProcessInfo(200, 1, 5.0, 'curl 1.1.1.1', 'foo'))
+    cache.track_exec(ProcessInfo(201, 1, 6.0, 'curl 2.2.2.2', 'foo'))
+    cache.track_exit(200, 5.0)
+    cache.track_exit(201, 1.0)  # start time not matching, ignored
+    mock_time.monotonic.return_value = 110
+    cache.expire_exited(30)
+    # exited process can still be looked up during the grace period
+    assert cache.crawl(200)[0].cmdline == 'curl 1.1.1.1'
+    mock_time.monotonic.return_value = 140
+    cache.expire_exited(30)
+    assert cache.stats()['tracked'] == 1
+    mock_psutil.Process.side_effect = Exception('no such process')
+    with pytest.raises(Exception, match='no such process'):
+        cache.crawl(200)
+    cache.reset_tracking()
+    assert cache.stats()['tracked'] == 0
+
+
+def test_process_cache_lookup(mock_psutil):
+    mock_psutil.Error = Exception
+    cache = ProcessTreeCache()
+    assert cache.lookup(123) == ProcessInfo(123, 50, 3.0, 'curl 1.1.1.1', 'foo')
+    assert cache.lookup(123, 3.0) == ProcessInfo(123, 50, 3.0, 'curl 1.1.1.1', 'foo')
+    # pid was reused
+    assert cache.lookup(124, 1.0) is None
+    assert cache.lookup(999) is None
+
+
+@patch('pidtree_bcc.process_cache.BOOT_TIME', 1000.0)
+@patch('pidtree_bcc.process_cache.CLOCK_TICKS', 100)
+def test_boot_ns_to_start_time(mock_psutil):
+    assert boot_ns_to_start_time(12345678901) == 1012.34
+    mock_psutil.boot_time.assert_not_called()
@@ -0,0 +1,113 @@
+import json
+from datetime import datetime
+from unittest.mock import patch
+
+import pytest
+
+from pidtree_bcc.process_cache import ProcessInfo
+from pidtree_bcc.serialization import EventSerializer
+from pidtree_bcc.serialization import get_json_encoder
+from pidtree_bcc.serialization import ProcessInterner
+from pidtree_bcc.serialization import TimestampFormatter
+
+
+@pytest.mark.parametrize('time_ns', (1700000000123456789, 1700000000000000000, 1700000000000000999))
+@patch('pidtree_bcc.serialization.time.time_ns')
+def test_timestamp_formatter(mock_time_ns, time_ns):
+    mock_time_ns.return_value = time_ns
+    expected = datetime.utcfromtimestamp(time_ns // 1000 / 10 ** 6).isoformat() + 'Z'
+    assert TimestampFormatter()() == expected
+
+
+@patch('pidtree_bcc.serialization.time.time_ns')
+def test_timestamp_formatter_cache(mock_time_ns):
+    formatter = TimestampFormatter()
+    mock_time_ns.return_value = 1700000000123456789
+    assert formatter() == '2023-11-14T22:13:20.123456Z'
+    with patch('pidtree_bcc.serialization.time.strftime') as mock_strftime:
+        mock_time_ns.return_value = 1700000000999999999
+        assert formatter() == '2023-11-14T22:13:20.999999Z'
+        mock_strftime.assert_not_called()
+    mock_time_ns.return_value = 1700000001000000000
+    assert formatter() == '2023-11-14T22:13:21Z'
+
+
+@pytest.mark.parametrize(
+    'event',
+    (
+        {'pid': 123, 'proctree': [{'pid': 123, 'cmdline': 'curl ünicode', 'username': 'foo'}], 'error': ''},
+        {},
+        {'pid': 123, 'probe': 'overridden'},
+    ),
+)
+def test_event_serializer_byte_compatible(event):
+    serializer = EventSerializer('tcp_connect')
+    serializer.timestamp = lambda: '2023-11-14T22:13:20.123456Z'
+    expected_event = {**event, 'timestamp': '2023-11-14T22:13:20.123456Z', 'probe': 'tcp_connect'}
+    assert serializer.serialize_with_metadata(event) == json.dumps(expected_event)
+
+
+def test_event_serializer_orjson():
+    pytest.importorskip('orjson')
+    serializer = EventSerializer('udp_session', 'orjson')
+    serializer.timestamp = lambda: '2023-11-14T22:13:20Z'
+    assert serializer.serialize_with_metadata({'pid': 1, 'error': ''}) == (
+        '{"pid":1,"error":"","timestamp":"2023-11-14T22:13:20Z","probe":"udp_session"}'
+    )
+
+
+def test_get_json_encoder_unknown():
+    with pytest.raises(RuntimeError):
+        get_json_encoder('foobar')
+
+
+@patch('pidtree_bcc.serialization.time.monotonic')
+def test_process_interner(mock_monotonic):
+    mock_monotonic.return_value = 0
+    interner = ProcessInterner(reannounce_interval=60)
+    init = ProcessInfo(1, 0, 100.0, 'init', 'root').to_dict()
+    shell = ProcessInfo(2, 1, 200.0, 'bash', 'foo').to_dict()
+    event, records = interner.intern_event({'pid': 3, 'proctree': [{'pid': 3, 'cmdline': 'curl'}, shell, init]})
+    assert event == {'pid': 3, 'proctree_ids': [1, 2, 3]}
+    assert records == [
+        {'type': 'process', 'id': 1, 'pid': 3, 'cmdline': 'curl'},
+        {'type': 'process', 'id': 2, 'pid': 2, 'cmdline': 'bash', 'username': 'foo', 'start_time': 200.0},
+        {'type': 'process', 'id': 3, 'pid': 1, 'cmdline': 'init', 'username': 'root', 'start_time': 100.0},
+    ]
+    # same processes, already announced
+    mock_monotonic.return_value = 30
+    assert interner.intern([shell, init]) == ([2, 3], [])
+    # PID reused by a different process
+    reused = ProcessInfo(2, 1, 300.0, 'bash', 'foo').to_dict()
+    ids, records = interner.intern([reused, init])
+    assert ids == [4, 3]
+    assert [record['id'] for record in records] == [4]
+    # re-announcement
+    mock_monotonic.return_value = 60
+    ids, records = interner.intern([shell, init])
+    assert ids == [2, 3]
+    assert [record['id'] for record in records] == [2, 3]
+
+
+def test_process_interner_max_size():
+    interner = ProcessInterner(max_size=2)
+    procs = [ProcessInfo(pid, 0, 1.0, 'foo', 'bar').to_dict() for pid in range(3)]
+    assert interner.intern(procs[:2])[0] == [1, 2]
+    assert interner.intern(procs[1:])[0] == [2, 3]
+    # least recently referenced process was forgotten
+    ids, records = interner.intern(procs[:1])
+    assert ids == [4]
+    assert len(records) == 1
+
+
+def test_process_interner_unhashable():
+    interner = ProcessInterner()
+    init = ProcessInfo(1, 0, 100.0, 'init', 'root').to_dict()
+    init['tags'] = ['foo']  # e.g. added by a plugin
+    proctree = [{'pid': 3, 'cmdline': 'curl', 'tags': ['bar']}, init]
+    event = {'pid': 3, 'proctree': proctree}
+    assert interner.intern_event(event) == (event, [])
+    # process with a start time is identified regardless of its other information
+    event, records = interner.intern_event({'pid': 1, 'proctree': [init]})
+    assert event == {'pid': 1, 'proctree_ids': [1]}
+    assert records[0]['tags'] == ['foo']
@@ -1,8 +1,12 @@
+import ctypes
+from collections import defaultdict
+from unittest.mock import call
 from unittest.mock import MagicMock
 from unittest.mock import patch
 
 from pidtree_bcc.probes.tcp_connect import TCPConnectProbe
 from pidtree_bcc.utils import ip_to_int
+from pidtree_bcc.utils import ipv6_to_bytes
 
 
 @patch('pidtree_bcc.probes.tcp_connect.crawl_process_tree')
@@ -32,3 +36,169 @@ def test_tcp_connect_enrich_event(mock_crawl):
         'error': '',
     }
     mock_crawl.assert_called_once_with(123)
+
+
+@patch('pidtree_bcc.probes.tcp_connect.crawl_process_tree')
+def test_tcp_connect_enrich_event_ipv6(mock_crawl):
+    probe = TCPConnectProbe(None, {'ipv6': True})
+    assert 'int kretprobe__tcp_v6_connect' in probe.expanded_bpf_text
+    assert 'BPF_HASH(currsock_v6, u32, struct sock *);' in probe.expanded_bpf_text
+    mock_event = MagicMock(
+        pid=123,
+        dport=443,
+        daddr=(ctypes.c_uint8 * 16)(*ipv6_to_bytes('2001:db8::1')),
+        saddr=(ctypes.c_uint8 * 16)(*ipv6_to_bytes('fd00::2')),
+    )
+    mock_crawl.return_value = []
+    event = probe.enrich_event(mock_event)
+    assert (event['daddr'], event['saddr'], event['port']) == ('2001:db8::1', 'fd00::2', 443)
+
+
+@patch('pidtree_bcc.probes.tcp_connect.crawl_process_tree')
+@patch.object(TCPConnectProbe, '_ktime_to_isoformat', staticmethod(lambda ktime: 'ts{}'.format(ktime)))
+def test_tcp_connect_enrich_summary(mock_crawl):
+    probe = TCPConnectProbe(None, {'aggregate_interval': 60})
+    mock_key = MagicMock(pid=123, daddr=ip_to_int('1.1.1.1'), dport=443)
+    mock_stats = MagicMock(count=42, first_seen_ns=1, last_seen_ns=2, saddr=ip_to_int('127.0.0.1'))
+    mock_crawl.return_value = [{'pid': 123, 'cmdline': 'curl 1.1.1.1', 'username': 'foo'}]
+    assert probe.enrich_summary(mock_key, mock_stats) == {
+        'type': 'connection_summary',
+        'pid': 123,
+        'proctree': [{'pid': 123, 'cmdline': 'curl 1.1.1.1', 'username': 'foo'}],
+        'daddr': '1.1.1.1',
+        'saddr': '127.0.0.1',
+        'port': 443,
+        'count': 42,
+        'first_seen': 'ts1',
+        'last_seen': 'ts2',
+        'error': '',
+    }
+    assert (probe._aggregation_worker, (60,)) in probe.SIDECARS
+
+
+def test_tcp_connect_kretprobe_miss_template():
+    text = TCPConnectProbe(None, {'ipv6': True, 'container_labels': ['foo=bar']}).expanded_bpf_text
+    # calls filtered by the kprobes are still recorded, as NULL, so they are not counted as kretprobe misses
+    assert text.count('count_filter_decision(FILTER_COUNTER_FILTERED_MNTNS);\n        sk = NULL;') == 2
+    assert text.count('if (ret != 0 || *skpp == 0) {') == 2
+
+
+def test_tcp_connect_drain_aggregation_map():
+    probe = TCPConnectProbe(None, {'aggregate_interval': 60})
+    probe.bpf = MagicMock()
+    table = probe.bpf.__getitem__.return_value
+    table.items_lookup_and_delete_batch.side_effect = Exception('not supported')
+    table.items.return_value = [('a', 1), ('b', 2)]
+    assert probe._drain_aggregation_map() == [('a', 1), ('b', 2)]
+    table.__delitem__.assert_has_calls([call('a'), call('b')])
+
+
+def test_tcp_connect_reload_filters_double_buffered():
+    probe = TCPConnectProbe(None, {'filters': [{'network': '10.0.0.0', 'network_mask': '255.0.0.0'}]})
+    assert 'filter_generation_map' in probe.expanded_bpf_text
+    assert 'net_filter_map_1' in probe.expanded_bpf_text
+    tables = defaultdict(MagicMock)
+    probe.bpf = tables
+    probe.reload_filters(is_init=True)
+    assert set(tables) == {'net_filter_map_0', 'port_filter_map_0', 'filter_generation_map'}
+    assert tables['filter_generation_map'].__setitem__.call_args[0][1].value == 0
+    probe.net_filters = []
+    for expected_generation in (1, 0):
+        tables.clear()
+        probe.reload_filters()
+        assert set(tables) == {
+            'net_filter_map_{}'.format(expected_generation),
+            'port_filter_map_{}'.format(expected_generation),
+            'filter_generation_map',
+        }
+        assert tables['filter_generation_map'].__setitem__.call_args[0][1].value == expected_generation
+        # the copy being loaded is not in use, so all ports are rewritten rather than diffed
+        port_map = tables['port_filter_map_{}'.format(expected_generation)]
+        port_map.items.assert_not_called()
+        assert port_map.__setitem__.call_count == 65536
+
+
+def test_tcp_connect_reload_filters_ipv6():
+    filters = [
+        {'network': '10.0.0.0', 'network_mask': '255.0.0.0'},
+        {'network': 'fd00::', 'network_mask': 'ff00::', 'except_ports': [53]},
+    ]
+    assert 'net_filter_map_v6_0' not in TCPConnectProbe(None, {'filters': filters}).expanded_bpf_text
+    probe = TCPConnectProbe(None, {'filters': filters, 'ipv6': True})
+    assert (
+        'BPF_LPM_TRIE(net_filter_map_v6_0, struct net_filter_key_v6_t, struct net_filter_val_t, 512);'
+        in probe.expanded_bpf_text
+    )
+    tables = defaultdict(MagicMock)
+    probe.bpf = tables
+    probe.reload_filters(is_init=True)
+    assert 'net_filter_map_v6_0' in tables
+    (v4_key, _), = [call_args[0] for call_args in tables['net_filter_map_0'].__setitem__.call_args_list]
+    (v6_key, v6_value), = [call_args[0] for call_args in tables['net_filter_map_v6_0'].__setitem__.call_args_list]
+    assert (v4_key.prefixlen, v6_key.prefixlen) == (8, 8)
+    assert bytes(v6_key.data) == ipv6_to_bytes('fd00::')
+    assert (v6_value.mode, v6_value.ranges[0].lower) == (1, 53)
+
+
+def test_tcp_connect_reload_filters_port_bitmap():
+    probe = TCPConnectProbe(None, {'excludeports': ['1-1024'], 'port_filter_bitmap': True})
+    assert 'struct port_filter_bitmap_t' in probe.expanded_bpf_text
+    tables = defaultdict(MagicMock)
+    probe.bpf = tables
+    for is_init in (True, False):
+        probe.reload_filters(is_init)
+        port_map = tables['port_filter_map_{}'.format(probe.filter_generation)]
+        port_map.__setitem__.assert_called_once()
+        assert port_map.__setitem__.call_args[0][1].is_set(1024)
+
+
+def test_tcp_connect_filter_port_bitmaps():
+    filters = [
+        {'network': '10.0.0.0', 'network_mask': '255.0.0.0', 'except_ports': list(range(20))},
+        {'network': '10.1.0.0', 'network_mask': '255.255.0.0', 'include_ports': [80, 443]},
+    ]
+    assert 'net_filter_map_port_bitmaps_0' not in TCPConnectProbe(None, {'filters': filters[1:]}).expanded_bpf_text
+    probe = TCPConnectProbe(None, {'filters': filters})
+    assert 'BPF_ARRAY(net_filter_map_port_bitmaps_0, struct net_filter_port_bitmap_t, 8);' in probe.expanded_bpf_text
+    tables = defaultdict(MagicMock)
+    probe.bpf = tables
+    probe.reload_filters(is_init=True)
+    key, bitmap = tables['net_filter_map_port_bitmaps_0'].__setitem__.call_args[0]
+    assert key.value == 0
+    assert [port for port in range(30) if bitmap.is_set(port)] == list(range(20))
+    trie_values = [call_args[0][1] for call_args in tables['net_filter_map_0'].__setitem__.call_args_list]
+    assert [(value.bitmap_index, value.range_size) for value in trie_values] == [(1, 0), (0, 2)]
+
+
+def test_tcp_connect_reload_filters_port_bitmaps_capacity():
+    def bitmap_filter(i):
+        return {'network': '10.{}.0.0'.format(i), 'network_mask': '255.255.0.0', 'except_ports': list(range(20))}
+
+    probe = TCPConnectProbe(None, {'filters': [bitmap_filter(0)]})
+    tables = defaultdict(MagicMock)
+    probe.bpf = tables
+    probe.reload_filters(is_init=True)
+    probe.net_filters = [bitmap_filter(i) for i in range(9)]
+    tables.clear()
+    with patch('pidtree_bcc.probes.logging') as mock_logging:
+        probe.reload_filters()
+    assert 'need 9 port bitmaps, but the probe was started with room for 8' in mock_logging.error.call_args[0][0]
+    assert not tables
+    assert probe.filter_generation == 0
+    probe.net_filters = [bitmap_filter(i) for i in range(8)]
+    probe.reload_filters()
+    assert tables['net_filter_map_port_bitmaps_1'].__setitem__.call_count == 8
+    assert probe.filter_generation == 1
+
+
+def test_tcp_connect_reload_filters_no_port_bitmaps():
+    probe = TCPConnectProbe(None, {'filters': [{'network': '10.0.0.0', 'network_mask': '255.0.0.0'}]})
+    probe.bpf = defaultdict(MagicMock)
+    probe.reload_filters(is_init=True)
+    probe.net_filters = [
+        {'network': '10.0.0.0', 'network_mask': '255.0.0.0', 'include_ports': list(range(20))},
+    ]
+    with patch('pidtree_bcc.probes.logging') as mock_logging:
+        probe.reload_filters()
+    assert 'room for 0' in mock_logging.error.call_args[0][0]
+    assert probe.filter_generation == 0
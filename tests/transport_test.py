@@ -0,0 +1,123 @@
+import asyncio
+from unittest.mock import patch
+
+import pytest
+
+from pidtree_bcc.transport import BatchingQueueTransport
+from pidtree_bcc.transport import forward_events
+from pidtree_bcc.transport import SharedMemoryRingTransport
+
+
+@pytest.fixture
+def ring_transport():
+    transport = SharedMemoryRingTransport(capacity=64)
+    yield transport
+    transport.close()
+
+
+@patch('pidtree_bcc.transport.time')
+def test_batching_queue_transport_max_batch(mock_time):
+    mock_time.monotonic.return_value = 0
+    transport = BatchingQueueTransport(max_batch=3, flush_interval=10)
+    for i in range(7):
+        transport.put(str(i))
+    assert transport.drain() == ['0', '1', '2', '3', '4', '5']
+    assert transport.drain() == []
+    transport.flush()
+    assert transport.drain() == ['6']
+
+
+@patch('pidtree_bcc.transport.time')
+def test_batching_queue_transport_flush_interval(mock_time):
+    mock_time.monotonic.return_value = 0
+    transport = BatchingQueueTransport(max_batch=100, flush_interval=1)
+    transport.put('a')
+    transport.put('b')
+    assert transport.drain() == []
+    mock_time.monotonic.return_value = 1
+    transport.put('c')
+    assert transport.drain() == ['a', 'b', 'c']
+
+
+@patch('pidtree_bcc.transport.time')
+def test_batching_queue_transport_flush_worker(mock_time):
+    mock_time.sleep.side_effect = [None, None, Exception('foobar')]  # to stop inf loop
+    mock_time.monotonic.side_effect = [0, 0.5, 1.5]
+    transport = BatchingQueueTransport(max_batch=100, flush_interval=1)
+    transport.put('a')
+    with pytest.raises(Exception, match='foobar'):
+        # never_crash uses functools.wraps so we can extract the wrapped method
+        transport.flush_worker.__wrapped__(transport)
+    assert transport.drain() == ['a']
+
+
+def test_shm_ring_transport(ring_transport):
+    assert ring_transport.drain() == []
+    ring_transport.put('foo')
+    ring_transport.put('bàr')
+    assert _forward_until([ring_transport], 2) == ['foo', 'bàr']
+    assert ring_transport.drain() == []
+
+
+def test_shm_ring_transport_wrap_around(ring_transport):
+    for i in range(20):
+        item = 'event-{:03d}'.format(i)  # 14 bytes per record: not a divisor of capacity
+        ring_transport.put(item)
+        assert ring_transport.drain() == [item]
+    assert ring_transport.overflow_count == 0
+
+
+def test_shm_ring_transport_overflow(ring_transport):
+    for i in range(6):
+        ring_transport.put('event-{:03d}'.format(i))
+    # only 4 records of 14 bytes fit in 64 bytes
+    assert ring_transport.overflow_count == 2
+    assert ring_transport.drain() == ['event-{:03d}'.format(i) for i in range(4)]
+    ring_transport.put('x' * 100)
+    assert ring_transport.overflow_count == 3
+    assert ring_transport.drain() == []
+
+
+def test_shm_ring_transport_binary():
+    transport = SharedMemoryRingTransport(capacity=64, binary=True)
+    try:
+        transport.put(b'\x00\x01')
+        assert transport.drain() == [b'\x00\x01']
+    finally:
+        transport.close()
+
+
+@patch('pidtree_bcc.transport.platform')
+def test_shm_ring_transport_unsupported_architecture(mock_platform):
+    mock_platform.machine.return_value = 'aarch64'
+    assert not SharedMemoryRingTransport.is_supported()
+    with pytest.raises(RuntimeError, match='not supported on aarch64'):
+        SharedMemoryRingTransport(capacity=64)
+    mock_platform.machine.return_value = 'x86_64'
+    SharedMemoryRingTransport(capacity=64).close()
+
+
+def _forward_until(transports, expected_events: int, poll_interval: float = 10) -> list:
+    written = []
+
+    async def run():
+        task = asyncio.ensure_future(forward_events(transports, written.extend, poll_interval))
+        while len(written) < expected_events:
+            await asyncio.sleep(0.01)
+        task.cancel()
+
+    asyncio.run(asyncio.wait_for(run(), 5))
+    return written
+
+
+def test_forward_events(ring_transport):
+    queue_transport = BatchingQueueTransport(max_batch=1)
+    ring_transport.put('foo')
+    queue_transport.put('bar')
+    assert sorted(_forward_until([ring_transport, queue_transport], 2)) == ['bar', 'foo']
+
+
+def test_forward_events_lost_notification(ring_transport):
+    with patch.object(ring_transport, '_notify'):
+        ring_transport.put('foo')
+    assert _forward_until([ring_transport], 1, poll_interval=0.05) == ['foo']
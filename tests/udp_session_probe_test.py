@@ -1,3 +1,5 @@
+import ctypes
+from collections import defaultdict
 from unittest.mock import MagicMock
 from unittest.mock import patch
 
@@ -5,6 +7,7 @@ import pytest
 
 from pidtree_bcc.probes.udp_session import SessionEventWrapper
 from pidtree_bcc.probes.udp_session import UDPSessionProbe
+from pidtree_bcc.utils import ipv6_to_bytes
 
 
 @patch('pidtree_bcc.probes.udp_session.crawl_process_tree')
@@ -18,10 +21,10 @@ def test_udp_session_enrich_event(mock_time, mock_crawl):
         {'pid': 1, 'cmdline': 'init', 'username': 'root'},
     ]
     assert probe.enrich_event(
-        MagicMock(type=1, pid=123, sock_pointer=1, daddr=168430090, dport=1337),
+        MagicMock(type=1, pid=123, sock_pointer=1, daddr=168430090, dport=1337, counted=0),
     ) is None
     assert probe.enrich_event(
-        MagicMock(type=2, pid=123, sock_pointer=1, daddr=16777343, dport=1337),
+        MagicMock(type=2, pid=123, sock_pointer=1, daddr=16777343, dport=1337, counted=0),
     ) is None
     assert probe.enrich_event(
         MagicMock(type=3, pid=123, sock_pointer=1),
@@ -51,17 +54,65 @@ def test_udp_session_enrich_event(mock_time, mock_crawl):
     mock_crawl.assert_called_once_with(123)
 
 
+@patch('pidtree_bcc.probes.udp_session.crawl_process_tree')
+@patch('pidtree_bcc.probes.udp_session.time')
+def test_udp_session_enrich_event_kernel_counters(mock_time, mock_crawl):
+    probe = UDPSessionProbe(None)
+    probe.bpf = MagicMock()
+    table = probe.bpf.__getitem__.return_value
+    table.Key.side_effect = lambda **kwargs: tuple(kwargs.values())
+    table.__getitem__.side_effect = {
+        (1, 168430090, 53): MagicMock(first_seen_ns=0.5 * 10 ** 9, count=10),
+    }.__getitem__
+    mock_time.monotonic.side_effect = range(1, 5)
+    mock_crawl.return_value = []
+    probe.enrich_event(MagicMock(type=1, pid=123, sock_pointer=1, daddr=168430090, dport=53, counted=1))
+    # counters map was full
+    probe.enrich_event(MagicMock(type=2, pid=123, sock_pointer=1, daddr=16777343, dport=53, counted=0))
+    probe.enrich_event(MagicMock(type=2, pid=123, sock_pointer=1, daddr=16777343, dport=53, counted=0))
+    assert probe.enrich_event(MagicMock(type=3, pid=123, sock_pointer=1))['destinations'] == [
+        {'daddr': '10.10.10.10', 'port': 53, 'duration': 3.5, 'msg_count': 10},
+        {'daddr': '127.0.0.1', 'port': 53, 'duration': 2, 'msg_count': 2},
+    ]
+    table.__delitem__.assert_called_once_with((1, 168430090, 53))
+
+
+@patch('pidtree_bcc.probes.udp_session.crawl_process_tree')
+@patch('pidtree_bcc.probes.udp_session.time')
+def test_udp_session_enrich_event_ipv6(mock_time, mock_crawl):
+
+    class DestinationV6Key(ctypes.Structure):
+        _fields_ = [('sock_pointer', ctypes.c_uint64), ('daddr', ctypes.c_uint8 * 16), ('dport', ctypes.c_uint16)]
+
+    probe = UDPSessionProbe(None, {'ipv6': True})
+    assert 'int kprobe__udpv6_sendmsg' in probe.expanded_bpf_text
+    probe.bpf = MagicMock()
+    table = probe.bpf.__getitem__.return_value
+    table.Key = DestinationV6Key
+    table.__getitem__.return_value = MagicMock(first_seen_ns=0.5 * 10 ** 9, count=4)
+    mock_time.monotonic.side_effect = range(1, 5)
+    mock_crawl.return_value = []
+    daddr = (ctypes.c_uint8 * 16)(*ipv6_to_bytes('2001:db8::53'))
+    probe.enrich_event(MagicMock(type=1, pid=123, sock_pointer=1, daddr=daddr, dport=53, counted=1))
+    probe.enrich_event(MagicMock(type=2, pid=123, sock_pointer=1, daddr=daddr, dport=53, counted=1))
+    assert probe.enrich_event(MagicMock(type=3, pid=123, sock_pointer=1))['destinations'] == [
+        {'daddr': '2001:db8::53', 'port': 53, 'duration': 2.5, 'msg_count': 4},
+    ]
+    probe.bpf.__getitem__.assert_called_with('destination_counts_v6')
+    (key,), _ = table.__delitem__.call_args
+    assert (key.sock_pointer, bytes(key.daddr), key.dport) == (1, ipv6_to_bytes('2001:db8::53'), 53)
+
+
 @patch('pidtree_bcc.probes.udp_session.time')
 def test_udp_session_expiration_worker(mock_time):
     mock_time.sleep.side_effect = [None, Exception('foobar')]  # to stop inf loop
-    mock_time.monotonic.return_value = 200
     probe = UDPSessionProbe(None)
-    probe.session_tracking = {
-        1: {'last_update': 180},
-        2: {'last_update': 0},
-        3: {'last_update': 190},
-    }
-    with patch.object(probe, '_process_events') as mock_process:
+    for sock_pointer, last_update in ((1, 180), (2, 0), (3, 190)):
+        mock_time.monotonic.return_value = last_update
+        probe.enrich_event(MagicMock(type=1, pid=123, sock_pointer=sock_pointer, daddr=1, dport=53, counted=0))
+    mock_time.monotonic.return_value = 200
+    with patch.object(probe, '_process_events') as mock_process, \
+            patch.object(probe, '_sweep_destination_counters') as mock_sweep:
         # never_crash uses functools.wraps so we can extract the wrapped method
         undecorated_method = probe._session_expiration_worker.__wrapped__
         # assert we catch the inf loop stopping exception
@@ -72,3 +123,69 @@ def test_udp_session_expiration_worker(mock_time):
         mock_process.assert_called_once_with(
             None, SessionEventWrapper(3, 2), None, False,
         )
+        mock_sweep.assert_called_once_with(80)
+    assert probe.session_tracking[2].error == 'session_max_duration_exceeded'
+
+
+@patch('pidtree_bcc.probes.udp_session.time')
+def test_udp_session_pop_expired_sessions(mock_time):
+    probe = UDPSessionProbe(None)
+    probe.EXPIRATION_BATCH_SIZE = 1
+    for sock_pointer in range(1, 5):
+        mock_time.monotonic.return_value = sock_pointer
+        probe.enrich_event(MagicMock(type=1, pid=123, sock_pointer=sock_pointer, daddr=1, dport=53, counted=0))
+    mock_time.monotonic.return_value = 50
+    # session 1 is still active, session 2 ended
+    probe.enrich_event(MagicMock(type=2, pid=123, sock_pointer=1, daddr=1, dport=53, counted=0))
+    probe.enrich_event(MagicMock(type=3, pid=123, sock_pointer=2))
+    assert probe._pop_expired_sessions(10) == [3, 4]
+    # session 1 entry was pushed back with its last update time
+    assert [entry[2] for entry in probe.session_expiry] == [1]
+    assert probe._pop_expired_sessions(60) == [1]
+    assert probe.session_memory_footprint()['sessions'] == 3
+
+
+@patch('pidtree_bcc.probes.udp_session.crawl_process_tree')
+@patch('pidtree_bcc.probes.udp_session.time')
+def test_udp_session_expiration_kernel_counters(mock_time, mock_crawl):
+    probe = UDPSessionProbe(None)
+    probe.bpf = defaultdict(MagicMock)
+    counters = probe.bpf['destination_counts']
+    counters.Key.side_effect = lambda **kwargs: tuple(kwargs.values())
+    counters.__getitem__.side_effect = {
+        (1, 1, 53): MagicMock(first_seen_ns=0, last_seen_ns=100 * 10 ** 9, count=5),
+        (2, 1, 53): MagicMock(first_seen_ns=0, last_seen_ns=5 * 10 ** 9, count=5),
+    }.__getitem__
+    mock_time.monotonic.return_value = 0
+    mock_crawl.return_value = []
+    for sock_pointer in (1, 2):
+        probe.enrich_event(MagicMock(type=1, pid=123, sock_pointer=sock_pointer, daddr=1, dport=53, counted=1))
+    # session 1 only sent messages counted in kernel since, so it is still active
+    assert probe._pop_expired_sessions(10) == [2]
+    assert [entry[:1] + entry[2:3] for entry in probe.session_expiry] == [(100, 1)]
+    probe.enrich_event(SessionEventWrapper(3, 2))
+    tracing = probe.bpf['tracing']
+    tracing.__delitem__.assert_called_once_with(tracing.Key.return_value)
+    tracing.Key.assert_called_once_with(2)
+    # sessions ended by the kernel are no longer traced there already
+    probe.enrich_event(MagicMock(type=3, pid=123, sock_pointer=1))
+    tracing.__delitem__.assert_called_once()
+
+
+@patch('pidtree_bcc.probes.udp_session.crawl_process_tree')
+@patch('pidtree_bcc.probes.udp_session.time')
+def test_udp_session_sweep_destination_counters(mock_time, mock_crawl):
+    probe = UDPSessionProbe(None)
+    probe.bpf = defaultdict(MagicMock)
+    mock_time.monotonic.return_value = 100
+    mock_crawl.return_value = []
+    probe.enrich_event(MagicMock(type=1, pid=123, sock_pointer=1, daddr=1, dport=53, counted=1))
+    counters = probe.bpf['destination_counts']
+    counters.items.return_value = [
+        (MagicMock(sock_pointer=1), MagicMock(last_seen_ns=5 * 10 ** 9)),  # session tracked here
+        (MagicMock(sock_pointer=2), MagicMock(last_seen_ns=5 * 10 ** 9)),  # end of session was lost
+        (MagicMock(sock_pointer=3), MagicMock(last_seen_ns=90 * 10 ** 9)),  # start of session not handled yet
+    ]
+    assert probe._sweep_destination_counters(80) == 1
+    (key,), _ = counters.__delitem__.call_args
+    assert key.sock_pointer == 2
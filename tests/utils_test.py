@@ -20,6 +20,7 @@ def test_smart_open():
     this_file = os.path.abspath(__file__)
     assert utils.smart_open() == sys.stdout
     assert utils.smart_open('-') == sys.stdout
+    assert utils.smart_open('-', mode='wb') == sys.stdout.buffer
     assert utils.smart_open(this_file).name == this_file
 
 
@@ -33,6 +34,12 @@ def test_int_to_ip():
     assert utils.int_to_ip(168430090) == '10.10.10.10'
 
 
+def test_format_ip():
+    assert utils.format_ip(16777343) == '127.0.0.1'
+    assert utils.format_ip(utils.ipv6_to_bytes('fd00::1')) == 'fd00::1'
+    assert utils.format_ip(list(utils.ipv6_to_bytes('::ffff:10.0.0.1'))) == '::ffff:10.0.0.1'
+
+
 @patch('pidtree_bcc.utils.os')
 def test_get_network_namespace(mock_os):
     mock_os.readlink.return_value = 'net:[456]'
@@ -52,6 +59,11 @@ def test_netmask_to_prefixlen():
     assert utils.netmask_to_prefixlen('255.0.0.0') == 8
     with pytest.raises(ValueError):
         utils.netmask_to_prefixlen('1.1.1.1')
+    assert utils.netmask_to_prefixlen('::') == 0
+    assert utils.netmask_to_prefixlen('ffff:ff00::') == 24
+    assert utils.netmask_to_prefixlen('ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff') == 128
+    with pytest.raises(ValueError):
+        utils.netmask_to_prefixlen('ffff::1')
 
 
 def test_round_nearest_multiple():